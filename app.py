@@ -1,25 +1,238 @@
+import time
+_startup = time.perf_counter()
+
+import functools
+import json
 import os
+import re
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import pandas as pd
-import plotly_express as px
+import dash_table
 from dash.dependencies import Input, Output
+from flask import Response, jsonify
 
-import src.twitter_plots as twitter_plots
+from src.figure_cache import FigureCache, data_version
 from src.helpers import get_project_global_variables
+from src.instrumentation import CallbackMetrics
+from src.twitter_cube import (build_daily_cube, cube_from_table, cube_range,
+                              tweet_counts_by_handle, tweet_counts_by_week)
+from src.twitter_browser import COLUMNS as BROWSER_COLUMNS, TweetBrowser
+from src.twitter_search import build_search_index, load_search_index
+from src.twitter_stats import build_sentiment_stats, load_sentiment_stats
+from src.twitter_storage import (content_path, read_rows, read_table,
+                                 read_tweets, table_exists)
+from src.twitter_term_index import (build_term_index, load_term_index,
+                                    top_terms)
 
 users = get_project_global_variables()["twitter_handles"]
 df_path_raw = get_project_global_variables()["df_path_raw"]
 df_path_clean = get_project_global_variables()["df_path_clean"]
-df_path_word_count = get_project_global_variables()["df_path_word_count"]
-df_path_phrase_count = get_project_global_variables()["df_path_phrase_count"]
+# the clean tweets are split by handle and week, so a callback can read only
+# the partitions it needs
+partitioned = get_project_global_variables()["data_layout"] == "partitioned"
+df_path_daily_cube = get_project_global_variables()["df_path_daily_cube"]
+word_index_path = get_project_global_variables()["word_index_path"]
+phrase_index_path = get_project_global_variables()["phrase_index_path"]
+search_index_path = get_project_global_variables()["search_index_path"]
+figures_dir = get_project_global_variables()["figures_dir"]
+sentiment_stats_path = get_project_global_variables()["sentiment_stats_path"]
+term_text_col = get_project_global_variables()["term_text_col"]
+scatter_mode = get_project_global_variables()["sentiment_scatter_mode"]
+scatter_max_points = \
+    get_project_global_variables()["sentiment_scatter_max_points"]
+
+
+def plots():
+    """
+    Imports the plotting module on first use. It pulls in plotly express,
+    so importing it lazily keeps it off the start up path.
+    """
+    import src.twitter_plots as twitter_plots
+    return twitter_plots
+
+
+# only the columns the dashboard uses
+tweet_columns = ['date', 'date_week', 'handle', 'break_tweet', 'polarity',
+                 'subjectivity', 'about_trudeau', 'about_scheer', 'about_may',
+                 'about_singh', 'about_bernier']
+
+
+@functools.lru_cache(maxsize=None)
+def tweets():
+    """Loads the clean tweets the first time they are needed"""
+    return read_table(df_path_clean, columns=tweet_columns)
+
+
+@functools.lru_cache(maxsize=None)
+def static_figure(name):
+    """
+    Returns one of the figures in twitter_plots.STATIC_FIGURES, loaded from
+    the JSON saved by the refresh stage or, if missing, built on first use.
+    """
+    path = os.path.join(figures_dir, f"{name}.json")
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    if name in plots().STATS_FIGURES:
+        return plots().STATS_FIGURES[name](sentiment_stats())
+    return plots().STATIC_FIGURES[name](tweets())
+
+
+@functools.lru_cache(maxsize=None)
+def sentiment_stats():
+    """
+    Sentiment distributions and trendlines saved by the refresh stage or,
+    if missing, computed from the tweets on first use.
+    """
+    if os.path.exists(sentiment_stats_path):
+        return load_sentiment_stats(sentiment_stats_path)
+    return build_sentiment_stats(tweets())
+
+
+@functools.lru_cache(maxsize=None)
+def sentiment_points():
+    """Tweets sorted by subjectivity for zooming into the sentiment scatter"""
+    return tweets()[['handle', 'subjectivity', 'polarity', 'break_tweet']] \
+        .sort_values('subjectivity', kind='stable').reset_index(drop=True)
+
+
+@functools.lru_cache(maxsize=None)
+def sentiment_trendlines():
+    """Trendlines of the sentiment scatter, fit to every tweet"""
+    return sentiment_stats()['trendlines']
+
+
+@functools.lru_cache(maxsize=16)
+def tweet_browser(handle="All", start_date=None, end_date=None):
+    """
+    Tweets of a handle (or "All") between two dates (None for no limit),
+    indexed for the tweet browser the first time they are used
+    """
+    handles = None if handle == "All" else [handle]
+    return TweetBrowser(read_tweets(df_path_clean, columns=BROWSER_COLUMNS,
+                                    handles=handles, start_date=start_date,
+                                    end_date=end_date))
+
+
+@functools.lru_cache(maxsize=None)
+def search_index():
+    """
+    The index of the clean tweets the search box queries, loaded the first
+    time something is searched
+    """
+    if os.path.exists(search_index_path):
+        return load_search_index(search_index_path)
+    return build_search_index(read_table(
+        df_path_clean, columns=['date', 'handle', 'clean_tweet']))
+
+
+@functools.lru_cache(maxsize=64)
+def search(query, start_date, end_date):
+    """Tweets matching a query between two dates, see SearchIndex.find"""
+    return search_index().find(query, start_date, end_date)
+
 
-df = pd.read_csv(df_path_clean)
-df['date'] = pd.to_datetime(df['date'])
-df_word_count = pd.read_csv(df_path_word_count)
-df_phrase_count = pd.read_csv(df_path_phrase_count)
+def searched_tweets(query, start_date, end_date):
+    """The clean tweets matching a query between two dates"""
+    rows = search_index().rows(search(query, start_date, end_date))
+    if partitioned:
+        # only the partitions holding the matches are read
+        return read_rows(df_path_clean, rows, columns=tweet_columns)
+    return tweets().iloc[rows]
+
+
+def search_query(query):
+    """The search box value, None if nothing is searched"""
+    return (query or "").strip() or None
+
+
+@functools.lru_cache(maxsize=None)
+def read_doc(name):
+    """Reads a markdown file from docs/ once per process"""
+    with open(os.path.join("docs", name)) as file:
+        return file.read()
+
+
+# tweets per day and handle for the date range callbacks
+if table_exists(df_path_daily_cube):
+    daily_cube = cube_from_table(read_table(df_path_daily_cube))
+else:
+    daily_cube = build_daily_cube(tweets())
+min_date = daily_cube.index.get_level_values('date').min()
+max_date = daily_cube.index.get_level_values('date').max()
+
+# word and phrase counts per day and handle for the count callbacks
+if os.path.exists(word_index_path) and os.path.exists(phrase_index_path):
+    word_index = load_term_index(word_index_path)
+    phrase_index = load_term_index(phrase_index_path)
+else:
+    df_text = read_table(df_path_clean,
+                         columns=['date', 'handle', term_text_col])
+    word_index = build_term_index(df_text, text_col=term_text_col,
+                                  ngrams=(1,))
+    phrase_index = build_term_index(df_text, text_col=term_text_col,
+                                    ngrams=(2, 3))
+    del df_text
+
+# figures returned by the callbacks, reused until the data files change
+figure_cache = FigureCache(
+    maxsize=get_project_global_variables()["figure_cache_size"],
+    version=data_version([content_path(df_path_clean), df_path_daily_cube,
+                          word_index_path, phrase_index_path,
+                          search_index_path, sentiment_stats_path])
+)
+
+# latency of every callback, served on /metrics
+callback_metrics = CallbackMetrics()
+
+
+def date_key(*args):
+    """
+    Cache key for callback arguments. The date picker sends dates with or
+    without a time, both map to the same figure.
+    """
+    return tuple(arg[:10] if isinstance(arg, str)
+                 and re.match(r"\d{4}-\d{2}-\d{2}", arg) else arg
+                 for arg in args)
+
+
+def search_key(*args):
+    """
+    Cache key for callbacks whose last argument is the search box query,
+    which is not shortened like a date
+    """
+    return date_key(*args[:-1]) + (search_query(args[-1]),)
+
+
+def zoom_ranges(relayout):
+    """
+    Axis ranges of a zoomed in graph from its relayoutData, None for an axis
+    that shows its whole range.
+    """
+    relayout = relayout or {}
+    ranges = []
+    for axis in ['xaxis', 'yaxis']:
+        if f"{axis}.range[0]" in relayout:
+            ranges.append((float(relayout[f"{axis}.range[0]"]),
+                           float(relayout[f"{axis}.range[1]"])))
+        elif f"{axis}.range" in relayout:
+            ranges.append(tuple(float(i) for i in relayout[f"{axis}.range"]))
+        else:
+            ranges.append(None)
+    return tuple(ranges)
+
+
+def zoom_key(x_range, y_range):
+    """Cache key for a zoomed in view, ranges rounded so pans can be reused"""
+    return tuple(None if r is None else tuple(round(i, 3) for i in r)
+                 for r in (x_range, y_range))
+
+
+def zoom_search_key(x_range, y_range, *args):
+    """Cache key for a zoomed in view of the tweets matching a query"""
+    return zoom_key(x_range, y_range) + search_key(*args)
 
 ###########################################
 # APP LAYOUT
@@ -40,24 +253,24 @@ colors = {"dark_green": "#3a4f41",
           "alice_blue": "#F0F8FF"
           }
 
-colour_dict = {'JustinTrudeau': '#D91A20',
-               'AndrewScheer': '#1A4E89',
-               'ElizabethMay': '#42A03A',
-               "theJagmeetSingh": '#F29F24',
-               'MaximeBernier': '#A9A9A9'}
-
-leaders_dropdown = [
-    {'label': 'All', 'value': 'All'},
-    {'label': 'JustinTrudeau', 'value': 'JustinTrudeau'},
-    {'label': 'AndrewScheer', 'value': 'AndrewScheer'},
-    {'label': 'ElizabethMay', 'value': 'ElizabethMay'},
-    {'label': 'theJagmeetSingh', 'value': 'theJagmeetSingh'},
-    {'label': 'MaximeBernier', 'value': 'MaximeBernier'}
+leaders_dropdown = [{'label': 'All', 'value': 'All'}] + \
+    [{'label': handle, 'value': handle} for handle in users]
+
+browser_columns = [
+    {'name': 'Date', 'id': 'date_time'},
+    {'name': 'Handle', 'id': 'handle'},
+    {'name': 'Tweet', 'id': 'full_text'},
+    {'name': 'Polarity', 'id': 'polarity'},
+    {'name': 'Subjectivity', 'id': 'subjectivity'},
+    {'name': 'Likes', 'id': 'favorite_count'},
+    {'name': 'Retweets', 'id': 'retweet_count'}
 ]
 
 
 # APP LAYOUT
 app.layout = html.Div(style={'backgroundColor': colors['light_grey']}, children=[
+    # fires the callbacks that load the static figures on page load
+    dcc.Location(id='url'),
     # HEADER
     html.Div(className="row", style={'backgroundColor': colors['dark_red'], "padding": 10}, children=[
         html.H2('Canadian 2019 Election Twitter Sentiment Analysis',
@@ -83,27 +296,36 @@ app.layout = html.Div(style={'backgroundColor': colors['light_grey']}, children=
             html.Div(className="row", children=[
                 html.Br(),
                 dcc.DatePickerRange(id='selected-date-range',
-                                    start_date=min(df['date']),
-                                    min_date_allowed=min(df['date']),
-                                    end_date=max(df['date']),
-                                    max_date_allowed=max(df['date']))
+                                    start_date=min_date,
+                                    min_date_allowed=min_date,
+                                    end_date=max_date,
+                                    max_date_allowed=max_date),
+                html.Br(),
+                # narrows the counts, sentiment and word plots to the
+                # matching tweets, see twitter_search.SearchIndex
+                dcc.Input(id='search-query', type='text', debounce=True,
+                          placeholder='Search tweets, e.g. pharmacare '
+                                      '"child care" -tax OR daycare '
+                                      'from:theJagmeetSingh',
+                          style={'width': '60%'}),
+                html.Div(id='search-count')
             ]),                
             # ROW 2 - Sentiment Plot
             html.Div(className="row", children=[
                 html.Hr(),
                 html.H4("What is the sentiment of their tweets?"),
-                dcc.Markdown(open("docs/sentiment-explained.md").read()),
-                dcc.Graph(figure=twitter_plots.plot_tweets_sentiment(df))
+                dcc.Markdown(read_doc("sentiment-explained.md")),
+                dcc.Graph(id='sentiment-scatter')
             ]),
             # ROW 3 - Sentiment Distributions
             html.Div(className="row", children=[
                 # ROW 3, COLUMN 1
                 html.Div(className="one-half column", children=[
-                    dcc.Graph(figure=twitter_plots.plot_polarity_dist(df))
+                    dcc.Graph(id='polarity-dist')
                 ]),
                 # ROW 3, COLUMN 2
                 html.Div(className="one-half column", children=[
-                    dcc.Graph(figure=twitter_plots.plot_subjectivity_dist(df))
+                    dcc.Graph(id='subjectivity-dist')
                 ])
             ]),
             # ROW 4 - About eachother
@@ -116,14 +338,13 @@ app.layout = html.Div(style={'backgroundColor': colors['light_grey']}, children=
             html.Div(className="row", children=[
                 # ROW 6, COLUMN 1
                 html.Div(className="one-half column", children=[
-                    dcc.Markdown(open("docs/tweeting-about.md").read()),
+                    dcc.Markdown(read_doc("tweeting-about.md")),
                     html.Br()
                 ]),
                 # ROW 6, COLUMN 2
                 html.Div(className="one-half column", children=[
                     # Tweets about eachother
-                    dcc.Graph(
-                        figure=twitter_plots.plot_about_eachother_heatmap(df)),
+                    dcc.Graph(id='about-heatmap'),
                     html.Br()
                 ]),
             ]),
@@ -143,10 +364,38 @@ app.layout = html.Div(style={'backgroundColor': colors['light_grey']}, children=
                     html.Br()
          
             ]),
+            # ROW 7.5 - Tweet browser
+            html.Div(className="row", children=[
+                html.Hr(),
+                html.H4("Browse the tweets"),
+                dcc.Dropdown(id='browser-drop-down',
+                             options=leaders_dropdown, value="All"),
+                html.Br(),
+                html.Label("Polarity"),
+                dcc.RangeSlider(id='browser-polarity', min=-1, max=1,
+                                step=0.05, value=[-1, 1],
+                                marks={-1: '-1', 0: '0', 1: '1'}),
+                html.Label("Subjectivity"),
+                dcc.RangeSlider(id='browser-subjectivity', min=0, max=1,
+                                step=0.05, value=[0, 1],
+                                marks={0: '0', 0.5: '0.5', 1: '1'}),
+                html.Br(),
+                html.Div(id='tweet-browser-count'),
+                # pages are sorted and filtered by the browse_tweets callback
+                dash_table.DataTable(id='tweet-browser',
+                                     columns=browser_columns,
+                                     page_current=0, page_size=20,
+                                     page_action='custom',
+                                     sort_action='custom', sort_mode='single',
+                                     sort_by=[],
+                                     style_cell={'textAlign': 'left',
+                                                 'whiteSpace': 'normal',
+                                                 'height': 'auto'})
+            ]),
             # ROW 8 - About
             html.Div(className="row", children=[
                 html.Hr(),
-                dcc.Markdown(open("docs/intro.md").read())
+                dcc.Markdown(read_doc("intro.md"))
             ])
         ])
     ])
@@ -157,36 +406,188 @@ app.layout = html.Div(style={'backgroundColor': colors['light_grey']}, children=
 # APP CALL BACKS
 ###########################################
 
+# Figures that do not depend on any input, loaded when the page is first
+# opened
+def add_static_figure_callback(name):
+    @app.callback(Output(name, "figure"), [Input("url", "pathname")])
+    @callback_metrics.timed(name=f"load_{name}")
+    def load_static_figure(pathname):
+        return static_figure(name)
+
+
+add_static_figure_callback("about-heatmap")
+
+
+# Sentiment distributions, of the tweets matching the search box if any
+def add_sentiment_dist_callback(name):
+    @app.callback(
+        Output(name, "figure"), [
+            Input("url", "pathname"),
+            Input("selected-date-range", 'start_date'),
+            Input("selected-date-range", 'end_date'),
+            Input("search-query", "value")
+        ]
+    )
+    @callback_metrics.timed(name=f"load_{name}")
+    def load_sentiment_dist(pathname, start_date, end_date, query):
+        if search_query(query) is None:
+            return static_figure(name)
+        return plot_searched_dist(name, start_date, end_date, query)
+
+
+@figure_cache.memoize(key=search_key)
+def plot_searched_dist(name, start_date, end_date, query):
+    """Plots a sentiment distribution of the tweets matching a query"""
+    stats = build_sentiment_stats(searched_tweets(
+        search_query(query), *date_key(start_date, end_date)))
+    return plots().STATS_FIGURES[name](stats)
+
+
+for name in ["polarity-dist", "subjectivity-dist"]:
+    add_sentiment_dist_callback(name)
+
+
+# Number of tweets matching the search box
+@app.callback(
+    Output("search-count", "children"), [
+        Input("selected-date-range", 'start_date'),
+        Input("selected-date-range", 'end_date'),
+        Input("search-query", "value")
+    ]
+)
+@callback_metrics.timed
+def count_searched_tweets(start_date, end_date, query):
+    """
+    Describes how many tweets the plots are showing
+    """
+    query = search_query(query)
+    if query is None:
+        return ""
+    hits = search(query, *date_key(start_date, end_date))
+    total = sum(len(tweets) for tweets in hits.values())
+    return f"{total:,} tweets match the search between the selected dates"
+
+
+# Sentiment scatter, binned until zoomed in far enough to show each tweet
+@app.callback(
+    Output("sentiment-scatter", "figure"), [
+        Input("url", "pathname"),
+        Input("sentiment-scatter", "relayoutData"),
+        Input("selected-date-range", 'start_date'),
+        Input("selected-date-range", 'end_date'),
+        Input("search-query", "value")
+    ]
+)
+@callback_metrics.timed
+def plot_sentiment_scatter(pathname, relayout, start_date, end_date, query):
+    """
+    Plots sentiment vs. subjectivity, of every tweet or of the tweets
+    matching the search box between the selected dates
+    """
+    x_range, y_range = zoom_ranges(relayout)
+    if search_query(query) is not None:
+        return plot_searched_sentiment(x_range, y_range, start_date,
+                                       end_date, query)
+    if scatter_mode != "binned":
+        return static_figure("sentiment-scatter")
+    if x_range is None and y_range is None:
+        return static_figure("sentiment-binned")
+    return plot_sentiment_zoom(x_range, y_range)
+
+
+@figure_cache.memoize(key=zoom_search_key)
+def plot_searched_sentiment(x_range, y_range, start_date, end_date, query):
+    """
+    Plots the tweets matching a query, each tweet if there are few enough
+    in view, otherwise binned
+    """
+    df = searched_tweets(search_query(query),
+                        *date_key(start_date, end_date))
+    in_view = plots().tweets_in_view(
+        df.sort_values('subjectivity', kind='stable'), x_range, y_range)
+    if len(in_view) <= scatter_max_points:
+        return plots().plot_tweets_sentiment_points(in_view, x_range,
+                                                    y_range)
+    return plots().plot_tweets_sentiment_binned(in_view, x_range, y_range)
+
+
+@figure_cache.memoize(key=zoom_key)
+def plot_sentiment_zoom(x_range, y_range):
+    """
+    Plots a zoomed in view of the sentiment scatter, every tweet if there
+    are few enough in view, otherwise finer bins
+    """
+    in_view = plots().tweets_in_view(sentiment_points(), x_range, y_range)
+    if len(in_view) <= scatter_max_points:
+        return plots().plot_tweets_sentiment_points(
+            in_view, x_range, y_range, trendlines=sentiment_trendlines())
+    return plots().plot_tweets_sentiment_binned(
+        in_view, x_range, y_range, trendlines=sentiment_trendlines())
+
+
+def tweet_cube(start_date, end_date, query):
+    """
+    Tweets per day and handle between two dates, only of the tweets
+    matching the search box query if there is one
+    """
+    query = search_query(query)
+    if query is None:
+        return cube_range(daily_cube, start_date, end_date)
+    return build_daily_cube(searched_tweets(query, start_date, end_date))
+
+
+def search_top_terms(filter_selection, start_date, end_date, query, n,
+                     term_col):
+    """
+    The most used words or phrases between two dates, only in the tweets
+    matching the search box query if there is one. Searched tweets are
+    counted in their clean text.
+    """
+    query = search_query(query)
+    index = word_index if term_col == 'word' else phrase_index
+    if query is None:
+        return top_terms(index, start_date, end_date,
+                         handle=filter_selection, n=n, term_col=term_col)
+    return search_index().top_terms(
+        search(query, start_date, end_date), n=n,
+        ngrams=(1,) if term_col == 'word' else (2, 3),
+        handle=filter_selection, term_col=term_col)
+
+
 # Tweet bar count
 @app.callback(
     Output("tweets-bar-count", "figure"), [
         Input("selected-date-range", 'start_date'),
-        Input("selected-date-range", 'end_date')
+        Input("selected-date-range", 'end_date'),
+        Input("search-query", "value")
     ]
 )
-def plot_tweets_bar_count(start_date, end_date, df=df):
+@callback_metrics.timed
+@figure_cache.memoize(key=search_key)
+def plot_tweets_bar_count(start_date, end_date, query=None):
     """
     Plots a word count horizontal bar chart
     """
-    df = df[df['date'] >= pd.to_datetime(start_date)]
-    df = df[df['date'] <= pd.to_datetime(end_date)]
-    return twitter_plots.plot_tweets_total(df)
+    cube = tweet_cube(*date_key(start_date, end_date), query)
+    return plots().plot_tweets_total_counts(tweet_counts_by_handle(cube))
 
 
 # Number of tweets by week
 @app.callback(
     Output("tweets-by-week-line", "figure"), [
         Input("selected-date-range", 'start_date'),
-        Input("selected-date-range", 'end_date')
+        Input("selected-date-range", 'end_date'),
+        Input("search-query", "value")
     ]
 )
-def plot_tweets_by_week_line(start_date, end_date, df=df):
+@callback_metrics.timed
+@figure_cache.memoize(key=search_key)
+def plot_tweets_by_week_line(start_date, end_date, query=None):
     """
     Plots a word count horizontal bar chart
     """
-    df = df[df['date'] >= pd.to_datetime(start_date)]
-    df = df[df['date'] <= pd.to_datetime(end_date)]
-    return twitter_plots.plot_tweets_time(df)
+    cube = tweet_cube(*date_key(start_date, end_date), query)
+    return plots().plot_tweets_time_counts(tweet_counts_by_week(cube))
 
 
 # Word count bar chart
@@ -194,59 +595,117 @@ def plot_tweets_by_week_line(start_date, end_date, df=df):
     Output("word-count-bar", "figure"), [
         Input("word-count-drop-down", "value"),
         Input("selected-date-range", 'start_date'),
-        Input("selected-date-range", 'end_date')
+        Input("selected-date-range", 'end_date'),
+        Input("search-query", "value")
     ]
 )
-def plot_word_count_bar_stack(filter_selection, start_date, end_date, 
-                              df=df_word_count):
+@callback_metrics.timed
+@figure_cache.memoize(key=search_key)
+def plot_word_count_bar_stack(filter_selection, start_date, end_date,
+                              query=None):
     """
     Plots a word count horizontal bar chart
     """
-    # df = df[df['date'] >= pd.to_datetime(start_date)]
-    # df = df[df['date'] <= pd.to_datetime(end_date)]
-    if filter_selection != "All":
-        df = df[df["handle"] == filter_selection]
-        df = df.sort_values(by=['total_count'], ascending=False).reset_index(
-            drop=True).head(50)
-    else:
-        df = df.sort_values(by=['total_count'],
-                            ascending=False).reset_index(drop=True)
-        df = df[df['rank'] <= 50]
-
-    fig = px.bar(df, y='word', x='count', orientation="h", color="handle",
-                 title="Tweet Word Count", height=800, 
-                 color_discrete_map=colour_dict)
-    fig.update_layout({"showlegend": False})
-    fig.update_layout(margin=dict(l=0, r=0, t=30, b=30), autosize=True)
-    fig.update_yaxes(categoryorder="total ascending", title_text="")
-    return(fig)
+    df = search_top_terms(filter_selection, *date_key(start_date, end_date),
+                          query, n=50, term_col='word')
+    return plots().plot_term_count_bar(df, 'word', "Tweet Word Count")
 
 
 # Phrase count bar chart
 @app.callback(
-    Output("phrase-count-bar", "figure"),
-    [Input("phrase-count-drop-down", "value")]
+    Output("phrase-count-bar", "figure"), [
+        Input("phrase-count-drop-down", "value"),
+        Input("selected-date-range", 'start_date'),
+        Input("selected-date-range", 'end_date'),
+        Input("search-query", "value")
+    ]
 )
-def plot_phrase_count_bar_stack(filter_selection):
+@callback_metrics.timed
+@figure_cache.memoize(key=search_key)
+def plot_phrase_count_bar_stack(filter_selection, start_date, end_date,
+                                query=None):
     """
     Plots a phrase count horizontal bar chart
     """
-    df = df_phrase_count
-    if filter_selection != "All":
-        df = df[df["handle"] == filter_selection]
-        df = df.sort_values(by=['total_count'], ascending=False).reset_index(
-            drop=True).head(50)
+    df = search_top_terms(filter_selection, *date_key(start_date, end_date),
+                          query, n=50, term_col='phrase')
+    return plots().plot_term_count_bar(df, 'phrase', "Tweet Phrase Count")
+
+
+# Tweet browser, one page at a time
+@app.callback(
+    [Output("tweet-browser", "data"),
+     Output("tweet-browser-count", "children")], [
+        Input("tweet-browser", "page_current"),
+        Input("tweet-browser", "page_size"),
+        Input("tweet-browser", "sort_by"),
+        Input("browser-drop-down", "value"),
+        Input("selected-date-range", 'start_date'),
+        Input("selected-date-range", 'end_date'),
+        Input("browser-polarity", "value"),
+        Input("browser-subjectivity", "value")
+    ]
+)
+@callback_metrics.timed
+def browse_tweets(page_current, page_size, sort_by, handle, start_date,
+                  end_date, polarity, subjectivity):
+    """
+    Returns the page of tweets the table shows
+    """
+    # with partitioned tweets only the partitions of the handle and dates
+    # are read, a flat file is read once for every handle and date
+    if partitioned:
+        browser = tweet_browser(handle, *date_key(start_date, end_date))
     else:
-        df = df.sort_values(by=['total_count'],
-                            ascending=False).reset_index(drop=True)
-        df = df[df['rank'] <= 50]
-
-    fig = px.bar(df, y='phrase', x='count', orientation="h", color="handle",
-                 title="Tweet Phrase Count", height=800, color_discrete_map=colour_dict)
-    fig.update_layout({"showlegend": False})
-    fig.update_layout(autosize=True, margin=dict(l=0, r=0, t=30, b=30))
-    fig.update_yaxes(categoryorder="total ascending", title_text="")
-    return(fig)
+        browser = tweet_browser()
+    records, page, total = browser.page(
+        page_current, page_size, sort_by, handle, start_date, end_date,
+        polarity, subjectivity)
+    pages = max(-(-total // page_size), 1)
+    return records, f"{total:,} tweets, page {page + 1} of {pages}"
+
+
+@server.route("/metrics")
+def metrics():
+    """Callback latency histograms in the Prometheus text format"""
+    cache = figure_cache.stats()
+    text = callback_metrics.to_prometheus(extra={
+        "figure_cache_hits": cache["hits"],
+        "figure_cache_misses": cache["misses"],
+        "figure_cache_size": cache["size"],
+        "app_startup_seconds": round(startup_seconds, 4)
+    })
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+@server.route("/figure-cache")
+def figure_cache_stats():
+    """Hit rate and size of the figure cache"""
+    return jsonify(figure_cache.stats())
+
+
+# build the figures for the default view ahead of the first visit
+if get_project_global_variables()["figure_cache_warm"]:
+    # the default dates and nothing searched
+    default_view = (str(min_date.date()), str(max_date.date()), None)
+    dropdown_values = [i['value'] for i in leaders_dropdown]
+    figure_cache.warm_in_background([
+        (plot_tweets_bar_count, [default_view]),
+        (plot_tweets_by_week_line, [default_view]),
+        (plot_word_count_bar_stack,
+         [(value,) + default_view for value in dropdown_values]),
+        (plot_phrase_count_bar_stack,
+         [(value,) + default_view for value in dropdown_values])
+    ])
+
+
+# how long importing this module took, i.e. the cost of booting a worker
+startup_seconds = time.perf_counter() - _startup
+startup_budget = get_project_global_variables()["startup_budget_seconds"]
+print(f"app ready in {startup_seconds:.2f}s")
+if startup_seconds > startup_budget:
+    print(f"warning: start up took longer than the "
+          f"{startup_budget:.2f}s budget")
 
 
 if __name__ == '__main__':
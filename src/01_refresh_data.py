@@ -1,21 +1,45 @@
 import pandas as pd
 
-from twitter_data import tweets_get
+from twitter_data import get_latest_ids, merge_tweets
+from twitter_scheduler import fetch_timelines
+from twitter_storage import read_table, table_exists, write_table
 from helpers import print_break, get_project_global_variables
+from instrumentation import RunReport
 
 print_break("Refreshing Twitter Data")
 
 start_date = get_project_global_variables()["start_date"]
 users = get_project_global_variables()["twitter_handles"]
 df_path_raw = get_project_global_variables()["df_path_raw"]
+incremental = get_project_global_variables()["refresh_incremental"]
+ingest_workers = get_project_global_variables()["ingest_workers"]
+export_csv = get_project_global_variables()["export_csv"]
+report = RunReport("01_refresh_data",
+                   get_project_global_variables()["run_reports_dir"],
+                   profile=get_project_global_variables()["profile_stages"],
+                   profile_dir=get_project_global_variables()["profile_dir"])
 
-df = pd.DataFrame()
-for user in users:
-    df_temp = tweets_get(
-        user_name=user, num=200, start_date=start_date
-    )
-    df_temp['handle'] = user
-    df = pd.concat([df, df_temp], sort=False)
+# in incremental mode only tweets newer than the stored ones are fetched
+df_stored = pd.DataFrame()
+if incremental and table_exists(df_path_raw):
+    with report.stage("load"):
+        df_stored = read_table(df_path_raw)
+    print(f"Loaded {df_stored.shape[0]} stored tweets")
+latest_ids = get_latest_ids(df_stored)
+last_seen = {}
+if not df_stored.empty:
+    last_seen = df_stored.groupby('handle')['date'].max().to_dict()
+
+# page all handles concurrently with one client, stalest handles first
+print(f"Getting tweets for {len(users)} handles...")
+with report.stage("fetch"):
+    df = fetch_timelines(users, start_date=start_date, since_ids=latest_ids,
+                         last_seen=last_seen, num=200,
+                         max_workers=ingest_workers)
+with report.stage("merge"):
+    print(f"\nFetched {df.shape[0]} new tweets")
+    if not df_stored.empty:
+        df = merge_tweets(df_stored, df)
 
 print("\nSummary of tweets:")
 print(f" - total number of tweets: {df.shape[0]}")
@@ -24,4 +48,10 @@ print(f" - end date: {max(df['date'])}")
 print("\n Tweet count by user:")
 print(df['handle'].value_counts())
 
-df.to_csv(df_path_raw, index=False)
+with report.stage("write"):
+    # a partitioned table only rewrites the handles and weeks that changed
+    stats = write_table(df, df_path_raw, export_csv=export_csv)
+if stats is not None:
+    print(f"\nPartitions written: {stats['written']}, unchanged: "
+          f"{stats['unchanged']}, removed: {stats['removed']}")
+report.save()
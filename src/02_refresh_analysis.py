@@ -1,42 +1,432 @@
+import argparse
+import functools
+import os
+
 import pandas as pd
 
 from helpers import get_project_global_variables, print_break
-from twitter_analysis import (count_tweets_about, get_phrase_counts_df,
-                              get_sentiment, get_word_counts_df, tweets_break,
-                              tweets_clean_text)
-
-start_date = get_project_global_variables()["start_date"]
-users = get_project_global_variables()["twitter_handles"]
-df_path_raw = get_project_global_variables()["df_path_raw"]
-df_path_clean = get_project_global_variables()["df_path_clean"]
-df_path_word_count = get_project_global_variables()["df_path_word_count"]
-df_path_phrase_count = get_project_global_variables()["df_path_phrase_count"]
-df = pd.read_csv(df_path_raw)
-
-print_break("Refreshing model")
-
-# clean tweet text
-print(" - cleaning tweets...")
-df['clean_tweet'] = df['full_text'].apply(tweets_clean_text)
-df['break_tweet'] = df['full_text'].apply(tweets_break)
-
-# add sentiment and polarity
-print(" - calculating sentiment and polarity...")
-raw_sentiment = get_sentiment(df['full_text'])
-clean_sentiment = get_sentiment(df['clean_tweet'])
-df['polarity'] = clean_sentiment['polarity']
-df['subjectivity'] = clean_sentiment['subjectivity']
-
-# creating count data
-print(" - calculating count data...")
-df = count_tweets_about(df, "full_text")
-df_phrase_count = get_phrase_counts_df(df=df, selected_col='clean_tweet',
-                                       users=users)
-df_word_count = get_word_counts_df(df=df, selected_col='clean_tweet',
-                                   users=users)
-
-# export clean data
-print(" - writing to disk...")
-df.to_csv(df_path_clean, index=False)
-df_word_count.to_csv(df_path_word_count, index=False)
-df_phrase_count.to_csv(df_path_phrase_count, index=False)
+from instrumentation import RunReport
+from pipeline import Pipeline, Stage, file_fingerprint
+from twitter_analysis import (TermCounter, count_tweets_about, lemmatize_batch,
+                              stop_words, tweets_break,
+                              tweets_clean_text_batch)
+from twitter_cube import build_daily_cube, cube_to_table, merge_daily_cubes
+from twitter_cache import PIPELINE_VERSION, TweetCache, get_clean_sentiment
+from twitter_plots import (STATIC_FIGURES, STATS_FIGURES, bin_sentiment,
+                           merge_sentiment_bins, plot_about_eachother_heatmap,
+                           plot_sentiment_bins, save_figures,
+                           save_static_figures)
+from twitter_search import SearchIndexBuilder, save_search_index
+from twitter_stats import (build_sentiment_stats, finalize_sentiment_stats,
+                           merge_sentiment_moments, save_sentiment_stats,
+                           sentiment_moments)
+from twitter_storage import (PartitionedTable, TableWriter, content_path,
+                             csv_path, iter_table, partition_order,
+                             read_table, table_format, table_schema,
+                             write_table)
+from twitter_term_index import TermIndexBuilder, save_term_index
+from twitter_tokens import TokenStore, letter_runs
+
+
+def add_tweet_columns(df, cache, config):
+    '''
+    Runs the per tweet stages: clean text, sentiment, lemmas (if
+    config["lemmatize"]), the text shown on hover and which leaders each
+    tweet mentions.
+
+    Returns
+    -------
+    tuple
+        df with the new columns, and a TokenStore of the text the words and
+        phrases are counted in (config["term_text_col"])
+    '''
+    # reuses the results for tweets that have not changed since the last run
+    clean_sentiment = get_clean_sentiment(df['full_text'], cache,
+                                          n_jobs=config["n_jobs"],
+                                          chunk_size=config["chunk_size"],
+                                          engine=config["sentiment_engine"])
+    df['clean_tweet'] = clean_sentiment['clean_tweet']
+    if config["lemmatize"]:
+        df['lemma_tweet'] = lemmatize_batch(df['clean_tweet'])
+    df['polarity'] = clean_sentiment['polarity']
+    df['subjectivity'] = clean_sentiment['subjectivity']
+    df['break_tweet'] = df['full_text'].apply(tweets_break)
+
+    # every tweet is split into tokens once, the stages below and the
+    # counts share them
+    raw_tokens = TokenStore.from_texts(df['full_text'], tokenize=letter_runs)
+    df = count_tweets_about(df, "full_text",
+                            keywords=config["mention_keywords"],
+                            tokens=raw_tokens)
+    return df, TokenStore.from_texts(df[config["term_text_col"]])
+
+
+def about_counts(df):
+    '''
+    Number of tweets about each leader per handle. Also adds up the counts
+    of several chunks when given a list of them.
+    '''
+    if isinstance(df, list):
+        df = pd.concat(df)
+    columns = [col for col in df.columns if col.startswith("about_")]
+    return df.groupby('handle', as_index=False)[columns].sum()
+
+
+def _combine(total, part, merge):
+    '''Adds the accumulator of one chunk to the running total'''
+    return part if total is None else merge([total, part])
+
+
+def table_outputs(path, export_csv):
+    '''Files write_table writes for a path'''
+    if table_format(path) == "partitioned":
+        # the flat csv export is named after the table, not the manifest
+        return [PartitionedTable(path).manifest_path] + \
+            ([csv_path(path)] if export_csv else [])
+    if table_format(path) == "csv":
+        return [path]
+    return [path, csv_path(path)] if export_csv else [path]
+
+
+def print_partition_stats(stats):
+    if stats is not None:
+        print(f"   partitions written: {stats['written']}, unchanged: "
+              f"{stats['unchanged']}, removed: {stats['removed']}")
+
+
+def stage_load(path, partitioned):
+    # the rows of the indexes are positions in the clean data, which a
+    # partitioned table reads back in partition order
+    df = read_table(path)
+    return partition_order(df) if partitioned else df
+
+
+def stage_clean_data(path, export_csv, df):
+    print_partition_stats(write_table(df, path, export_csv=export_csv))
+
+
+def stage_clean(df):
+    return tweets_clean_text_batch(df['full_text'])
+
+
+def stage_sentiment(config, df, clean):
+    # reuses the scores of tweets that have not changed since the last run,
+    # the cache is opened here as stages run in worker threads
+    cache = TweetCache(config["cache_path"],
+                       max_entries=config["cache_max_entries"])
+    scores = get_clean_sentiment(df['full_text'], cache,
+                                 n_jobs=config["n_jobs"],
+                                 chunk_size=config["chunk_size"],
+                                 engine=config["sentiment_engine"],
+                                 clean=clean)
+    stats = cache.stats()
+    cache.close()
+    print(f"   cache hits: {stats['hits']}, misses: {stats['misses']}, "
+          f"hit rate: {stats['hit_rate']:.1%}")
+    return scores[['polarity', 'subjectivity']]
+
+
+def stage_lemma(lemmatize, clean):
+    return lemmatize_batch(clean) if lemmatize else None
+
+
+def stage_break(df):
+    return df['full_text'].apply(tweets_break)
+
+
+def stage_mentions(keywords, df):
+    raw_tokens = TokenStore.from_texts(df['full_text'], tokenize=letter_runs)
+    return count_tweets_about(pd.DataFrame(index=df.index), "full_text",
+                              keywords=keywords, tokens=raw_tokens)
+
+
+def stage_tweets(df, clean, sentiment, lemma, broken, about):
+    df = df.copy()
+    df['clean_tweet'] = clean
+    if lemma is not None:
+        df['lemma_tweet'] = lemma
+    df['polarity'] = sentiment['polarity']
+    df['subjectivity'] = sentiment['subjectivity']
+    df['break_tweet'] = broken
+    for col in about.columns:
+        df[col] = about[col]
+    return df
+
+
+def stage_term_counts(users, ngrams, path, export_csv, tokens, df):
+    counter = TermCounter().update_tokens(tokens, df['handle'], ngrams=ngrams)
+    if ngrams == (1,):
+        counts = counter.word_counts_df(users=users)
+    else:
+        counts = counter.phrase_counts_df(users=users)
+    write_table(counts, path, export_csv=export_csv)
+
+
+def stage_term_index(text_col, ngrams, path, tokens, df):
+    index = TermIndexBuilder(text_col, ngrams).add_tokens(df, tokens).build()
+    save_term_index(index, path)
+
+
+def stage_search_index(path, tokens, df):
+    index = SearchIndexBuilder(stop_words()).add_tokens(
+        tokens, df['handle'], df['date']).build()
+    save_search_index(index, path)
+
+
+def stage_daily_cube(path, export_csv, df):
+    write_table(cube_to_table(build_daily_cube(df)), path,
+                export_csv=export_csv)
+
+
+def stage_stats_file(path, stats):
+    save_sentiment_stats(stats, path)
+
+
+def stage_figures(directory, df, stats):
+    save_static_figures(df, directory, stats)
+
+
+def build_pipeline(config):
+    '''
+    The refresh as a graph of stages: the per tweet columns (clean text,
+    sentiment, lemmas, hover text and mentions) are artifacts the outputs
+    are built from. See pipeline.Pipeline for when a stage reruns.
+    '''
+    raw_path = config["df_path_raw"]
+    partitioned = table_format(config["df_path_clean"]) == "partitioned"
+    export_csv = config["export_csv"]
+    users = config["twitter_handles"]
+    text_col = config["term_text_col"]
+    text_stage = "lemma" if config["lemmatize"] else "clean"
+    # the search index is always over the clean text
+    search_tokens = "clean_tokens" if config["lemmatize"] else "tokens"
+    figures = list(STATIC_FIGURES) + list(STATS_FIGURES)
+
+    stages = [
+        Stage("load", functools.partial(stage_load, raw_path, partitioned),
+              params={"raw": file_fingerprint(content_path(raw_path)),
+                      "partitioned": partitioned}, persist=False),
+        # the tweet cache version covers the cleaning and scoring helpers
+        Stage("clean", stage_clean, ["load"], version=PIPELINE_VERSION),
+        Stage("sentiment", functools.partial(stage_sentiment, config),
+              ["load", "clean"], version=PIPELINE_VERSION,
+              params={"engine": config["sentiment_engine"]}),
+        Stage("lemma", functools.partial(stage_lemma, config["lemmatize"]),
+              ["clean"], params={"lemmatize": config["lemmatize"]}),
+        Stage("break", stage_break, ["load"]),
+        Stage("mentions",
+              functools.partial(stage_mentions, config["mention_keywords"]),
+              ["load"], params={"keywords": config["mention_keywords"]}),
+        Stage("tokens", TokenStore.from_texts, [text_stage], persist=False),
+        Stage("clean_tokens", TokenStore.from_texts, ["clean"],
+              persist=False),
+        Stage("tweets", stage_tweets,
+              ["load", "clean", "sentiment", "lemma", "break", "mentions"],
+              persist=False),
+        Stage("sentiment_stats", build_sentiment_stats, ["tweets"]),
+
+        # outputs
+        Stage("clean_data",
+              functools.partial(stage_clean_data, config["df_path_clean"],
+                                export_csv),
+              ["tweets"],
+              outputs=table_outputs(config["df_path_clean"], export_csv)),
+        Stage("word_counts",
+              functools.partial(stage_term_counts, users, (1,),
+                                config["df_path_word_count"], export_csv),
+              ["tokens", "load"], params={"users": users},
+              outputs=table_outputs(config["df_path_word_count"],
+                                    export_csv)),
+        Stage("phrase_counts",
+              functools.partial(stage_term_counts, users, (2, 3),
+                                config["df_path_phrase_count"], export_csv),
+              ["tokens", "load"], params={"users": users},
+              outputs=table_outputs(config["df_path_phrase_count"],
+                                    export_csv)),
+        Stage("daily_cube",
+              functools.partial(stage_daily_cube,
+                                config["df_path_daily_cube"], export_csv),
+              ["tweets"],
+              outputs=table_outputs(config["df_path_daily_cube"],
+                                    export_csv)),
+        Stage("word_index",
+              functools.partial(stage_term_index, text_col, (1,),
+                                config["word_index_path"]),
+              ["tokens", "load"], outputs=[config["word_index_path"]]),
+        Stage("phrase_index",
+              functools.partial(stage_term_index, text_col, (2, 3),
+                                config["phrase_index_path"]),
+              ["tokens", "load"], outputs=[config["phrase_index_path"]]),
+        Stage("search_index",
+              functools.partial(stage_search_index,
+                                config["search_index_path"]),
+              [search_tokens, "load"], outputs=[config["search_index_path"]]),
+        Stage("sentiment_stats_file",
+              functools.partial(stage_stats_file,
+                                config["sentiment_stats_path"]),
+              ["sentiment_stats"],
+              outputs=[config["sentiment_stats_path"]]),
+        # the figures that do not depend on dashboard inputs
+        Stage("figures",
+              functools.partial(stage_figures, config["figures_dir"]),
+              ["tweets", "sentiment_stats"],
+              outputs=[os.path.join(config["figures_dir"], f"{name}.json")
+                       for name in figures])
+    ]
+    return Pipeline(stages, config["pipeline_dir"],
+                    max_workers=config["pipeline_workers"])
+
+
+def refresh_streaming(config, cache, report, chunk_rows):
+    '''
+    Runs the per tweet stages on chunks of chunk_rows tweets, appending each
+    chunk to the clean data file and adding it to accumulators for the
+    counts, cube, term and search indexes, sentiment statistics and figures.
+    Memory depends on the chunk size and the vocabulary, not the number of
+    tweets, apart from the search index which keeps the clean text as term
+    ids.
+    '''
+    counter = TermCounter()
+    daily_cube = None
+    text_col = config["term_text_col"]
+    word_index = TermIndexBuilder(text_col, ngrams=(1,))
+    phrase_index = TermIndexBuilder(text_col, ngrams=(2, 3))
+    search_index = SearchIndexBuilder(stop_words())
+    moments = {}
+    about = None
+    binned = None
+    # the rows of the search index are positions in the clean data, a
+    # partitioned table is read in partition order so the chunks must be too
+    raw_path = config["df_path_raw"]
+    if table_format(config["df_path_clean"]) == "partitioned" and not (
+            table_format(raw_path) == "partitioned"
+            and PartitionedTable(raw_path).exists()):
+        raise ValueError(f"streaming into a partitioned table needs the raw "
+                         f"tweets in {raw_path}, run 01_refresh_data.py "
+                         f"with the same DATA_LAYOUT first")
+
+    # the raw columns keep the types of the whole raw table, not of the
+    # first chunk, where e.g. media may have no values yet
+    schema = None
+    if table_format(config["df_path_clean"]) in ("parquet", "feather"):
+        schema = table_schema(raw_path, chunk_rows)
+
+    print(f" - processing tweets in chunks of {chunk_rows}...")
+    with report.stage("stream"), \
+            TableWriter(config["df_path_clean"],
+                        export_csv=config["export_csv"],
+                        schema=schema) as writer:
+        for chunk in iter_table(raw_path, chunk_rows):
+            chunk, tokens = add_tweet_columns(chunk, cache, config)
+            writer.write(chunk)
+
+            counter.update_tokens(tokens, chunk['handle'])
+            daily_cube = _combine(daily_cube, build_daily_cube(chunk),
+                                  merge_daily_cubes)
+            word_index.add_tokens(chunk, tokens)
+            phrase_index.add_tokens(chunk, tokens)
+            if text_col == 'clean_tweet':
+                search_index.add_tokens(tokens, chunk['handle'],
+                                        chunk['date'])
+            else:
+                search_index.add(chunk)
+            moments = merge_sentiment_moments(moments,
+                                              sentiment_moments(chunk))
+            about = _combine(about, about_counts(chunk), about_counts)
+            binned = _combine(binned, bin_sentiment(chunk),
+                              merge_sentiment_bins)
+            print(f"   {writer.rows} tweets")
+    print_partition_stats(writer.stats)
+
+    with report.stage("aggregates"):
+        users = config["twitter_handles"]
+        df_word_count = counter.word_counts_df(users=users)
+        df_phrase_count = counter.phrase_counts_df(users=users)
+        sentiment_stats = finalize_sentiment_stats(moments)
+
+    print(" - writing to disk...")
+    with report.stage("write"):
+        write_summaries(config, df_word_count, df_phrase_count, daily_cube,
+                        word_index.build(), phrase_index.build(),
+                        search_index.build(), sentiment_stats)
+
+    # the per tweet scatter needs every tweet at once, the app builds it
+    # from the clean data when it is first shown
+    print(" - building static figures...")
+    with report.stage("figures"):
+        stale = os.path.join(config["figures_dir"], "sentiment-scatter.json")
+        if os.path.exists(stale):
+            os.remove(stale)
+        figures = [
+            ("sentiment-binned", plot_sentiment_bins(
+                binned, sentiment_stats['trendlines'])),
+            ("about-heatmap", plot_about_eachother_heatmap(about))
+        ]
+        figures += [(name, plot(sentiment_stats))
+                    for name, plot in STATS_FIGURES.items()]
+        save_figures(figures, config["figures_dir"])
+
+
+def write_summaries(config, df_word_count, df_phrase_count, daily_cube,
+                    word_index, phrase_index, search_index, sentiment_stats):
+    '''Writes the outputs derived from the clean tweets'''
+    export_csv = config["export_csv"]
+    write_table(df_word_count, config["df_path_word_count"],
+                export_csv=export_csv)
+    write_table(df_phrase_count, config["df_path_phrase_count"],
+                export_csv=export_csv)
+    write_table(cube_to_table(daily_cube), config["df_path_daily_cube"],
+                export_csv=export_csv)
+    save_term_index(word_index, config["word_index_path"])
+    save_term_index(phrase_index, config["phrase_index_path"])
+    save_search_index(search_index, config["search_index_path"])
+    save_sentiment_stats(sentiment_stats, config["sentiment_stats_path"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Refreshes the analysis of the raw tweets, rerunning "
+                    "only the stages whose inputs or code changed.")
+    parser.add_argument("stages", nargs="*",
+                        help="stages to bring up to date, by default every "
+                             "stage that writes an output")
+    parser.add_argument("--force", action="store_true",
+                        help="rerun the stages even if they are fresh")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list the stages that would run")
+    args = parser.parse_args(argv)
+
+    config = get_project_global_variables()
+    report = RunReport("02_refresh_analysis", config["run_reports_dir"],
+                       profile=config["profile_stages"],
+                       profile_dir=config["profile_dir"])
+
+    print_break("Refreshing model")
+
+    if config["stream_chunk_rows"]:
+        cache = TweetCache(config["cache_path"],
+                           max_entries=config["cache_max_entries"])
+        refresh_streaming(config, cache, report, config["stream_chunk_rows"])
+        stats = cache.stats()
+        cache.close()
+        print(f"   cache hits: {stats['hits']}, misses: {stats['misses']}, "
+              f"hit rate: {stats['hit_rate']:.1%}")
+        # the outputs no longer match the artifacts of the stage graph
+        build_pipeline(config).reset()
+    else:
+        pipeline = build_pipeline(config)
+        targets = args.stages or None
+        if args.dry_run:
+            stale = pipeline.plan(targets, force=args.force)
+            print(f" - stages to run: {', '.join(stale) or 'none'}")
+            return
+        ran = pipeline.run(targets, force=args.force, report=report)
+        print(f" - ran {len(ran)} of {len(pipeline.stages)} stages, the "
+              f"others were up to date or not needed")
+
+    report.save()
+
+
+# guard so worker processes used for sentiment scoring can import this file
+if __name__ == "__main__":
+    main()
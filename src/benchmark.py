@@ -0,0 +1,324 @@
+"""
+Benchmarks the analysis pipeline on synthetic tweets.
+
+Generates tweets shaped like twitter-data-raw.csv at several sizes, runs
+each stage of the pipeline on them and reports the time and peak memory
+of every stage. Results are compared with a saved baseline and stages
+that got slower or use more memory are flagged. Runs offline.
+
+    python src/benchmark.py                      # 10k, 100k and 1M tweets
+    python src/benchmark.py --sizes 10000        # a quick run
+    python src/benchmark.py --save-baseline      # record a new baseline
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from helpers import get_project_global_variables
+from twitter_analysis import (count_tweets_about, get_phrase_counts_df,
+                              get_sentiment, get_word_counts_df,
+                              tweets_clean_text_batch)
+from twitter_data import fix_dates
+from twitter_search import build_search_index
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+BASELINE_PATH = "data/benchmark-baseline.json"
+RESULTS_PATH = "data/benchmark-results.json"
+
+# a stage is flagged when it is this many times slower (or larger) than the
+# baseline and the difference is above the noise floor
+TOLERANCE = 1.25
+TIME_NOISE_SECONDS = 0.05
+MEMORY_NOISE_BYTES = 1024 ** 2
+
+# common words, including words TextBlob scores, the leaders' names so the
+# mention search finds something and contractions the cleaner splits
+COMMON_WORDS = """
+the to and of a in for we is our that on it with be this will are you i
+have at all canada canadians people government new more today their by
+from not they who need can families time country make work help plan
+jobs climate change vote election party leader liberal conservative ndp
+green campaign support better great good proud strong bad worst hard
+clear real important best together future child care tax taxes cuts
+economy health pharmacare housing energy pipeline carbon veterans
+seniors young workers communities every year years day week back first
+thank thanks happy wonderful terrible wrong right fair honest corrupt
+justin trudeau andrew scheer elizabeth may jagmeet singh maxime bernier
+we're can't don't it's you're they're won't gonna cannot wanna
+""".split()
+
+HASHTAGS = ["#cdnpoli", "#elxn43", "#climatechange", "#canada", "#debate"]
+
+
+def make_vocabulary(n_words, seed=0):
+    """
+    Returns COMMON_WORDS followed by made up words, so larger corpora have
+    the long tail of rare words real tweets have.
+    """
+    rng = np.random.RandomState(seed)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    made_up = set()
+    while len(made_up) < n_words:
+        made_up.add("".join(rng.choice(letters, rng.randint(3, 11))))
+    return COMMON_WORDS + sorted(made_up - set(COMMON_WORDS))
+
+
+def make_synthetic_tweets(n, seed=0, start_date=datetime.date(2019, 9, 11),
+                          end_date=datetime.date(2020, 3, 31)):
+    """
+    Generates n tweets with the columns of twitter-data-raw.csv, before
+    fix_dates. Words are drawn from a Zipf distribution over
+    make_vocabulary, with urls, hashtags, mentions and "&amp;" mixed in.
+
+    Parameters
+    ----------
+    n : int
+        Number of tweets
+    seed : int
+        Random seed, the same seed gives the same tweets
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    rng = np.random.RandomState(seed)
+    users = get_project_global_variables()["twitter_handles"]
+    vocabulary = np.array(make_vocabulary(20000, seed))
+
+    # zipf ranks past the vocabulary are folded back into it
+    lengths = rng.randint(5, 46, n)
+    ranks = (rng.zipf(1.3, lengths.sum()) - 1) % len(vocabulary)
+    words = vocabulary[ranks]
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    extras = rng.random_sample((n, 4))
+    texts = []
+    for i in range(n):
+        text = " ".join(words[bounds[i]:bounds[i + 1]])
+        if extras[i, 0] < 0.3:
+            text += " &amp; " + HASHTAGS[i % len(HASHTAGS)]
+        if extras[i, 1] < 0.2:
+            text = f"@{users[i % len(users)]} " + text
+        if extras[i, 2] < 0.5:
+            text += f" https://t.co/{i:010x}"
+        texts.append(text.capitalize())
+
+    start = pd.Timestamp(start_date).value // 10 ** 9
+    end = pd.Timestamp(end_date).value // 10 ** 9
+    created = pd.to_datetime(np.sort(rng.randint(start, end, n))[::-1],
+                             unit='s')
+    ids = 1170000000000000000 + np.arange(n)[::-1] * 1000
+    handles = np.array(users)[rng.randint(0, len(users), n)]
+    empty = ["[]"] * n
+    return pd.DataFrame({
+        'created_at': created.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+        'favorite_count': rng.randint(0, 5000, n),
+        'full_text': texts,
+        'hashtags': empty,
+        'id': ids,
+        'id_str': ids,
+        'lang': 'en',
+        'quoted_status': None,
+        'quoted_status_id': np.nan,
+        'quoted_status_id_str': np.nan,
+        'retweet_count': rng.randint(0, 1000, n).astype(float),
+        'source': '<a href="https://mobile.twitter.com">Twitter Web App</a>',
+        'urls': empty,
+        'user': None,
+        'user_mentions': empty,
+        'media': None,
+        'handle': handles,
+        'favorited': extras[:, 3] < 0.01
+    })
+
+
+def stage_fix_dates(df, n_jobs):
+    return fix_dates(df)
+
+
+def stage_clean_text(df, n_jobs):
+    df['clean_tweet'] = tweets_clean_text_batch(df['full_text'])
+    return df
+
+
+def stage_sentiment(df, n_jobs):
+    sentiment = get_sentiment(df['clean_tweet'], n_jobs=n_jobs)
+    df['polarity'] = sentiment['polarity']
+    df['subjectivity'] = sentiment['subjectivity']
+    return df
+
+
+def stage_sentiment_lexicon(df, n_jobs):
+    get_sentiment(df['clean_tweet'], engine="lexicon")
+    return df
+
+
+def stage_count_tweets_about(df, n_jobs):
+    keywords = get_project_global_variables()["mention_keywords"]
+    return count_tweets_about(df, "full_text", keywords=keywords)
+
+
+def stage_word_counts(df, n_jobs):
+    users = get_project_global_variables()["twitter_handles"]
+    get_word_counts_df(df, 'clean_tweet', users)
+    return df
+
+
+def stage_phrase_counts(df, n_jobs):
+    users = get_project_global_variables()["twitter_handles"]
+    get_phrase_counts_df(df, 'clean_tweet', users)
+    return df
+
+
+def stage_search_index(df, n_jobs):
+    build_search_index(df)
+    return df
+
+
+# in pipeline order, each stage gets the output of the one before
+STAGES = [("fix_dates", stage_fix_dates),
+          ("clean_text", stage_clean_text),
+          ("sentiment", stage_sentiment),
+          ("sentiment_lexicon", stage_sentiment_lexicon),
+          ("count_tweets_about", stage_count_tweets_about),
+          ("word_counts", stage_word_counts),
+          ("phrase_counts", stage_phrase_counts),
+          ("search_index", stage_search_index)]
+
+
+def run_stages(df, n_jobs, memory):
+    """
+    Runs every stage on df, returning stage -> seconds, or stage -> peak
+    bytes allocated by the stage when memory is True (traced separately as
+    tracing slows the stage down).
+    """
+    out = {}
+    for name, stage in STAGES:
+        if memory:
+            tracemalloc.start()
+            df = stage(df, n_jobs)
+            out[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            df = stage(df, n_jobs)
+            out[name] = time.perf_counter() - start
+    return out
+
+
+def run_benchmark(sizes, n_jobs=1, memory=True, seed=0):
+    """
+    Benchmarks every stage at each size.
+
+    Returns
+    -------
+    dict
+        str(size) -> stage -> {"seconds": float, "peak_bytes": int}
+    """
+    results = {}
+    for size in sizes:
+        print(f" - {size} tweets: generating...")
+        df = make_synthetic_tweets(size, seed)
+        print(f" - {size} tweets: timing stages...")
+        seconds = run_stages(df.copy(), n_jobs, memory=False)
+        peaks = {}
+        if memory:
+            print(f" - {size} tweets: measuring memory...")
+            peaks = run_stages(df.copy(), n_jobs, memory=True)
+        results[str(size)] = {
+            name: {"seconds": round(seconds[name], 4),
+                   "peak_bytes": peaks.get(name)}
+            for name, _ in STAGES
+        }
+    return results
+
+
+def find_regressions(results, baseline, tolerance=TOLERANCE):
+    """
+    Compares results with a baseline of the same shape, returning a list of
+    messages for stages that are slower or use more memory.
+    """
+    regressions = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            for metric, noise in [("seconds", TIME_NOISE_SECONDS),
+                                  ("peak_bytes", MEMORY_NOISE_BYTES)]:
+                new, old = result.get(metric), before.get(metric)
+                if new is None or old is None:
+                    continue
+                if new > old * tolerance and new - old > noise:
+                    regressions.append(
+                        f"{name} at {size} tweets: {metric} {old:,} -> "
+                        f"{new:,} ({new / max(old, 1e-9):.2f}x)")
+    return regressions
+
+
+def print_results(results):
+    for size, stages in results.items():
+        print(f"\n{size} tweets")
+        print(f"{'stage':<20} {'seconds':>10} {'peak MB':>10}")
+        for name, result in stages.items():
+            peak = result["peak_bytes"]
+            peak = "" if peak is None else f"{peak / 1024 ** 2:.1f}"
+            print(f"{name:<20} {result['seconds']:>10.3f} {peak:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--n-jobs", type=int, default=1,
+                        help="processes used for sentiment scoring")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory pass")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.sizes, n_jobs=args.n_jobs,
+                            memory=not args.no_memory)
+    print_results(results)
+    report = {"created": datetime.datetime.now().isoformat(),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "n_jobs": args.n_jobs,
+              "results": results}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nsaved baseline to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline at {args.baseline}, run with --save-baseline")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = find_regressions(results, baseline["results"],
+                                   args.tolerance)
+    if regressions:
+        print("\nREGRESSIONS")
+        for message in regressions:
+            print(f" - {message}")
+        return 1
+    print("\nno regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
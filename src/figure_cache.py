@@ -0,0 +1,115 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def data_version(paths):
+    '''
+    Returns a short fingerprint of data files based on their size and
+    modification time, so cached figures are not reused after a refresh.
+    '''
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            h.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()[:12]
+
+
+class FigureCache:
+    '''
+    Bounded least recently used cache of figures returned by Dash callbacks,
+    keyed on (callback, arguments, data version).
+
+    Parameters
+    ----------
+    maxsize : int
+        Number of figures kept, the least recently used is evicted first
+    version : str
+        Data version mixed into every key, see data_version
+    '''
+
+    def __init__(self, maxsize=256, version=""):
+        self.maxsize = maxsize
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def memoize(self, func=None, key=None):
+        '''
+        Decorator caching a callback's figures.
+
+        Parameters
+        ----------
+        func : callable
+            The callback
+        key : callable
+            Optional function mapping the callback arguments to the tuple
+            used in the cache key, e.g. to normalise dates
+        '''
+        if func is None:
+            return functools.partial(self.memoize, key=key)
+
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            cache_key = (name, key(*args) if key else args, self.version)
+            with self._lock:
+                if cache_key in self._figures:
+                    self._figures.move_to_end(cache_key)
+                    self.hits += 1
+                    return self._figures[cache_key]
+                self.misses += 1
+            figure = func(*args)
+            with self._lock:
+                self._figures[cache_key] = figure
+                while len(self._figures) > self.maxsize:
+                    self._figures.popitem(last=False)
+                    self.evictions += 1
+            return figure
+
+        wrapper.uncached = func
+        return wrapper
+
+    def warm(self, func, arg_lists):
+        '''Calls a memoized callback for each list of arguments'''
+        for args in arg_lists:
+            func(*args)
+
+    def warm_in_background(self, jobs):
+        '''
+        Warms the cache in a daemon thread so it does not hold up start up.
+
+        Parameters
+        ----------
+        jobs : list of (callable, list of argument tuples)
+        '''
+        def run():
+            for func, arg_lists in jobs:
+                self.warm(func, arg_lists)
+        thread = threading.Thread(target=run, name="figure-cache-warm",
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+
+    def stats(self):
+        '''Returns size and hit rate statistics'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._figures),
+                    "maxsize": self.maxsize,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "version": self.version}
@@ -1,4 +1,5 @@
 import datetime
+import os
 
 
 def print_break(text):
@@ -9,20 +10,105 @@ def print_break(text):
     print("#" * 64)
 
 
+def read_handles(path):
+    """Twitter handles listed in a file, one per line, # starts a comment"""
+    with open(path) as file:
+        lines = [line.split("#")[0].strip() for line in file]
+    return [line for line in lines if line]
+
+
 def get_project_global_variables():
     """
     Returns a list of 'global variables' that are referenced in multiple
     different places. Purpose is to reduce the risk of typing in the wrong
     thing.
     """
+    # "csv", "parquet" or "feather", set DATA_FORMAT to switch
+    data_format = os.environ.get("DATA_FORMAT", "csv")
+    # count lemmas ("tax" for "taxes") instead of words, set LEMMATIZE=1
+    lemmatize = os.environ.get("LEMMATIZE", "0") == "1"
+    # "flat" keeps each table in one file, "partitioned" splits the raw and
+    # clean tweets into one file per handle and week, set DATA_LAYOUT
+    data_layout = os.environ.get("DATA_LAYOUT", "flat")
+    tweets_ext = data_format + (".parts" if data_layout == "partitioned"
+                                else "")
+    twitter_handles = ["JustinTrudeau", "AndrewScheer", "ElizabethMay",
+                       "theJagmeetSingh", "MaximeBernier"]
+    # a file with one handle per line replaces the election leaders, set
+    # TWITTER_HANDLES_FILE
+    if os.environ.get("TWITTER_HANDLES_FILE"):
+        twitter_handles = read_handles(os.environ["TWITTER_HANDLES_FILE"])
     out = {
-        "twitter_handles": ["JustinTrudeau", "AndrewScheer",
-                            "ElizabethMay", "theJagmeetSingh", 
-                            "MaximeBernier"],
+        "twitter_handles": twitter_handles,
         "start_date": datetime.date(2019, 9, 11),  # elct started on 2019-09-11
-        "df_path_raw": "data/twitter-data-raw.csv",
-        "df_path_clean": "data/twitter-data-clean.csv",
-        "df_path_word_count": "data/word-count.csv",
-        "df_path_phrase_count": "data/phrase-count.csv"
+        # keywords that count as a tweet being about each candidate, one
+        # about_<candidate> column is created per key
+        "mention_keywords": {
+            "trudeau": ["justin", "trudeau", "justintrudeau"],
+            "scheer": ["scheer", "andrew", "andrewscheer"],
+            "may": ["may", "elizabeth", "elizabethmay"],
+            "singh": ["singh", "jagmeet", "jagmeetsingh", "thejagmeetsingh"],
+            "bernier": ["bernier", "maxime", "maximebernier"]
+        },
+        "data_format": data_format,
+        "data_layout": data_layout,
+        "df_path_raw": f"data/twitter-data-raw.{tweets_ext}",
+        "df_path_clean": f"data/twitter-data-clean.{tweets_ext}",
+        "df_path_word_count": f"data/word-count.{data_format}",
+        "df_path_phrase_count": f"data/phrase-count.{data_format}",
+        "df_path_daily_cube": f"data/daily-cube.{data_format}",
+        # word and phrase counts per day and handle
+        "word_index_path": "data/word-index.npz",
+        "phrase_index_path": "data/phrase-index.npz",
+        # clean tweets by term, sharded by handle, for the search box
+        "search_index_path": "data/search-index.npz",
+        # distributions and trendlines of the sentiment scores
+        "sentiment_stats_path": "data/sentiment-stats.json",
+        # prebuilt figures loaded by the app
+        "figures_dir": "data/figures",
+        # also write csv copies when using a columnar format
+        "export_csv": os.environ.get("EXPORT_CSV", "0") == "1",
+        # figures kept by the dashboard, and whether to build the default
+        # views in the background at start up (WARM_FIGURE_CACHE=1)
+        "figure_cache_size": 256,
+        "figure_cache_warm": os.environ.get("WARM_FIGURE_CACHE", "0") == "1",
+        # seconds app.py may take to import before a warning is printed
+        "startup_budget_seconds": float(
+            os.environ.get("STARTUP_BUDGET_SECONDS", "2.0")),
+        # "binned" draws the sentiment scatter as per cell counts and only
+        # sends individual tweets once zoomed in, "points" draws every tweet
+        "sentiment_scatter_mode": os.environ.get("SENTIMENT_SCATTER_MODE",
+                                                 "binned"),
+        # most tweets drawn individually when the binned scatter is zoomed in
+        "sentiment_scatter_max_points": 2000,
+        # JSON reports of each refresh run, and the refresh stages to run
+        # under cProfile, e.g. PROFILE_STAGES=counts,figures (or "all")
+        "run_reports_dir": "data/run-reports",
+        "profile_stages": [i for i in os.environ.get(
+            "PROFILE_STAGES", "").split(",") if i],
+        "profile_dir": "data/profiles",
+        # only fetch tweets newer than the ones already in df_path_raw
+        "refresh_incremental": True,
+        # handles paged at the same time when fetching tweets
+        "ingest_workers": 4,
+        # the words and phrases are counted in this column
+        "lemmatize": lemmatize,
+        "term_text_col": "lemma_tweet" if lemmatize else "clean_tweet",
+        # process the raw tweets in chunks of this many rows so memory does
+        # not grow with the number of tweets, 0 to load them all at once
+        "stream_chunk_rows": int(os.environ.get("STREAM_CHUNK_ROWS", "0")),
+        # "textblob" scores one tweet at a time, "lexicon" scores all tweets
+        # at once with the same lexicon and rules
+        "sentiment_engine": os.environ.get("SENTIMENT_ENGINE", "textblob"),
+        # worker processes and tweets per chunk for sentiment scoring
+        "n_jobs": os.cpu_count() or 1,
+        "chunk_size": 500,
+        # artifacts of the refresh stages and their fingerprints, and how
+        # many stages run at the same time
+        "pipeline_dir": "data/pipeline",
+        "pipeline_workers": 4,
+        # cache of clean text and sentiment for tweets seen in earlier runs
+        "cache_path": "data/tweet-cache.sqlite",
+        "cache_max_entries": 200000
     }
     return out
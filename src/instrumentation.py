@@ -0,0 +1,238 @@
+import bisect
+import contextlib
+import cProfile
+import datetime
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# upper bounds in seconds of the callback latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0]
+
+
+def peak_rss_bytes(children=False):
+    '''
+    Peak resident set size of this process, or of its finished child
+    processes (e.g. the sentiment workers), None where it is not available.
+    '''
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunReport:
+    '''
+    Times the stages of a refresh script and records the peak memory after
+    each, then writes them to a JSON report.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run, used for the report file name
+    directory : str
+        Where reports are written
+    profile : list of str
+        Stages to run under cProfile, or ["all"]. By default, None.
+    profile_dir : str
+        Where profiles are written as {name}-{stage}.prof
+    '''
+
+    def __init__(self, name, directory, profile=None, profile_dir=None):
+        self.name = name
+        self.directory = directory
+        self.profile = set(profile or [])
+        self.profile_dir = profile_dir or directory
+        self.started = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self.stages = []
+        # the stages of a Pipeline run in worker threads, so the records and
+        # prints of stages finishing at the same time are serialized
+        self._lock = threading.Lock()
+        # stages running, and stages started so far, to tell whether a stage
+        # ran alone
+        self._running = 0
+        self._started_count = 0
+
+    def _profiled(self, stage):
+        return stage in self.profile or "all" in self.profile
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        '''Context manager timing one stage'''
+        profiler = cProfile.Profile() if self._profiled(stage) else None
+        with self._lock:
+            alone = self._running == 0
+            self._running += 1
+            self._started_count += 1
+            started_count = self._started_count
+        rss_before = peak_rss_bytes()
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            rss_after = peak_rss_bytes()
+            with self._lock:
+                self._running -= 1
+                # the peak RSS is the whole process's, so its growth is only
+                # the stage's own if no other stage ran at the same time
+                alone = alone and self._started_count == started_count
+                self.stages.append({
+                    "stage": stage,
+                    "seconds": round(seconds, 4),
+                    "peak_rss_bytes": rss_after,
+                    "peak_rss_growth_bytes": None
+                    if rss_after is None or not alone
+                    else rss_after - rss_before
+                })
+                print(f"   {stage}: {seconds:.2f}s", flush=True)
+                if profiler:
+                    self._save_profile(profiler, stage)
+
+    def _save_profile(self, profiler, stage):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{self.name}-{stage}.prof")
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(
+            "cumulative").print_stats(15)
+        print(out.getvalue())
+        print(f"   profile saved to {path}")
+
+    def to_dict(self):
+        return {"run": self.name,
+                "started": self.started.isoformat(),
+                "seconds": round(time.perf_counter() - self._start, 4),
+                "peak_rss_bytes": peak_rss_bytes(),
+                "children_peak_rss_bytes": peak_rss_bytes(children=True),
+                "stages": self.stages}
+
+    def save(self):
+        '''Writes the report to {directory}/{name}-{start time}.json'''
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = self.started.strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(self.directory, f"{self.name}-{stamp}.json")
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+        print(f"run report saved to {path}")
+        return path
+
+
+class LatencyHistogram:
+    '''Counts of observed latencies in cumulative buckets'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        '''(upper bound, count of observations <= bound), ending with +Inf'''
+        out = []
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+class CallbackMetrics:
+    '''
+    Latency histograms of the Dash callbacks, one per callback.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, error=False):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram(self.buckets)
+                self.errors[name] = 0
+            self.histograms[name].observe(seconds)
+            self.errors[name] += error
+
+    def timed(self, func=None, name=None):
+        '''
+        Decorator recording the latency of every call of a callback.
+
+        Parameters
+        ----------
+        func : callable
+            The callback
+        name : str
+            Name in the metrics. By default, None (the function name).
+        '''
+        if func is None:
+            return functools.partial(self.timed, name=name)
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                out = func(*args, **kwargs)
+                error = False
+                return out
+            finally:
+                self.observe(label, time.perf_counter() - start, error)
+
+        return wrapper
+
+    def to_prometheus(self, extra=None):
+        '''
+        The histograms in the Prometheus text format.
+
+        Parameters
+        ----------
+        extra : dict
+            Other gauges to include, metric name -> number
+        '''
+        lines = ["# HELP dash_callback_seconds Latency of Dash callbacks",
+                 "# TYPE dash_callback_seconds histogram"]
+        with self._lock:
+            for name, hist in sorted(self.histograms.items()):
+                for bound, count in hist.cumulative():
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f'dash_callback_seconds_bucket'
+                                 f'{{callback="{name}",le="{le}"}} {count}')
+                lines.append(f'dash_callback_seconds_sum'
+                             f'{{callback="{name}"}} {hist.sum:.6f}')
+                lines.append(f'dash_callback_seconds_count'
+                             f'{{callback="{name}"}} {hist.count}')
+            lines.append("# TYPE dash_callback_errors_total counter")
+            for name, errors in sorted(self.errors.items()):
+                lines.append(f'dash_callback_errors_total'
+                             f'{{callback="{name}"}} {errors}')
+        for metric, value in (extra or {}).items():
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
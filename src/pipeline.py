@@ -0,0 +1,324 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def file_fingerprint(path, block_size=2 ** 20):
+    '''Hash of a file's content, None if it does not exist'''
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _code_of(func):
+    '''Source of a stage function (or of the function a partial wraps)'''
+    func = getattr(func, "func", func)
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return func.__qualname__
+
+
+def _names_in(code):
+    '''Global names a code object (and the functions nested in it) uses'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _names_in(const)
+    return names
+
+
+def _module_of(value):
+    if inspect.ismodule(value):
+        return value
+    name = getattr(value, "__module__", None)
+    return sys.modules.get(name) if isinstance(name, str) else None
+
+
+def module_files(func):
+    '''
+    Source files of the modules a stage function uses that sit next to it
+    (the project's modules, not libraries), and of the project modules
+    those use in turn. The script the function is defined in is left out,
+    its own source is hashed separately.
+
+    Returns
+    -------
+    list of str
+        Absolute paths, sorted
+    '''
+    func = getattr(func, "func", func)
+    # e.g. a classmethod such as TokenStore.from_texts
+    func = getattr(func, "__func__", func)
+    try:
+        directory = os.path.dirname(os.path.abspath(inspect.getfile(func)))
+    except TypeError:
+        return []
+    pending = [_module_of(func)]
+    scope = getattr(func, "__globals__", {})
+    if hasattr(func, "__code__"):
+        pending += [_module_of(scope[name]) for name in
+                    _names_in(func.__code__) if name in scope]
+
+    found = set()
+    while pending:
+        module = pending.pop()
+        path = getattr(module, "__file__", None)
+        if path is None or module.__name__ == "__main__":
+            continue
+        path = os.path.abspath(path)
+        if os.path.dirname(path) != directory or path in found:
+            continue
+        found.add(path)
+        pending += [_module_of(value) for value in vars(module).values()]
+    return sorted(found)
+
+
+class Stage:
+    '''
+    One step of a Pipeline.
+
+    Parameters
+    ----------
+    name : str
+    func : callable
+        Called with the artifact of each input, in order, returns the
+        stage's artifact
+    inputs : list of str
+        Names of the stages whose artifacts func takes. By default, none.
+    params : dict
+        Settings the output depends on (JSON serialisable), part of the
+        fingerprint, e.g. the hash of a source file or a config value
+    version : str
+        Bump to rerun the stage when its output changes for a reason its
+        code and modules do not show, e.g. a new version of a library
+    outputs : list of str
+        Files func writes. The stage is fresh while they exist and its
+        fingerprint is unchanged, and it has no artifact for other stages.
+    persist : bool
+        Pickle the artifact so later runs can reuse it. Cheap stages (e.g.
+        reading a file) set this to False and only run when a stage that
+        needs them does.
+    '''
+
+    def __init__(self, name, func, inputs=(), params=None, version="1",
+                 outputs=None, persist=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.version = version
+        self.outputs = list(outputs or [])
+        self.persist = persist
+
+
+class Pipeline:
+    '''
+    Runs a graph of stages, skipping the stages whose artifacts are still
+    fresh.
+
+    Each stage has a fingerprint, a hash of its code, the content of the
+    project modules it uses (see module_files), its version, params and
+    the fingerprints of its inputs, so a change anywhere upstream changes
+    it. The fingerprint of every stage that ran is kept in a state file. A
+    stage reruns only when its fingerprint differs from the saved one or
+    its artifact is missing, and a stage only runs when a target needs it.
+    Stages whose inputs are ready run at the same time in a thread pool.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Each stage after the stages it takes as inputs
+    directory : str
+        Where artifacts are pickled and the state file is kept
+    max_workers : int
+        Stages run at the same time
+    '''
+
+    def __init__(self, stages, directory, max_workers=4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.directory = directory
+        self.max_workers = max_workers
+        self.state_path = os.path.join(directory, "state.json")
+        self._lock = threading.Lock()
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(f"stage {stage.name} takes {name}, "
+                                     f"which is not declared before it")
+
+    def _artifact_path(self, name):
+        return os.path.join(self.directory, f"{name}.pkl")
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as file:
+            return json.load(file)
+
+    def _save_state(self, state):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(state, file, indent=2, sort_keys=True)
+        os.replace(tmp, self.state_path)
+
+    def reset(self):
+        '''
+        Forgets every fingerprint, e.g. after the outputs were written some
+        other way, so the next run rebuilds them
+        '''
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def fingerprints(self):
+        '''stage -> fingerprint'''
+        out = {}
+        files = {}
+        for name, stage in self.stages.items():
+            modules = {}
+            for path in module_files(stage.func):
+                if path not in files:
+                    files[path] = file_fingerprint(path)
+                modules[os.path.basename(path)] = files[path]
+            digest = hashlib.sha1(json.dumps({
+                "stage": name,
+                "version": stage.version,
+                "code": _code_of(stage.func),
+                "modules": modules,
+                "params": stage.params,
+                "inputs": [out[i] for i in stage.inputs]
+            }, sort_keys=True, default=str).encode("utf-8"))
+            out[name] = digest.hexdigest()
+        return out
+
+    def _is_fresh(self, stage, fingerprint, state):
+        if not stage.outputs and not stage.persist:
+            return False
+        if state.get(stage.name) != fingerprint:
+            return False
+        if stage.outputs:
+            return all(os.path.exists(path) for path in stage.outputs)
+        return os.path.exists(self._artifact_path(stage.name))
+
+    def plan(self, targets=None, force=False):
+        '''
+        Stages that have to run to bring the targets up to date, in order.
+
+        Parameters
+        ----------
+        targets : list of str
+            By default, None (every stage that writes outputs)
+        force : bool
+            Rerun the targets and everything they need even if fresh
+        '''
+        if targets is None:
+            targets = [name for name, stage in self.stages.items()
+                       if stage.outputs]
+        fingerprints = self.fingerprints()
+        state = {} if force else self.load_state()
+
+        needed = set()
+
+        def need(name):
+            if name in needed:
+                return
+            needed.add(name)
+            for i in self.stages[name].inputs:
+                stage = self.stages[i]
+                # fresh persisted artifacts are loaded instead of rebuilt
+                if not self._is_fresh(stage, fingerprints[i], state):
+                    need(i)
+
+        for name in targets:
+            if name not in self.stages:
+                raise ValueError(f"unknown stage {name}")
+            if not self._is_fresh(self.stages[name], fingerprints[name],
+                                  state):
+                need(name)
+        return [name for name in self.stages if name in needed]
+
+    def run(self, targets=None, force=False, report=None):
+        '''
+        Runs the stages in plan(targets, force).
+
+        Parameters
+        ----------
+        report : RunReport
+            Times each stage. By default, None.
+
+        Returns
+        -------
+        list of str
+            The stages that ran
+        '''
+        to_run = self.plan(targets, force)
+        fingerprints = self.fingerprints()
+        state = self.load_state()
+        artifacts = {}
+        pending = list(to_run)
+        in_flight = {}
+
+        def inputs_ready(name):
+            return all(i in artifacts or i not in to_run
+                       for i in self.stages[name].inputs)
+
+        def artifact(name):
+            # fresh artifacts are read once, however many stages take them
+            if name not in artifacts:
+                artifacts[name] = self._load(name)
+            return artifacts[name]
+
+        def execute(name):
+            stage = self.stages[name]
+            args = [artifact(i) for i in stage.inputs]
+            if report is None:
+                out = stage.func(*args)
+            else:
+                with report.stage(name):
+                    out = stage.func(*args)
+            self._finish(name, out, fingerprints[name], state)
+            return out
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or in_flight:
+                for name in [n for n in pending if inputs_ready(n)]:
+                    pending.remove(name)
+                    in_flight[executor.submit(execute, name)] = name
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = in_flight.pop(future)
+                    # cancel what has not started and raise the error
+                    if future.exception() is not None:
+                        for other in in_flight:
+                            other.cancel()
+                        raise future.exception()
+                    artifacts[name] = future.result()
+        return to_run
+
+    def _load(self, name):
+        with open(self._artifact_path(name), "rb") as file:
+            return pickle.load(file)
+
+    def _finish(self, name, artifact, fingerprint, state):
+        '''Saves the artifact and records the stage as fresh'''
+        stage = self.stages[name]
+        if not stage.outputs and not stage.persist:
+            return
+        if not stage.outputs:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._artifact_path(name), "wb") as file:
+                pickle.dump(artifact, file, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            state[name] = fingerprint
+            self._save_state(state)
@@ -1,9 +1,40 @@
+import functools
+import heapq
+import multiprocessing
 import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import nltk
+import numpy as np
 import pandas as pd
 from textblob import TextBlob
 
+from helpers import get_project_global_variables
+from twitter_sentiment import lexicon_sentiment
+from twitter_tokens import letter_runs
+
+# compiled once and shared by the batch cleaner
+URL_PATTERN = re.compile(r"http\S+")
+NON_ALPHA_NUMERIC_PATTERN = re.compile(r"[^a-zA-Z0-9\s]")
+AMP_PATTERN = re.compile(r" amp ")
+
+# contractions the treebank tokenizer (used by TextBlob.words) still splits
+# once punctuation has been removed, e.g. "gonna" -> "gon na"
+TREEBANK_CONTRACTIONS = {"cannot": ["can", "not"],
+                         "gimme": ["gim", "me"],
+                         "gonna": ["gon", "na"],
+                         "gotta": ["got", "ta"],
+                         "lemme": ["lem", "me"],
+                         "wanna": ["wan", "na"]}
+
+# treebank tag prefix -> wordnet part of speech, anything else is a noun
+WORDNET_POS = {"J": 'a', "N": 'n', "V": 'v', "R": 'r'}
+
+# (word, part of speech) pairs whose lemma is remembered
+LEMMA_CACHE_SIZE = 100000
+
 
 def lemmatize_with_postag(sentence):
     '''
@@ -20,6 +51,53 @@ def lemmatize_with_postag(sentence):
     return " ".join(lemmatized_list)
 
 
+@functools.lru_cache(maxsize=None)
+def _tagger():
+    """The part of speech tagger TextBlob uses, loaded once"""
+    return nltk.tag.PerceptronTagger()
+
+
+@functools.lru_cache(maxsize=None)
+def _lemmatizer():
+    return nltk.stem.WordNetLemmatizer()
+
+
+@functools.lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemma(word, pos):
+    """Lemma of a word, pos is a wordnet part of speech (a, n, v or r)"""
+    return _lemmatizer().lemmatize(word, pos)
+
+
+def lemmatize_batch(tweets):
+    '''
+    Lemmatizes many clean tweets at once, e.g. "taxes" -> "tax". Produces
+    the same output as `lemmatize_with_postag` for clean text, but tags all
+    tweets with one tagger and looks up each (word, part of speech) pair in
+    a cache shared across calls, so the lemmatizer only runs once per pair.
+
+    Parameters
+    ----------
+    tweets : pd.Series or iterable of str
+        Clean tweets, words separated by spaces
+
+    Returns
+    -------
+    pd.Series or list
+        Lemmatized tweets, as a Series with the same index if a Series was
+        passed in, otherwise as a list
+    '''
+    sentences = [tweet.split() if isinstance(tweet, str) else []
+                 for tweet in tweets]
+    tagged = _tagger().tag_sents(sentences)
+    lemmas = [" ".join(lemma(word, WORDNET_POS.get(tag[:1], 'n'))
+                       for word, tag in sentence)
+              for sentence in tagged]
+
+    if isinstance(tweets, pd.Series):
+        return pd.Series(lemmas, index=tweets.index, name=tweets.name)
+    return lemmas
+
+
 def tweets_clean_text(tweet):
     '''
     Cleans the text of a tweet
@@ -57,6 +135,51 @@ def tweets_clean_text(tweet):
     return(tweet)
 
 
+def stop_words():
+    '''The words `tweets_clean_text_batch` removes from tweets'''
+    return set(nltk.corpus.stopwords.words('english'))
+
+
+def tweets_clean_text_batch(tweets):
+    '''
+    Cleans the text of many tweets at once. Produces the same output as
+    `tweets_clean_text` but loads the stop words once and tokenizes with
+    `str.split` instead of building two TextBlobs per tweet.
+
+    Parameters
+    ----------
+    tweets : pd.Series or iterable of str
+        The tweets to clean
+
+    Returns
+    -------
+    pd.Series or list
+        Clean tweets, as a Series with the same index if a Series was passed
+        in, otherwise as a list
+    '''
+    removed = stop_words()
+    contractions = TREEBANK_CONTRACTIONS
+    url_sub = URL_PATTERN.sub
+    non_alpha_numeric_sub = NON_ALPHA_NUMERIC_PATTERN.sub
+    amp_sub = AMP_PATTERN.sub
+
+    clean = []
+    for tweet in tweets:
+        tweet = non_alpha_numeric_sub("", url_sub("", tweet))
+        words = []
+        for word in tweet.lower().split():
+            for part in contractions.get(word, (word,)):
+                if part not in removed:
+                    words.append(part)
+        # quotes, dashes and runs of spaces handled by `tweets_clean_text`
+        # can no longer occur once non alpha/numeric characters are removed
+        clean.append(amp_sub("", " ".join(words)))
+
+    if isinstance(tweets, pd.Series):
+        return pd.Series(clean, index=tweets.index, name=tweets.name)
+    return clean
+
+
 def tweets_break(x):
     '''Loop through a tweet and insert <br> every 60 characters for better spacing'''
     it = 1
@@ -80,20 +203,191 @@ def tweets_break(x):
     return "".join(clean)
 
 
-def get_sentiment(tweets):
-    '''returns a dictionary with sentiment and polarity'''
+def _sentiment_chunk(tweets):
+    '''Scores a chunk of tweets, running the analyzer once per tweet'''
     polarity = []
     subjectivity = []
     for tweet in tweets:
-        tweet = TextBlob(tweet)
-        pol = tweet.sentiment.polarity
-        polarity.append(pol)
-        subj = tweet.sentiment.subjectivity
-        subjectivity.append(subj)
+        sentiment = TextBlob(tweet).sentiment
+        polarity.append(sentiment.polarity)
+        subjectivity.append(sentiment.subjectivity)
+    return polarity, subjectivity
+
+
+def _worker_context():
+    '''
+    How the sentiment workers are started. The refresh runs its stages in a
+    thread pool, and a process forked while other threads run can inherit
+    a lock one of them holds and hang, so the workers are started from a
+    fresh process (forkserver, or spawn where it is not available).
+    '''
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn")
+
+
+def get_sentiment(tweets, n_jobs=1, chunk_size=1000, engine="textblob"):
+    '''
+    Returns a dictionary with sentiment and polarity
+
+    Parameters
+    ----------
+    tweets : iterable of str
+        The tweets to score
+    n_jobs : int
+        Number of worker processes. With 1 (the default) the tweets are
+        scored in the current process.
+    chunk_size : int
+        Number of tweets sent to a worker at a time when n_jobs > 1
+    engine : str
+        "textblob" to run TextBlob on each tweet, or "lexicon" to score all
+        tweets at once with the compiled Pattern lexicon (see
+        twitter_sentiment), which gives the same scores for clean tweets.
+        n_jobs and chunk_size only apply to "textblob".
+
+    Returns
+    -------
+    dict
+        {'polarity': [...], 'subjectivity': [...]} in the same order as
+        `tweets`
+    '''
+    if engine == "lexicon":
+        return lexicon_sentiment(tweets)
+    if engine != "textblob":
+        raise ValueError(f"unknown sentiment engine {engine!r}")
+    tweets = list(tweets)
+    if n_jobs is None or n_jobs <= 1 or len(tweets) <= chunk_size:
+        polarity, subjectivity = _sentiment_chunk(tweets)
+        return {'polarity': polarity, 'subjectivity': subjectivity}
+
+    chunks = [tweets[i:i + chunk_size]
+              for i in range(0, len(tweets), chunk_size)]
+    polarity = []
+    subjectivity = []
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             mp_context=_worker_context()) as executor:
+        # map returns results in the order the chunks were submitted
+        for pol, subj in executor.map(_sentiment_chunk, chunks):
+            polarity += pol
+            subjectivity += subj
 
     return {'polarity': polarity, 'subjectivity': subjectivity}
 
 
+class TermCounter:
+    """
+    Counts words and phrases (2 and 3 word n-grams joined by "_") per handle
+    in a single pass over clean tweets. Counters from different chunks of
+    tweets can be combined with `merge`.
+    """
+
+    def __init__(self):
+        self.words = defaultdict(Counter)
+        self.phrases = defaultdict(Counter)
+
+    def update(self, tweets, handles):
+        """
+        Adds the terms of some tweets.
+
+        Parameters:
+        -----------
+        tweets -- (list) clean tweets, words separated by spaces
+        handles -- (list) the handle of each tweet
+        """
+        for tweet, handle in zip(tweets, handles):
+            if not isinstance(tweet, str):
+                continue
+            words = tweet.split()
+            self.words[handle].update(words)
+            phrases = self.phrases[handle]
+            phrases.update(a + "_" + b for a, b in zip(words, words[1:]))
+            phrases.update(a + "_" + b + "_" + c
+                           for a, b, c in zip(words, words[1:], words[2:]))
+        return self
+
+    def update_tokens(self, tokens, handles, ngrams=(1, 2, 3)):
+        """
+        Adds the terms of some tweets from their tokens. Each handle's
+        Counter is updated once per distinct term, with that term's total
+        count, instead of once per use.
+
+        Parameters:
+        -----------
+        tokens -- (TokenStore) clean tweets split into words
+        handles -- (list) the handle of each tweet
+        ngrams -- (tuple) 1 to count words, 2 and 3 to count phrases
+        """
+        codes, uniques = pd.factorize(pd.Series(handles))
+        for n in ngrams:
+            counters = self.words if n == 1 else self.phrases
+            counts = tokens.count(n, codes)
+            terms = tokens.ngram_terms(counts['key'], n)
+            # counts are sorted by group, each handle is one slice
+            groups = counts['group'].values
+            starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+            ends = np.r_[starts[1:], len(groups)]
+            values = counts['count'].tolist()
+            for start, end in zip(starts, ends):
+                counters[uniques[groups[start]]].update(
+                    dict(zip(terms[start:end], values[start:end])))
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another TermCounter to this one"""
+        for handle, counts in other.words.items():
+            self.words[handle].update(counts)
+        for handle, counts in other.phrases.items():
+            self.phrases[handle].update(counts)
+        return self
+
+    def word_counts_df(self, users=None, max_rows=5000):
+        """Top word counts, see `top_counts_df`"""
+        return top_counts_df(self.words, 'word', users, max_rows)
+
+    def phrase_counts_df(self, users=None, max_rows=5000):
+        """Top phrase counts, see `top_counts_df`"""
+        return top_counts_df(self.phrases, 'phrase', users, max_rows)
+
+
+def top_counts_df(counts_by_handle, term_col, users=None, max_rows=5000):
+    """
+    Builds the word-count/phrase-count table from per handle counts.
+
+    Parameters:
+    -----------
+    counts_by_handle -- (dict) handle -> Counter of terms
+    term_col -- (str) name of the term column, 'word' or 'phrase'
+    users -- (list) handles to include per handle rows for. By default all.
+    max_rows -- (int) number of rows to keep
+
+    Returns:
+    --------
+    DataFrame with term_col, count, handle, total_count and rank columns,
+    sorted by total_count, for the terms with the highest totals
+    """
+    totals = Counter()
+    for counts in counts_by_handle.values():
+        totals.update(counts)
+    if users is None:
+        users = list(counts_by_handle)
+
+    # every term has at least one row, so the top max_rows terms are enough
+    # to fill max_rows rows
+    top = heapq.nlargest(max_rows, totals.items(),
+                         key=lambda item: (item[1], item[0]))
+    rows = []
+    for rank, (term, total) in enumerate(top, start=1):
+        term_rows = [(term, counts_by_handle[user][term], user, total, rank)
+                     for user in users if counts_by_handle[user][term] > 0]
+        term_rows.sort(key=lambda row: row[1], reverse=True)
+        rows += term_rows
+        if len(rows) >= max_rows:
+            break
+
+    return pd.DataFrame(rows[:max_rows], columns=[
+        term_col, 'count', 'handle', 'total_count', 'rank'])
+
+
 def get_word_counts(tweets_df):
     """
     Calculates the word counts for a string
@@ -106,12 +400,8 @@ def get_word_counts(tweets_df):
     --------
     Dictionary with word count
     """
-    words = " ".join(list(tweets_df))
-    counts = TextBlob(words).word_counts
-    counts_df = pd.DataFrame.from_dict(dict(counts), orient="index")
-    counts_df = counts_df.sort_values(by=[0], ascending=False)
-    counts_df.reset_index(level=0, inplace=True)
-    counts_df.columns = ['word', 'count']
+    counts = TermCounter().update(tweets_df, repeat(None)).words[None]
+    counts_df = pd.DataFrame(counts.most_common(), columns=['word', 'count'])
     return counts_df
 
 
@@ -127,67 +417,20 @@ def get_phrase_counts(tweets_df):
     --------
     Dictionary with phrase count
     """
-    # get ngrams
-    words = " ".join(list(tweets_df))
-    ngram_2 = TextBlob(words).ngrams(n=2)
-    ngram_3 = TextBlob(words).ngrams(n=3)
-    ngrams = ngram_2 + ngram_3
-    # do word count on ngrams
-    phrases = []
-    for i in ngrams:
-        phrases.append("_".join(i))
-    phrases = " ".join(list(phrases))
-    counts = TextBlob(phrases).word_counts
-    # turn into dataframe
-    counts_df = pd.DataFrame.from_dict(dict(counts), orient="index")
-    counts_df = counts_df.sort_values(by=[0], ascending=False)
-    counts_df.reset_index(level=0, inplace=True)
-    counts_df.columns = ['phrase', 'count']
+    counts = TermCounter().update(tweets_df, repeat(None)).phrases[None]
+    counts_df = pd.DataFrame(counts.most_common(),
+                             columns=['phrase', 'count'])
     return counts_df
 
 
 def get_phrase_counts_df(df, selected_col, users):
-    df_phrase_count_total = get_phrase_counts(df[selected_col])
-    df_phrase_count_total.columns = ['phrase', 'total_count']
-    df_phrase_count_total['rank'] = df_phrase_count_total['total_count'].rank(
-        ascending=False, method="first")
-    df_phrase_count = pd.DataFrame()
-
-    for i in users:
-        temp = get_phrase_counts(
-            df[df['handle'] == i]['clean_tweet'])
-        temp['handle'] = i
-        df_phrase_count = pd.concat([temp, df_phrase_count])
-
-    df_phrase_count = pd.merge(df_phrase_count, df_phrase_count_total,
-                               how='left', on='phrase')
-    df_phrase_count = df_phrase_count.sort_values(
-        by=['total_count', 'phrase', 'count'], ascending=False
-    ).reset_index(drop=True)
-
-    return df_phrase_count.head(5000)
+    counter = TermCounter().update(df[selected_col], df['handle'])
+    return counter.phrase_counts_df(users=users)
 
 
 def get_word_counts_df(df, selected_col, users):
-    df_word_count_totals = get_word_counts(df[selected_col])
-    df_word_count_totals.columns = ['word', 'total_count']
-    df_word_count_totals['rank'] = df_word_count_totals['total_count'].rank(
-        ascending=False, method="first")
-    df_word_count = pd.DataFrame()
-
-    for i in users:
-        temp = get_word_counts(
-            df[df['handle'] == i]['clean_tweet'])
-        temp['handle'] = i
-        df_word_count = pd.concat([temp, df_word_count])
-
-    df_word_count = pd.merge(df_word_count, df_word_count_totals, how='left',
-                                on='word')
-    df_word_count = df_word_count.sort_values(
-        by=['total_count', 'word', 'count'], ascending=False
-    ).reset_index(drop=True)
-    
-    return df_word_count.head(5000)
+    counter = TermCounter().update(df[selected_col], df['handle'])
+    return counter.word_counts_df(users=users)
 
 
 def word_search(text, search_words):
@@ -210,22 +453,85 @@ def word_search(text, search_words):
     return False
 
 
-def count_tweets_about(df, col_to_search):
-    justin_search = ["justin", "trudeau", "justintrudeau"]
-    scheer_search = ["scheer", "andrew", "andrewscheer"]
-    may_search = ["may", "elizabeth", "ElizabethMay"]
-    singh_search = ["singh", "jagmeet", "jagmeetsingh", "theJagmeetSingh"]
-    bernier_search = ["bernier", "maxime", "MaximeBernier"]
-
-    df["about_trudeau"] = df[col_to_search].apply(
-        word_search, search_words=justin_search)
-    df["about_scheer"] = df[col_to_search].apply(
-        word_search, search_words=scheer_search)
-    df["about_may"] = df[col_to_search].apply(
-        word_search, search_words=may_search)
-    df["about_singh"] = df[col_to_search].apply(
-        word_search, search_words=singh_search)
-    df["about_bernier"] = df[col_to_search].apply(
-        word_search, search_words=bernier_search)
+def build_mention_matcher(keywords):
+    """
+    Compiles the keywords of every candidate into a single pattern.
+    Keywords are matched case insensitively and only as whole words, so
+    "may" matches "May's" and "#May2019" but not "maybe".
+
+    Parameters:
+    -----------
+    keywords -- (dict) candidate -> list of keywords
+
+    Returns:
+    --------
+    Tuple of the compiled pattern and a dict of keyword -> candidates
+    """
+    candidates_by_keyword = defaultdict(set)
+    for candidate, words in keywords.items():
+        for word in words:
+            candidates_by_keyword[word.lower()].add(candidate)
+    # longest first so the longest keyword wins when several could match
+    alternatives = sorted(candidates_by_keyword, key=len, reverse=True)
+    pattern = re.compile(
+        r"(?<![a-z])(" + "|".join(map(re.escape, alternatives)) + r")(?![a-z])",
+        re.IGNORECASE
+    )
+    return pattern, candidates_by_keyword
+
+
+def find_mentions(texts, keywords):
+    """
+    Finds the candidates each text mentions in one pass per text.
+
+    Parameters:
+    -----------
+    texts -- (list) the bodies of text to search
+    keywords -- (dict) candidate -> list of keywords
+
+    Returns:
+    --------
+    List with the set of candidates mentioned in each text
+    """
+    pattern, candidates_by_keyword = build_mention_matcher(keywords)
+    mentions = []
+    for text in texts:
+        found = set()
+        if isinstance(text, str):
+            for match in pattern.findall(text):
+                found |= candidates_by_keyword[match.lower()]
+        mentions.append(found)
+    return mentions
+
+
+def count_tweets_about(df, col_to_search, keywords=None, tokens=None):
+    """
+    Adds an about_<candidate> column per candidate, True if the tweet
+    mentions any of the candidate's keywords.
+
+    Parameters:
+    -----------
+    df -- (DataFrame) tweets
+    col_to_search -- (str) column with the text to search
+    keywords -- (dict) candidate -> list of keywords. By default the
+        mention_keywords from get_project_global_variables.
+    tokens -- (TokenStore) col_to_search already split with letter_runs,
+        used instead of searching the text again
+
+    Returns:
+    --------
+    df with the about_ columns added
+    """
+    if keywords is None:
+        keywords = get_project_global_variables()["mention_keywords"]
+    if tokens is not None:
+        for candidate, words in keywords.items():
+            df[f"about_{candidate}"] = tokens.contains(
+                [letter_runs(word) for word in words])
+        return df
+
+    mentions = find_mentions(df[col_to_search], keywords)
+    for candidate in keywords:
+        df[f"about_{candidate}"] = [candidate in i for i in mentions]
 
     return df
@@ -0,0 +1,145 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+# columns read from the clean tweets, the table shows all but date
+COLUMNS = ['date_time', 'date', 'handle', 'full_text', 'polarity',
+           'subjectivity', 'favorite_count', 'retweet_count']
+
+# columns the table can be sorted by
+SORTABLE = ['date_time', 'handle', 'polarity', 'subjectivity',
+            'favorite_count', 'retweet_count']
+
+# full range of the sentiment filters, a filter set to it filters nothing
+POLARITY_RANGE = (-1.0, 1.0)
+SUBJECTIVITY_RANGE = (0.0, 1.0)
+
+
+class TweetBrowser:
+    '''
+    Pages through tweets filtered by handle, date and sentiment and sorted
+    by any column in SORTABLE, for a dash_table.DataTable with custom
+    paging and sorting.
+
+    Tweets are kept as arrays in date order, so a date range is a slice
+    found with a binary search, and each sort order is an argsort computed
+    the first time it is used. The rows matching a filter and sort order
+    are kept for the next requests, so paging through them only reads the
+    rows on each page.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with the COLUMNS columns
+    cache_size : int
+        Filter and sort combinations whose rows are kept
+    '''
+
+    def __init__(self, df, cache_size=32):
+        df = df.sort_values(['date', 'date_time'], kind='stable')
+        self.values = {col: df[col].values for col in COLUMNS}
+        self.dates = df['date'].values.astype('datetime64[ns]')
+        self.handles, self.handle_codes = np.unique(df['handle'].values,
+                                                    return_inverse=True)
+        self._orders = {}
+        self._rows = functools.lru_cache(maxsize=cache_size)(self._select)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def order(self, col):
+        '''Row positions sorted by a column, ascending'''
+        if col not in self._orders:
+            if col == 'handle':
+                values = self.handle_codes
+            else:
+                values = self.values[col]
+            self._orders[col] = np.argsort(values, kind='stable')
+        return self._orders[col]
+
+    def _date_slice(self, start_date, end_date):
+        lo = 0 if start_date is None else np.searchsorted(
+            self.dates, np.datetime64(pd.Timestamp(start_date), 'ns'),
+            side='left')
+        hi = len(self) if end_date is None else np.searchsorted(
+            self.dates, np.datetime64(pd.Timestamp(end_date), 'ns'),
+            side='right')
+        return lo, hi
+
+    def _select(self, handle, start_date, end_date, polarity, subjectivity,
+                sort_col, descending):
+        '''Positions of the matching rows in sort order'''
+        lo, hi = self._date_slice(start_date, end_date)
+        mask = np.ones(hi - lo, dtype=bool)
+        if handle != "All":
+            code = np.searchsorted(self.handles, handle)
+            if code == len(self.handles) or self.handles[code] != handle:
+                return np.array([], dtype=int)
+            mask &= self.handle_codes[lo:hi] == code
+        for col, selected, full in [('polarity', polarity, POLARITY_RANGE),
+                                    ('subjectivity', subjectivity,
+                                     SUBJECTIVITY_RANGE)]:
+            if selected is not None and tuple(selected) != full:
+                values = self.values[col][lo:hi]
+                mask &= (values >= selected[0]) & (values <= selected[1])
+
+        if sort_col == 'date_time':
+            rows = np.flatnonzero(mask) + lo
+        else:
+            order = self.order(sort_col)
+            keep = np.zeros(len(self), dtype=bool)
+            keep[lo:hi] = mask
+            rows = order[keep[order]]
+        return rows[::-1] if descending else rows
+
+    def page(self, page_current=0, page_size=20, sort_by=None, handle="All",
+             start_date=None, end_date=None, polarity=None,
+             subjectivity=None):
+        '''
+        One page of the matching tweets.
+
+        Parameters
+        ----------
+        page_current : int
+            Page number from 0, past the last page gives the last page
+        page_size : int
+        sort_by : list of dict
+            DataTable sort_by, e.g. [{'column_id': 'polarity',
+            'direction': 'desc'}]. By default, None (newest first), which
+            is also used for columns not in SORTABLE.
+        handle : str
+            A handle or "All"
+        start_date, end_date : str or datetime
+            Date range, inclusive. By default, None (no limit).
+        polarity, subjectivity : list of float
+            [min, max] ranges, inclusive. By default, None (any).
+
+        Returns
+        -------
+        tuple
+            (records for DataTable.data, page number returned, number of
+            matching tweets)
+        '''
+        sort_col, descending = 'date_time', True
+        if sort_by and sort_by[0]['column_id'] in SORTABLE:
+            sort_col = sort_by[0]['column_id']
+            descending = sort_by[0]['direction'] == 'desc'
+        rows = self._rows(
+            handle, None if start_date is None else str(start_date)[:10],
+            None if end_date is None else str(end_date)[:10],
+            None if polarity is None else tuple(polarity),
+            None if subjectivity is None else tuple(subjectivity),
+            sort_col, descending)
+
+        last_page = max((len(rows) - 1) // page_size, 0)
+        page_current = min(page_current or 0, last_page)
+        idx = rows[page_current * page_size:(page_current + 1) * page_size]
+        page = pd.DataFrame({col: self.values[col][idx] for col in COLUMNS
+                             if col != 'date'})
+        page['date_time'] = pd.to_datetime(page['date_time']) \
+            .dt.strftime("%Y-%m-%d %H:%M")
+        page[['polarity', 'subjectivity']] = \
+            page[['polarity', 'subjectivity']].round(3)
+        page = page.astype(object).where(page.notnull(), None)
+        return page.to_dict('records'), page_current, len(rows)
@@ -0,0 +1,179 @@
+import hashlib
+import sqlite3
+import time
+
+import pandas as pd
+
+from twitter_analysis import get_sentiment, tweets_clean_text_batch
+
+# bump whenever tweets_clean_text_batch or get_sentiment change their output
+# so stale entries are never returned
+PIPELINE_VERSION = "1"
+
+
+class TweetCache:
+    '''
+    On-disk cache of clean text, polarity and subjectivity keyed by a hash
+    of the tweet text and the pipeline version.
+
+    Parameters
+    ----------
+    path : str
+        Location of the sqlite database, created if it does not exist
+    max_entries : int
+        Once the cache holds more entries than this, the least recently used
+        are evicted
+    version : str
+        Pipeline version mixed into every key
+    '''
+
+    def __init__(self, path, max_entries=200000, version=PIPELINE_VERSION):
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tweets ("
+            "key TEXT PRIMARY KEY, clean_tweet TEXT, polarity REAL, "
+            "subjectivity REAL, last_used REAL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS tweets_last_used ON tweets (last_used)"
+        )
+
+    def key(self, text):
+        '''Returns the cache key for a tweet'''
+        return hashlib.sha1(
+            (self.version + "\0" + text).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        '''
+        Looks up many keys at once and marks the ones found as used.
+
+        Returns
+        -------
+        dict
+            key -> (clean_tweet, polarity, subjectivity) for the keys found
+        '''
+        keys = list(set(keys))
+        found = {}
+        # stay below sqlite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(
+                "SELECT key, clean_tweet, polarity, subjectivity FROM tweets "
+                f"WHERE key IN ({placeholders})", batch
+            )
+            for key, clean, pol, subj in rows:
+                found[key] = (clean, pol, subj)
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE tweets SET last_used = ? WHERE key = ?",
+            [(now, key) for key in found]
+        )
+        self.conn.commit()
+        return found
+
+    def put_many(self, items):
+        '''
+        Stores (key, clean_tweet, polarity, subjectivity) tuples and evicts
+        the least recently used entries if the cache is over its size cap.
+        '''
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO tweets VALUES (?, ?, ?, ?, ?)",
+            [item + (now,) for item in items]
+        )
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries above max_entries'''
+        size = len(self)
+        if size <= self.max_entries:
+            return
+        excess = size - self.max_entries
+        self.conn.execute(
+            "DELETE FROM tweets WHERE key IN ("
+            "SELECT key FROM tweets ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self.conn.commit()
+        self.evictions += excess
+
+    def stats(self):
+        '''Returns hit/miss statistics for this session'''
+        lookups = self.hits + self.misses
+        return {"entries": len(self),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tweets").fetchone()[0]
+
+
+def get_clean_sentiment(tweets, cache, n_jobs=1, chunk_size=1000,
+                        engine="textblob", clean=None):
+    '''
+    Cleans and scores tweets, only doing the work for tweets that are not
+    already in the cache.
+
+    Parameters
+    ----------
+    tweets : pd.Series
+        Raw tweet text
+    cache : TweetCache
+        Cache to read from and write new results to
+    n_jobs, chunk_size : int
+        Passed on to get_sentiment for the tweets that are not cached
+    engine : str
+        Sentiment engine, passed on to get_sentiment. Both engines give the
+        same scores for clean tweets, so they share cache entries.
+    clean : pd.Series
+        tweets already cleaned with tweets_clean_text_batch, same index as
+        `tweets`. By default, None (uncached tweets are cleaned here).
+
+    Returns
+    -------
+    pd.DataFrame
+        clean_tweet, polarity and subjectivity columns with the same index as
+        `tweets`
+    '''
+    keys = [cache.key(tweet) for tweet in tweets]
+    found = cache.get_many(keys)
+
+    # score every distinct uncached tweet once
+    missing = {}
+    missing_clean = {}
+    for i, (key, tweet) in enumerate(zip(keys, tweets)):
+        if key not in found and key not in missing:
+            missing[key] = tweet
+            if clean is not None:
+                missing_clean[key] = clean.iloc[i]
+    num_missed = sum(key not in found for key in keys)
+    cache.hits += len(keys) - num_missed
+    cache.misses += num_missed
+
+    if missing:
+        if clean is None:
+            new_clean = tweets_clean_text_batch(list(missing.values()))
+        else:
+            new_clean = list(missing_clean.values())
+        sentiment = get_sentiment(new_clean, n_jobs=n_jobs,
+                                  chunk_size=chunk_size, engine=engine)
+        new = list(zip(missing.keys(), new_clean, sentiment['polarity'],
+                       sentiment['subjectivity']))
+        cache.put_many(new)
+        found.update((item[0], item[1:]) for item in new)
+
+    rows = [found[key] for key in keys]
+    return pd.DataFrame(rows, index=tweets.index,
+                        columns=['clean_tweet', 'polarity', 'subjectivity'])
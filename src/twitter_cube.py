@@ -0,0 +1,75 @@
+import pandas as pd
+
+
+def build_daily_cube(df):
+    '''
+    Aggregates tweets to one row per day and handle so the date range
+    callbacks work on days instead of tweets.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Clean tweets with date, date_week, handle, polarity and subjectivity
+        columns
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by (date, handle), sorted, with date_week, n_tweets,
+        polarity_sum and subjectivity_sum columns
+    '''
+    grouped = df.groupby(['date', 'handle'])
+    cube = grouped[['polarity', 'subjectivity']].sum()
+    cube.columns = ['polarity_sum', 'subjectivity_sum']
+    cube.insert(0, 'n_tweets', grouped.size())
+    cube.insert(0, 'date_week', grouped['date_week'].first())
+    return cube.sort_index()
+
+
+def cube_from_table(df_cube):
+    '''Restores the index of a cube that was written with write_table'''
+    return df_cube.set_index(['date', 'handle']).sort_index()
+
+
+def cube_to_table(cube):
+    '''Flattens a cube so it can be written with write_table'''
+    return cube.reset_index()
+
+
+def cube_range(cube, start_date, end_date):
+    '''
+    Returns the cube rows from start_date to end_date (inclusive). The date
+    level is sorted, so this is a binary search rather than a scan.
+    '''
+    return cube.loc[pd.to_datetime(start_date):pd.to_datetime(end_date)]
+
+
+def tweet_counts_by_handle(cube):
+    '''Number of tweets per handle, as plotted by plot_tweets_total'''
+    df_count = cube.groupby(level='handle')['n_tweets'].sum().reset_index()
+    df_count.columns = ['handle', 'number of tweets']
+    return df_count
+
+
+def tweet_counts_by_week(cube):
+    '''Number of tweets per week and handle, as plotted by plot_tweets_time'''
+    df_weekly_count = cube.reset_index().groupby(
+        ['date_week', 'handle'], as_index=False)['n_tweets'].sum()
+    df_weekly_count.columns = ['week', 'handle', 'number of tweets']
+    return df_weekly_count
+
+
+def merge_daily_cubes(cubes):
+    '''
+    Combines cubes built from separate chunks of tweets, e.g. when tweets
+    are processed in chunks. Rows for the same day and handle are added.
+    '''
+    cubes = [cube for cube in cubes if len(cube)]
+    if not cubes:
+        return build_daily_cube(pd.DataFrame(columns=[
+            'date', 'date_week', 'handle', 'polarity', 'subjectivity']))
+    combined = pd.concat(cubes)
+    grouped = combined.groupby(level=['date', 'handle'])
+    cube = grouped[['n_tweets', 'polarity_sum', 'subjectivity_sum']].sum()
+    cube.insert(0, 'date_week', grouped['date_week'].first())
+    return cube.sort_index()
@@ -2,12 +2,21 @@ import datetime
 import json
 import os
 
+import numpy as np
 import pandas as pd
 import twitter
 
+# how the twitter API writes created_at, e.g. "Thu Mar 26 18:12:32 +0000 2020"
+CREATED_AT_FORMAT = "%a %b %d %H:%M:%S %z %Y"
 
-def create_twitter_api():
-    """Check environment and return appropriate twitter API"""
+
+def create_twitter_api(sleep_on_rate_limit=True):
+    """
+    Check environment and return appropriate twitter API. The returned
+    client keeps a pooled HTTP session, so create it once and share it.
+    Pass sleep_on_rate_limit=False when the caller manages rate limits
+    itself.
+    """
 
     # API CREDENTIALS
     path = "twitter-credentials.json"
@@ -30,26 +39,36 @@ def create_twitter_api():
                       access_token_key=ACCESS_KEY,
                       access_token_secret=ACCESS_SECRET,
                       tweet_mode='extended',
-                      sleep_on_rate_limit=True)
+                      sleep_on_rate_limit=sleep_on_rate_limit)
 
     return api
 
 
 def fix_dates(df):
-    """fixes dates for twitter dataframe"""
-    df['date_time'] = pd.to_datetime(df['created_at'])
-    df['date'] = pd.to_datetime(df['date_time'].dt.date)
-
-    def find_monday(d):
-        """Receives a date and returns the date of the preceding Monday."""
-        while d.weekday() != 0:
-            d += datetime.timedelta(-1)
-        return d
-    df['date_week'] = df['date'].apply(find_monday)
+    """
+    fixes dates for twitter dataframe: date_time from created_at, the date
+    and the Monday of its week (date_week), computed on whole columns
+    """
+    try:
+        date_time = pd.to_datetime(df['created_at'], format=CREATED_AT_FORMAT)
+    except ValueError:
+        date_time = pd.to_datetime(df['created_at'])
+    df['date_time'] = date_time
+    if date_time.dt.tz is not None:
+        date_time = date_time.dt.tz_localize(None)
+    df['date'] = date_time.dt.normalize()
+    df['date_week'] = df['date'] - pd.to_timedelta(df['date'].dt.weekday,
+                                                   unit='D')
     return df
 
 
-def load_tweets(api, user_name, num, n_max_id=0):
+def oldest_date(statuses):
+    """Date (UTC) of the oldest of a page of twitter.Status"""
+    return datetime.datetime.utcfromtimestamp(
+        min(i.created_at_in_seconds for i in statuses)).date()
+
+
+def load_tweets(api, user_name, num, n_max_id=0, since_id=None):
     """
     Get raw data from twitter. See api.GetUserTimeline 
     https://developer.twitter.com/en/docs/tweets/timelines/api-reference/get-statuses-user_timeline.html
@@ -65,6 +84,9 @@ def load_tweets(api, user_name, num, n_max_id=0):
     n_max_id : int
         Returns only statuses with an ID less than (that is, older than) or 
         qual to the specified ID. By default, 0.
+    since_id : int
+        Returns only statuses with an ID greater than (that is, newer than)
+        the specified ID. By default, None (no lower bound).
 
     Returns
     -------
@@ -76,12 +98,38 @@ def load_tweets(api, user_name, num, n_max_id=0):
         exclude_replies=True,
         include_rts=False,
         trim_user=True,
-        max_id=n_max_id
+        max_id=n_max_id,
+        since_id=since_id
     )
     return raw
 
 
-def tweets_get(user_name, num=200, start_date=datetime.date(2019, 9, 11)):
+def tweets_to_df(statuses, start_date, handles=None):
+    '''
+    Turns a list of twitter.Status into a DataFrame of english tweets posted
+    on or after start_date. The frame is built once, from every status.
+
+    Parameters
+    ----------
+    statuses : list of twitter.Status
+    start_date : datetime.date
+    handles : list of str
+        Handle of each status, added as a handle column. By default, None
+        (no handle column).
+    '''
+    if not statuses:
+        return pd.DataFrame()
+    df = pd.DataFrame.from_records([i.AsDict() for i in statuses])
+    df = fix_dates(df)
+    if handles is not None:
+        df['handle'] = np.asarray(handles, dtype=object)
+    df = df[df['date'] >= pd.to_datetime(start_date)]
+    df = df[df['lang'] == 'en']  # keep only english langauge tweets
+    return df
+
+
+def tweets_get(user_name, num=200, start_date=datetime.date(2019, 9, 11),
+               since_id=None, api=None):
     '''
     Gets tweets and returns a DataFrame.
 
@@ -91,41 +139,83 @@ def tweets_get(user_name, num=200, start_date=datetime.date(2019, 9, 11)):
         The user you would like to get twitter data from (e.g. "JustinTrudeau")
     num : int
         The number of tweets you would like to return (max is 200)
-    loops: int
-        Because the max number of tweets is only 200, loops will indicate how many sets of "num" tweets you would like to return. 
-        For example num=200 and loops=2 would get 400 tweets
+    start_date : datetime.date
+        Tweets are fetched from the newest back to this date
+    since_id : int
+        Only fetch tweets newer than this id, e.g. the newest tweet already
+        stored for this user. By default, None (fetch back to start_date).
+    api : twitter.Api
+        Client to reuse. By default, None (a new client is created).
 
     Returns
     -------
     Dataframe with twitter data
     '''
 
-    api = create_twitter_api()
+    if api is None:
+        api = create_twitter_api()
     
     # get the first batch of twitter data
     print(f"Getting tweets for: {user_name}...")
-    raw = load_tweets(api=api, user_name=user_name, num=num)
-    df = pd.DataFrame.from_dict([i.AsDict() for i in raw])
-    df = fix_dates(df)
-
-    # loop through the dataframe x number of times based on the smallest id
-    # from the dataframe
-    max_id = df['id'].min()-1
-    min_date = df['date'].min()
-    while min_date > start_date:
+    raw = load_tweets(api=api, user_name=user_name, num=num, since_id=since_id)
+    if not raw:
+        print(f"\tno new tweets for {user_name}...")
+        return pd.DataFrame()
+
+    # page back from the oldest tweet so far, keeping the pages and
+    # building the DataFrame once at the end
+    statuses = list(raw)
+    while oldest_date(raw) > start_date:
         raw = load_tweets(
-            api=api, user_name=user_name, num=num, n_max_id=max_id
+            api=api, user_name=user_name, num=num,
+            n_max_id=min(i.id for i in raw) - 1, since_id=since_id
         )
-        temp_df = pd.DataFrame.from_dict([i.AsDict() for i in raw])
-        try:
-            temp_df = fix_dates(temp_df)
-        except KeyError:
-            print(f"\terror fixing dates for {user_name}...")
-            return df
-        df = pd.concat([df, temp_df], sort=False)
-        max_id = df['id'].min()-1
-        min_date = df['date'].min()
+        # an empty page means we have reached since_id or the oldest tweet
+        # twitter will return
+        if not raw:
+            break
+        statuses += raw
 
-    df = df[df['date'] >= pd.to_datetime(start_date)]
-    df = df[df['lang'] == 'en']  # keep only english langauge tweets
-    return df
+    return tweets_to_df(statuses, start_date)
+
+
+def get_latest_ids(df):
+    '''
+    Returns the newest stored tweet id for each handle.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Stored tweets with "handle" and "id" columns
+
+    Returns
+    -------
+    dict
+        handle -> highest tweet id
+    '''
+    if df.empty:
+        return {}
+    return df.groupby('handle')['id'].max().to_dict()
+
+
+def merge_tweets(df_old, df_new):
+    '''
+    Merges newly fetched tweets into the stored tweets. When a tweet is in
+    both, the newly fetched copy is kept (e.g. it has newer like counts).
+
+    Parameters
+    ----------
+    df_old : pd.DataFrame
+        Stored tweets
+    df_new : pd.DataFrame
+        Newly fetched tweets
+
+    Returns
+    -------
+    pd.DataFrame
+        Tweets de-duplicated on "id", newest first within each handle
+    '''
+    df = pd.concat([df_new, df_old], sort=False)
+    df = df.drop_duplicates(subset='id', keep='first')
+    df = df.sort_values(by=['handle', 'id'], ascending=[True, False])
+    return df.reset_index(drop=True)
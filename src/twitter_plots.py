@@ -1,6 +1,8 @@
-import dash_html_components as html
+import os
+
+import numpy as np
+import pandas as pd
 import plotly_express as px
-import plotly.figure_factory as ff
 import plotly.graph_objects as go
 
 
@@ -18,27 +20,26 @@ colors = {"dark_green": "#3a4f41",
           "light_grey": "#d2d7df"
           }
 
+# axes of the sentiment scatter, and cells per axis when it is binned
+SUBJECTIVITY_RANGE = (0.0, 1.0)
+POLARITY_RANGE = (-1.0, 1.0)
+SENTIMENT_BINS = 40
+
 # Note to self. To change plot background color
 # fig.update_layout({"showlegend": False, "paper_bgcolor": colors['dark_grey']})
 
 
-def generate_table(df, max_rows=10):
-    '''
-    Renders a table in dash app.
-    '''
-    return html.Table(
-        # Header
-        [html.Tr([html.Th(col) for col in df.columns])] +
-        # Body
-        [html.Tr([
-            html.Td(df.iloc[i][col]) for col in df.columns
-        ]) for i in range(min(len(df), max_rows))]
-    )
-
-
 def plot_tweets_total(df):
     df_count = df.groupby(['handle'], as_index=False).count().iloc[:, 0:2]
     df_count.columns = ['handle', 'number of tweets']
+    return plot_tweets_total_counts(df_count)
+
+
+def plot_tweets_total_counts(df_count):
+    '''
+    Plots the number of tweets per handle from precomputed counts (see
+    twitter_cube.tweet_counts_by_handle)
+    '''
     # create plot
     fig = px.bar(df_count, x='handle',
                  y='number of tweets', color="handle", color_discrete_map=colour_dict,
@@ -55,6 +56,14 @@ def plot_tweets_time(df):
     df_weekly_count = df.groupby(
         ['date_week', 'handle'], as_index=False).count().iloc[:, 0:3]
     df_weekly_count.columns = ['week', 'handle', 'number of tweets']
+    return plot_tweets_time_counts(df_weekly_count)
+
+
+def plot_tweets_time_counts(df_weekly_count):
+    '''
+    Plots tweets by week for each unique handle from precomputed counts (see
+    twitter_cube.tweet_counts_by_week)
+    '''
     # create plot
     fig = px.line(df_weekly_count, x='week',
                   y='number of tweets', color="handle", color_discrete_map=colour_dict,
@@ -64,68 +73,249 @@ def plot_tweets_time(df):
     return fig
 
 
-def plot_tweets_sentiment(df):
+def plot_tweets_sentiment(df, trendlines=None):
     '''
     Plots sentiment vs. subjectivity for every tweet.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with handle, subjectivity, polarity and break_tweet columns
+    trendlines : dict
+        Precomputed handle -> (slope, intercept). By default, None (fit to
+        df, see sentiment_trendlines).
     '''
     fig_scatter = px.scatter(df, x='subjectivity', y='polarity', height=600,
                              hover_name='break_tweet', color='handle', color_discrete_map=colour_dict, opacity=0.5,
-                             title="Tweet Polarity Vs. Subjectivity", trendline='ols')
-    return fig_scatter
-
-
-def plot_polarity_dist(df):
-    '''
-    Plots a histogram distribution of sentiment for each unique handle.
-    '''
-    # define variables
-    polarity = []
-    tweets = []
-    group_labels = []
-    leaders = list(df['handle'].unique())
-    for user in leaders:
-        polarity.append(df[df['handle'] == user]['polarity'])
-        tweets.append(df[df['handle'] == user]['break_tweet'])
-        group_labels.append(user)
-    # turn data into lists
-    data_dist = polarity
-    rug_text = tweets
-    colors = [colour_dict[i] for i in leaders]
-    # plot
-    fig = ff.create_distplot(data_dist, group_labels,
-                             show_hist=False, colors=colors, rug_text=rug_text)
-    fig.update_layout(title_text='Polarity Distribution')
-    fig.update_layout(margin=dict(l=0, r=0, t=30, b=30))
-    fig.update_layout({"showlegend": False})
+                             title="Tweet Polarity Vs. Subjectivity")
+    if trendlines is None:
+        trendlines = sentiment_trendlines(df)
+    return _sentiment_layout(fig_scatter, trendlines, None, None)
+
+
+def sentiment_trendlines(df):
+    '''
+    Least squares fit of polarity on subjectivity for each handle, the same
+    line as plotly's 'ols' trendline.
+
+    Returns
+    -------
+    dict
+        handle -> (slope, intercept)
+    '''
+    out = {}
+    for handle, group in df.groupby('handle'):
+        if group['subjectivity'].nunique() > 1:
+            slope, intercept = np.polyfit(group['subjectivity'],
+                                          group['polarity'], 1)
+            out[handle] = (float(slope), float(intercept))
+    return out
+
+
+def tweets_in_view(df, x_range=None, y_range=None):
+    '''
+    Returns the tweets inside a zoomed in view of the sentiment scatter.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets sorted by subjectivity, so the x range is a binary search
+    x_range, y_range : tuple of float
+        Subjectivity and polarity shown. By default, None (the whole axis).
+    '''
+    x0, x1 = x_range or SUBJECTIVITY_RANGE
+    y0, y1 = y_range or POLARITY_RANGE
+    subjectivity = df['subjectivity'].values
+    lo = np.searchsorted(subjectivity, x0, side='left')
+    hi = np.searchsorted(subjectivity, x1, side='right')
+    df = df.iloc[lo:hi]
+    return df[(df['polarity'] >= y0) & (df['polarity'] <= y1)]
+
+
+def bin_sentiment(df, x_range=None, y_range=None, bins=SENTIMENT_BINS):
+    '''
+    Bins tweets into a bins x bins grid of subjectivity and polarity for
+    each handle.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with handle, subjectivity, polarity and break_tweet columns
+    x_range, y_range : tuple of float
+        Subjectivity and polarity covered by the grid. By default, None
+        (the whole axis).
+    bins : int
+        Cells per axis
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per non empty cell and handle: handle, subjectivity and
+        polarity (the centre of the cell), count and a sample tweet
+    '''
+    x0, x1 = x_range or SUBJECTIVITY_RANGE
+    y0, y1 = y_range or POLARITY_RANGE
+    df = df[df['subjectivity'].between(x0, x1) & df['polarity'].between(y0, y1)]
+    x_width = (x1 - x0) / bins
+    y_width = (y1 - y0) / bins
+    cells = pd.DataFrame({
+        'handle': df['handle'].values,
+        'x': np.minimum(((df['subjectivity'].values - x0) // x_width), bins - 1),
+        'y': np.minimum(((df['polarity'].values - y0) // y_width), bins - 1),
+        'sample': df['break_tweet'].values
+    })
+    binned = cells.groupby(['handle', 'x', 'y'])['sample'].agg(
+        ['size', 'first']).reset_index()
+    return pd.DataFrame({'handle': binned['handle'],
+                         'subjectivity': x0 + (binned['x'] + 0.5) * x_width,
+                         'polarity': y0 + (binned['y'] + 0.5) * y_width,
+                         'count': binned['size'],
+                         'sample': binned['first']})
+
+
+def _sentiment_layout(fig, trendlines, x_range, y_range):
+    '''Adds the trendlines and axes shared by the binned and zoomed views'''
+    x0, x1 = x_range or SUBJECTIVITY_RANGE
+    for handle, (slope, intercept) in trendlines.items():
+        fig.add_trace(go.Scatter(
+            x=[x0, x1], y=[intercept + slope * x0, intercept + slope * x1],
+            mode='lines', name=handle, showlegend=False, hoverinfo='skip',
+            line=dict(color=colour_dict.get(handle))))
+    fig.update_layout(title="Tweet Polarity Vs. Subjectivity", height=600,
+                      xaxis=dict(title='subjectivity', range=x_range),
+                      yaxis=dict(title='polarity', range=y_range),
+                      # keeps the user's zoom when the figure is replaced
+                      uirevision='sentiment-scatter')
     return fig
 
 
-def plot_subjectivity_dist(df):
-    '''
-    Plots a histogram distribution of sentiment for each unique handle.
-    '''
-    # define variables
-    subjectivity = []
-    tweets = []
-    group_labels = []
-    leaders = list(df['handle'].unique())
-    for user in leaders:
-        subjectivity.append(df[df['handle'] == user]['subjectivity'])
-        tweets.append(df[df['handle'] == user]['break_tweet'])
-        group_labels.append(user)
-    # turn data into lists
-    data_dist = subjectivity
-    rug_text = tweets
-    colors = [colour_dict[i] for i in leaders]
-    # plot
-    fig = ff.create_distplot(data_dist, group_labels,
-                             show_hist=False, colors=colors, rug_text=rug_text)
-    fig.update_layout(title_text='Subjectivity Distribution')
-    fig.update_layout(margin=dict(l=0, r=0, t=30, b=30))
-    fig.update_layout({"showlegend": False})
+def plot_tweets_sentiment_binned(df, x_range=None, y_range=None,
+                                 bins=SENTIMENT_BINS, trendlines=None):
+    '''
+    Plots sentiment vs. subjectivity with tweets binned into a grid, one
+    marker per cell sized by the number of tweets in it and a sample tweet
+    as hover text. The figure has at most bins x bins markers per handle
+    however many tweets there are.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with handle, subjectivity, polarity and break_tweet columns
+    x_range, y_range : tuple of float
+        Zoomed in view. By default, None (the whole axis).
+    bins : int
+        Cells per axis of the view
+    trendlines : dict
+        Precomputed sentiment_trendlines. By default, None (fit to df).
+    '''
+    if trendlines is None:
+        trendlines = sentiment_trendlines(df)
+    return plot_sentiment_bins(bin_sentiment(df, x_range, y_range, bins),
+                               trendlines, x_range, y_range)
+
+
+def merge_sentiment_bins(binned):
+    '''
+    Combines bin_sentiment outputs of separate chunks of tweets (binned over
+    the same grid), adding the counts of the same cell.
+    '''
+    combined = pd.concat(binned, ignore_index=True)
+    grouped = combined.groupby(['handle', 'subjectivity', 'polarity'],
+                               sort=False)
+    return grouped.agg({'count': 'sum', 'sample': 'first'}).reset_index()
+
+
+def plot_sentiment_bins(binned, trendlines, x_range=None, y_range=None):
+    '''
+    Draws the output of bin_sentiment, see plot_tweets_sentiment_binned.
+    '''
+    largest = binned['count'].max() if len(binned) else 1
+
+    fig = go.Figure()
+    for handle, cells in binned.groupby('handle'):
+        fig.add_trace(go.Scatter(
+            x=cells['subjectivity'], y=cells['polarity'], mode='markers',
+            name=handle, text=cells['count'], customdata=cells['sample'],
+            hovertemplate="%{text} tweets<br>%{customdata}<extra></extra>",
+            marker=dict(color=colour_dict.get(handle), opacity=0.5,
+                        size=4 + 16 * np.sqrt(cells['count'] / largest))))
+    return _sentiment_layout(fig, trendlines, x_range, y_range)
+
+
+def plot_tweets_sentiment_points(df, x_range=None, y_range=None,
+                                 trendlines=None):
+    '''
+    Plots every tweet in a zoomed in view of the binned sentiment scatter.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The tweets in view, see tweets_in_view
+    x_range, y_range : tuple of float
+        Zoomed in view. By default, None (the whole axis).
+    trendlines : dict
+        Precomputed sentiment_trendlines. By default, None (fit to df).
+    '''
+    if trendlines is None:
+        trendlines = sentiment_trendlines(df)
+    fig = go.Figure()
+    for handle, tweets in df.groupby('handle'):
+        fig.add_trace(go.Scatter(
+            x=tweets['subjectivity'], y=tweets['polarity'], mode='markers',
+            name=handle, hovertext=tweets['break_tweet'], hoverinfo='text',
+            marker=dict(color=colour_dict.get(handle), opacity=0.5)))
+    return _sentiment_layout(fig, trendlines, x_range, y_range)
+
+
+def plot_sentiment_dist(stats, metric, title):
+    '''
+    Plots the distribution of a sentiment metric for each unique handle, a
+    KDE curve above a rug of binned scores, from precomputed statistics
+    (see twitter_stats.build_sentiment_stats). Laid out like
+    plotly.figure_factory.create_distplot without the histogram.
+    '''
+    fig = go.Figure()
+    kde = stats['kde'][metric]
+    rugs = stats['rug'][metric]
+    leaders = list(kde)
+    for handle in leaders:
+        fig.add_trace(go.Scatter(
+            x=kde[handle]['x'], y=kde[handle]['density'], mode='lines',
+            name=handle, legendgroup=handle,
+            line=dict(color=colour_dict.get(handle))))
+    for handle in leaders:
+        rug = rugs[handle]
+        fig.add_trace(go.Scatter(
+            x=rug['x'], y=[handle] * len(rug['x']), mode='markers',
+            name=handle, legendgroup=handle, showlegend=False, yaxis='y2',
+            text=rug['count'], customdata=rug['sample'],
+            hovertemplate="%{text} tweets<br>%{customdata}<extra></extra>",
+            marker=dict(color=colour_dict.get(handle), symbol='line-ns-open')))
+    fig.update_layout(
+        title_text=title,
+        yaxis=dict(domain=[0.35, 1], anchor='free', position=0.0),
+        yaxis2=dict(domain=[0, 0.25], anchor='x', dtick=1,
+                    showticklabels=False),
+        margin=dict(l=0, r=0, t=30, b=30),
+        showlegend=False)
     return fig
 
 
+def plot_polarity_dist(stats):
+    '''
+    Plots a distribution of sentiment for each unique handle.
+    '''
+    return plot_sentiment_dist(stats, 'polarity', 'Polarity Distribution')
+
+
+def plot_subjectivity_dist(stats):
+    '''
+    Plots a distribution of subjectivity for each unique handle.
+    '''
+    return plot_sentiment_dist(stats, 'subjectivity',
+                               'Subjectivity Distribution')
+
+
 def plot_about_eachother_heatmap(df):
     '''
     Plots a heatmap about how much they are tweeting about eachother
@@ -140,3 +330,43 @@ def plot_about_eachother_heatmap(df):
     ))
     fig.update_layout(title_text='Tweets About Eachother')
     return fig
+
+
+def plot_term_count_bar(df, term_col, title):
+    '''
+    Plots a word or phrase count horizontal bar chart, stacked by handle
+    '''
+    fig = px.bar(df, y=term_col, x='count', orientation="h", color="handle",
+                 title=title, height=800, color_discrete_map=colour_dict)
+    fig.update_layout({"showlegend": False})
+    fig.update_layout(margin=dict(l=0, r=0, t=30, b=30), autosize=True)
+    fig.update_yaxes(categoryorder="total ascending", title_text="")
+    return fig
+
+
+# figures that only depend on the full data set, built once per refresh
+STATIC_FIGURES = {"sentiment-scatter": plot_tweets_sentiment,
+                  "sentiment-binned": plot_tweets_sentiment_binned,
+                  "about-heatmap": plot_about_eachother_heatmap}
+
+# figures drawn from the statistics saved by the refresh stage
+STATS_FIGURES = {"polarity-dist": plot_polarity_dist,
+                 "subjectivity-dist": plot_subjectivity_dist}
+
+
+def save_static_figures(df, directory, stats):
+    '''
+    Builds every figure in STATIC_FIGURES and STATS_FIGURES and saves it as
+    plotly JSON so the app can load it instead of building it.
+    '''
+    figures = [(name, plot(df)) for name, plot in STATIC_FIGURES.items()]
+    figures += [(name, plot(stats)) for name, plot in STATS_FIGURES.items()]
+    save_figures(figures, directory)
+
+
+def save_figures(figures, directory):
+    '''Saves (name, figure) pairs as {directory}/{name}.json'''
+    os.makedirs(directory, exist_ok=True)
+    for name, fig in figures:
+        with open(os.path.join(directory, f"{name}.json"), "w") as file:
+            file.write(fig.to_json())
@@ -0,0 +1,284 @@
+import datetime
+import heapq
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import twitter
+from twitter.ratelimit import EndpointRateLimit
+
+from twitter_data import (create_twitter_api, load_tweets, oldest_date,
+                          tweets_to_df)
+
+# statuses/user_timeline allows 900 requests per 15 minute window with user
+# auth
+TIMELINE_LIMIT = 900
+RATE_LIMIT_WINDOW = 15 * 60
+RATE_LIMIT_ERROR_CODE = 88
+
+
+def timeline_url(api):
+    '''URL twitter reports the user_timeline rate limit against'''
+    return f"{api.base_url}/statuses/user_timeline.json"
+
+
+class RateLimitBudget:
+    '''
+    Tracks how many user_timeline requests are left in the current rate
+    limit window. The scheduler spends one request per page and blocks only
+    when the budget is empty, instead of the whole client sleeping.
+
+    Parameters
+    ----------
+    limit : int
+        Requests allowed per window
+    remaining : int
+        Requests left in the current window. By default, `limit`.
+    reset : float
+        Epoch seconds when the current window ends. By default, one window
+        from now, until twitter reports the actual reset time.
+    '''
+
+    def __init__(self, limit=TIMELINE_LIMIT, remaining=None, reset=None,
+                 clock=time.time, sleep=time.sleep):
+        self.limit = limit
+        self.remaining = limit if remaining is None else remaining
+        self.reset = clock() + RATE_LIMIT_WINDOW if reset is None else reset
+        # True while reset is our own estimate rather than twitter's
+        self.estimated = reset is None
+        self.clock = clock
+        self.sleep = sleep
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Spends one request, sleeping until the window resets if empty'''
+        with self._lock:
+            if self.remaining <= 0:
+                wait_for = self.reset - self.clock()
+                if wait_for > 0:
+                    print(f"\trate limit reached, waiting {wait_for:.0f}s...")
+                    self.sleep(wait_for)
+                self.remaining = self.limit
+                self.reset = self.clock() + RATE_LIMIT_WINDOW
+                self.estimated = True
+            self.remaining -= 1
+            self.spent += 1
+
+    def update(self, remaining, reset):
+        '''
+        Syncs the budget with the limit twitter reported. Requests still in
+        flight are not in twitter's count yet, so within the same window
+        the lower of the two is kept.
+        '''
+        remaining = int(remaining)
+        reset = float(reset)
+        with self._lock:
+            if reset <= self.clock():
+                # reported by a request made in a window that has now ended
+                return
+            if reset > self.reset or self.estimated:
+                self.remaining = remaining
+                self.reset = reset
+                self.estimated = False
+            else:
+                self.remaining = min(self.remaining, remaining)
+
+    def exhaust(self):
+        '''Marks the window as used up, e.g. after a rate limit error'''
+        with self._lock:
+            self.remaining = 0
+
+
+def _is_rate_limit_error(err):
+    messages = err.message if isinstance(err.message, list) else [err.message]
+    return any(isinstance(i, dict) and i.get('code') == RATE_LIMIT_ERROR_CODE
+               for i in messages)
+
+
+def fetch_timelines(handles, start_date, since_ids=None, last_seen=None,
+                    num=200, max_workers=4, api=None, budget=None):
+    '''
+    Pages the timelines of several handles concurrently with one shared
+    client.
+
+    Each handle is paged backwards from its newest tweet until start_date
+    (or since_id) is reached. Up to `max_workers` pages are in flight at a
+    time, one per handle. Whenever a page can be requested it goes to the
+    stalest handle with work left, so a scarce rate limit budget is spent
+    on the handles that have gone longest without a refresh.
+
+    Parameters
+    ----------
+    handles : list of str
+        Twitter handles to fetch
+    start_date : datetime.date
+        Oldest date to fetch back to
+    since_ids : dict
+        handle -> newest stored tweet id, only newer tweets are fetched
+    last_seen : dict
+        handle -> date of the newest stored tweet, used to order the
+        handles. Handles not in it are treated as the stalest.
+    num : int
+        Tweets per page (max 200)
+    max_workers : int
+        Number of pages requested at the same time
+    api : twitter.Api or StubTimelineApi
+        Shared client. By default, None (one is created).
+    budget : RateLimitBudget
+        By default, None (a full window is assumed)
+
+    Returns
+    -------
+    pd.DataFrame
+        Tweets of every handle with a handle column, built once from all
+        the pages fetched
+    '''
+    if api is None:
+        api = create_twitter_api(sleep_on_rate_limit=False)
+    if budget is None:
+        budget = RateLimitBudget()
+    since_ids = since_ids or {}
+    last_seen = last_seen or {}
+
+    # stalest first, handles that were never fetched before all others
+    order = sorted(handles, key=lambda h: (h in last_seen, last_seen.get(h)))
+    pending = [(priority, handle) for priority, handle in enumerate(order)]
+    heapq.heapify(pending)
+    max_ids = {handle: 0 for handle in handles}
+    statuses = {handle: [] for handle in handles}
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_workers:
+                priority, handle = heapq.heappop(pending)
+                budget.acquire()
+                future = executor.submit(
+                    load_tweets, api=api, user_name=handle, num=num,
+                    n_max_id=max_ids[handle], since_id=since_ids.get(handle)
+                )
+                in_flight[future] = (priority, handle)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                priority, handle = in_flight.pop(future)
+                try:
+                    raw = future.result()
+                except twitter.TwitterError as err:
+                    if not _is_rate_limit_error(err):
+                        raise
+                    # retry the same page once the window resets
+                    limit = api.CheckRateLimit(timeline_url(api))
+                    budget.update(0, limit.reset)
+                    budget.exhaust()
+                    heapq.heappush(pending, (priority, handle))
+                    continue
+
+                limit = api.CheckRateLimit(timeline_url(api))
+                budget.update(limit.remaining, limit.reset)
+
+                # an empty page means we have reached since_id or the oldest
+                # tweet twitter will return
+                if not raw:
+                    continue
+                statuses[handle] += raw
+                max_ids[handle] = min(i.id for i in raw) - 1
+                if oldest_date(raw) > start_date:
+                    heapq.heappush(pending, (priority, handle))
+
+    return tweets_to_df(
+        [i for handle in handles for i in statuses[handle]], start_date,
+        handles=[handle for handle in handles
+                 for _ in range(len(statuses[handle]))])
+
+
+class StubTimelineApi:
+    '''
+    Offline stand-in for twitter.Api that serves user timelines from memory.
+    Follows twitter's max_id/since_id paging and its rate limit, raising
+    the same TwitterError when the window is used up, so the scheduler can
+    be exercised without credentials or network access.
+
+    Parameters
+    ----------
+    timelines : dict
+        handle -> list of status dicts as returned by the twitter API (see
+        make_stub_timelines)
+    limit : int
+        Requests allowed per window
+    window : float
+        Length of the rate limit window in seconds
+    latency : float
+        Seconds each request takes
+    '''
+
+    base_url = "https://api.twitter.com/1.1"
+
+    def __init__(self, timelines, limit=TIMELINE_LIMIT,
+                 window=RATE_LIMIT_WINDOW, latency=0.0, clock=time.time):
+        self.timelines = {
+            handle: sorted(statuses, key=lambda i: i['id'], reverse=True)
+            for handle, statuses in timelines.items()
+        }
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.clock = clock
+        self.remaining = limit
+        self.reset = clock() + window
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def GetUserTimeline(self, screen_name=None, count=200, max_id=None,
+                        since_id=None, **kwargs):
+        with self._lock:
+            if self.clock() >= self.reset:
+                self.remaining = self.limit
+                self.reset = self.clock() + self.window
+            if self.remaining <= 0:
+                raise twitter.TwitterError(
+                    [{'message': 'Rate limit exceeded',
+                      'code': RATE_LIMIT_ERROR_CODE}])
+            self.remaining -= 1
+            self.calls.append(screen_name)
+        if self.latency:
+            time.sleep(self.latency)
+
+        page = [i for i in self.timelines.get(screen_name, [])
+                if (not max_id or i['id'] <= max_id)
+                and (not since_id or i['id'] > since_id)]
+        return [twitter.Status.NewFromJsonDict(i) for i in page[:count]]
+
+    def CheckRateLimit(self, url):
+        with self._lock:
+            return EndpointRateLimit(self.limit, self.remaining, self.reset)
+
+
+def make_stub_timelines(handles, num_tweets, start_date, end_date):
+    '''
+    Generates fake status dicts for StubTimelineApi, spread evenly between
+    start_date and end_date with ids increasing over time.
+
+    Returns
+    -------
+    dict
+        handle -> list of status dicts
+    '''
+    start = datetime.datetime.combine(start_date, datetime.time())
+    step = (datetime.datetime.combine(end_date, datetime.time()) - start) \
+        / max(num_tweets, 1)
+    timelines = {}
+    for h, handle in enumerate(handles):
+        timelines[handle] = []
+        for i in range(num_tweets):
+            created = start + step * i
+            timelines[handle].append({
+                'id': (i * len(handles) + h + 1) * 1000,
+                'created_at': created.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+                'full_text': f"tweet {i} from {handle}",
+                'lang': 'en',
+                'favorite_count': i % 50,
+                'retweet_count': i % 20
+            })
+    return timelines
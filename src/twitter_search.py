@@ -0,0 +1,499 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# a query is words and "quoted phrases", each may be negated with "-"
+QUERY_PATTERN = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+NON_ALPHA_NUMERIC_PATTERN = re.compile(r"[^a-zA-Z0-9\s]")
+
+# bits of a posting holding the position of the word in its tweet, tweets
+# have at most 140 words
+POSITION_BITS = 16
+
+
+def _ranges(starts, lengths):
+    '''Positions starts[i] to starts[i] + lengths[i] of every i, in order'''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.array([], dtype=np.int64)
+    shift = np.repeat(np.asarray(starts, dtype=np.int64)
+                      - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + shift
+
+
+def _intersect(a, b):
+    '''Values in both of two sorted arrays of unique values'''
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return a
+    idx = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[idx] == a]
+
+
+def _distinct(values):
+    '''Sorted unique values, sorting rather than hashing like np.unique'''
+    values = np.sort(values, kind='stable')
+    if len(values) == 0:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+
+def _union(a, b):
+    '''Values in either of two sorted arrays of unique values, sorted'''
+    return _distinct(np.concatenate([a, b]))
+
+
+def _day(date):
+    '''A date as datetime64[D], None stays None'''
+    return None if date is None else np.datetime64(pd.Timestamp(date), 'D')
+
+
+def _difference(a, b):
+    '''Values of a sorted array of unique values that are not in another'''
+    if len(a) == 0 or len(b) == 0:
+        return a
+    idx = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[idx] != a]
+
+
+class SearchShard:
+    '''
+    The inverted index of one handle's tweets. Tweets are numbered from 0
+    in date order. Each term has a sorted postings list of where it is
+    used, tweet << POSITION_BITS | position of the word in the tweet, so a
+    date range is a slice of every list and a phrase is its words' lists
+    shifted by their place in it and intersected.
+
+    Parameters
+    ----------
+    dates : np.ndarray
+        datetime64[D] date of each tweet, sorted
+    rows : np.ndarray
+        Row of each tweet in the clean data
+    terms : np.ndarray
+        Sorted ids of the terms used in the shard
+    indptr : np.ndarray
+        Postings of terms[k] are postings[indptr[k]:indptr[k + 1]]
+    postings : np.ndarray
+        Tweet and position of every word, sorted within each term
+    tokens : np.ndarray
+        Term ids of every tweet, one after the other, to count terms
+    offsets : np.ndarray
+        Start of each tweet in tokens, plus the end of the last one
+    '''
+
+    def __init__(self, dates, rows, terms, indptr, postings, tokens,
+                 offsets):
+        self.dates = dates
+        self.rows = rows
+        self.terms = terms
+        self.indptr = indptr
+        self.postings = postings
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def from_tokens(cls, dates, rows, tokens, offsets):
+        '''Builds the postings of tweets already in date order'''
+        lengths = np.diff(offsets)
+        tweet = np.repeat(np.arange(len(dates), dtype=np.int64), lengths)
+        position = np.arange(len(tokens), dtype=np.int64) - offsets[tweet]
+        # stable, so each term's postings stay in tweet and position order
+        order = np.argsort(tokens, kind='stable')
+        counts = np.bincount(tokens, minlength=1)
+        terms = np.flatnonzero(counts)
+        return cls(dates, rows, terms.astype(np.int32),
+                   np.concatenate([[0], np.cumsum(counts[terms])]),
+                   ((tweet << POSITION_BITS) | position)[order], tokens,
+                   offsets)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def date_slice(self, start_date=None, end_date=None):
+        '''
+        Tweets from start_date to end_date (datetime64[D], inclusive) are
+        numbered lo to hi - 1, returns (lo, hi)
+        '''
+        lo = 0 if start_date is None else np.searchsorted(
+            self.dates, start_date, side='left')
+        hi = len(self) if end_date is None else np.searchsorted(
+            self.dates, end_date, side='right')
+        return int(lo), int(hi)
+
+    def term_postings(self, term, lo, hi):
+        '''Postings of a term id in the tweets numbered lo to hi - 1'''
+        k = np.searchsorted(self.terms, term)
+        if k == len(self.terms) or self.terms[k] != term:
+            return np.array([], dtype=np.int64)
+        postings = self.postings[self.indptr[k]:self.indptr[k + 1]]
+        return postings[np.searchsorted(postings, lo << POSITION_BITS):
+                        np.searchsorted(postings, hi << POSITION_BITS)]
+
+    def match(self, phrase, lo, hi):
+        '''
+        Sorted numbers of the tweets numbered lo to hi - 1 containing a
+        phrase, a tuple of term ids
+        '''
+        found = self.term_postings(phrase[0], lo, hi)
+        for k, term in enumerate(phrase[1:], start=1):
+            if len(found) == 0:
+                break
+            # where the k-th word follows, moved back to the first word
+            found = _intersect(found, self.term_postings(term, lo, hi) - k)
+        tweets = (found >> POSITION_BITS).astype(np.int32)
+        if len(tweets) == 0:
+            return tweets
+        return tweets[np.concatenate([[True], tweets[1:] != tweets[:-1]])]
+
+    def gather(self, tweets):
+        '''Token ids of some tweets, and the tweet of each token'''
+        starts = self.offsets[tweets]
+        lengths = self.offsets[np.asarray(tweets) + 1] - starts
+        return (self.tokens[_ranges(starts, lengths)],
+                np.repeat(np.arange(len(tweets)), lengths))
+
+
+class SearchIndex:
+    '''
+    Inverted index of the clean tweets, sharded by handle, answering
+    keyword queries without reading the tweets.
+
+    A query is words and "quoted phrases", all of which must be in a tweet.
+    A word or phrase starting with "-" must not be, OR separates
+    alternatives and from:handle only searches one handle's tweets, e.g.
+    `pharmacare "child care" -tax OR daycare from:theJagmeetSingh`. Query
+    words are cleaned like tweets: punctuation and case are dropped and
+    stop words ignored.
+
+    Parameters
+    ----------
+    terms : list of str
+        Term of each term id
+    stop_words : iterable of str
+        Words removed when the tweets were cleaned
+    shards : dict
+        handle -> SearchShard
+    '''
+
+    def __init__(self, terms, stop_words, shards):
+        self.terms = list(terms)
+        self.stop_words = set(stop_words)
+        self.shards = shards
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        self._handles = {handle.lower(): handle for handle in shards}
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards.values())
+
+    def _phrase(self, text):
+        '''Term ids of the words of a query phrase, -1 for unknown words'''
+        words = NON_ALPHA_NUMERIC_PATTERN.sub("", text).lower().split()
+        return tuple(self.term_ids.get(word, -1) for word in words
+                     if word not in self.stop_words)
+
+    def parse(self, query):
+        '''
+        Parses a query.
+
+        Returns
+        -------
+        tuple
+            (handles searched, None for all, and a list of alternatives,
+            each a pair of lists of the phrases that must and must not be
+            in a tweet)
+        '''
+        handles = set()
+        clauses = [([], [])]
+        for negate, quoted, word in QUERY_PATTERN.findall(query or ""):
+            if not negate and not quoted and word == "OR":
+                clauses.append(([], []))
+                continue
+            if not negate and word.lower().startswith("from:"):
+                name = word[5:].lstrip("@").lower()
+                handles.add(self._handles.get(name, name))
+                continue
+            phrase = self._phrase(quoted or word)
+            if phrase:
+                clauses[-1][1 if negate else 0].append(phrase)
+        return (handles or None), clauses
+
+    def find(self, query, start_date=None, end_date=None):
+        '''
+        Tweets matching a query between two dates.
+
+        Parameters
+        ----------
+        query : str
+            See SearchIndex
+        start_date, end_date : str or datetime
+            Date range, inclusive. By default, None (no limit).
+
+        Returns
+        -------
+        dict
+            handle -> sorted numbers of the matching tweets in its shard,
+            see rows and top_terms
+        '''
+        handles, clauses = self.parse(query)
+        start_date, end_date = _day(start_date), _day(end_date)
+        hits = {}
+        for handle, shard in self.shards.items():
+            if handles is not None and handle not in handles:
+                continue
+            lo, hi = shard.date_slice(start_date, end_date)
+            found = None
+            for include, exclude in clauses:
+                if not include and not exclude and len(clauses) > 1:
+                    continue
+                # rarest first, so the other postings are searched, not read
+                matches = sorted((shard.match(phrase, lo, hi)
+                                  for phrase in include), key=len)
+                if matches:
+                    tweets = matches[0]
+                    for other in matches[1:]:
+                        tweets = _intersect(tweets, other)
+                else:
+                    tweets = np.arange(lo, hi, dtype=np.int32)
+                for phrase in exclude:
+                    tweets = _difference(tweets, shard.match(phrase, lo, hi))
+                found = tweets if found is None else _union(found, tweets)
+            if found is not None and len(found):
+                hits[handle] = found
+        return hits
+
+    def rows(self, hits):
+        '''Sorted rows in the clean data of the tweets found by find'''
+        if not hits:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate([self.shards[handle].rows[tweets]
+                                       for handle, tweets in hits.items()]))
+
+    @staticmethod
+    def _ngram_counts(ids, tweet, n, base):
+        '''
+        n-grams of some tweets' term ids, counted. Keys are the ids written
+        as one number in base, or tuples of ids when base is None (the keys
+        would not fit in 64 bits).
+        '''
+        starts = len(ids) - n + 1
+        if starts <= 0:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty
+        inside = tweet[:starts] == tweet[n - 1:n - 1 + starts]
+        if base is None:
+            grams = np.stack([ids[k:k + starts][inside] for k in range(n)],
+                             axis=1)
+            grams, counts = np.unique(grams, axis=0, return_counts=True)
+            keys = np.empty(len(grams), dtype=object)
+            keys[:] = list(map(tuple, grams.tolist()))
+            return keys, counts
+        keys = ids[:starts].astype(np.int64)
+        for k in range(1, n):
+            keys = keys * base + ids[k:k + starts]
+        return np.unique(keys[inside], return_counts=True)
+
+    def _ngram_terms(self, key, n, used, base):
+        '''An n-gram key of _ngram_counts back to text, words joined by "_"'''
+        if base is None:
+            ids = list(key)
+        else:
+            ids = []
+            for _ in range(n):
+                key, i = divmod(int(key), base)
+                ids.append(i)
+            ids.reverse()
+        return "_".join(self.terms[used[i]] for i in ids)
+
+    def top_terms(self, hits, n=50, ngrams=(1,), handle="All",
+                  term_col='word'):
+        '''
+        The most used terms of the tweets found by find, in the layout of
+        twitter_term_index.top_terms.
+
+        Parameters
+        ----------
+        hits : dict
+            Output of find
+        n : int
+            Number of terms
+        ngrams : tuple of int
+            (1,) for words, (2, 3) for phrases
+        handle : str
+            A handle, or "All" for the top terms across every handle broken
+            down by handle
+        term_col : str
+            Name of the term column, "word" or "phrase"
+
+        Returns
+        -------
+        pd.DataFrame
+            term_col, count, handle, total_count and rank columns
+        '''
+        columns = [term_col, 'count', 'handle', 'total_count', 'rank']
+        gathered = {user: self.shards[user].gather(tweets)
+                    for user, tweets in hits.items()
+                    if handle == "All" or user == handle}
+        # terms are numbered again among the terms the tweets use, so the
+        # keys are small, and only when even those do not fit in 64 bits
+        # (millions of distinct words) are n-grams counted as rows of ids
+        used = _distinct(np.concatenate(
+            [ids for ids, _ in gathered.values()] + [np.array([], np.int64)]))
+        base = len(used) if len(used) ** max(ngrams) < 2 ** 63 else None
+        counts = []
+        for user, (ids, tweet) in gathered.items():
+            ids = np.searchsorted(used, ids)
+            for size in ngrams:
+                keys, count = self._ngram_counts(ids, tweet, size, base)
+                counts.append(pd.DataFrame({'size': size, 'key': keys,
+                                            'count': count, 'handle': user}))
+        if not counts:
+            return pd.DataFrame(columns=columns)
+        counts = pd.concat(counts, ignore_index=True)
+
+        totals = counts.groupby(['size', 'key'])['count'].sum()
+        top = totals.sort_values(ascending=False, kind='stable').head(n)
+        top = top.reset_index(name='total_count')
+        top['rank'] = np.arange(1, len(top) + 1)
+        top[term_col] = [self._ngram_terms(key, size, used, base)
+                         for size, key in zip(top['size'], top['key'])]
+        out = counts.merge(top, on=['size', 'key'])
+        return out.sort_values(by=['rank', 'count'],
+                               ascending=[True, False])[columns] \
+            .reset_index(drop=True)
+
+
+class SearchIndexBuilder:
+    '''
+    Builds a SearchIndex one chunk of tweets at a time, keeping a single
+    vocabulary. Tweets are numbered by their order of arrival, which is
+    their row in the clean data.
+
+    Parameters
+    ----------
+    stop_words : iterable of str
+        Words removed when the tweets were cleaned, ignored in queries
+    '''
+
+    def __init__(self, stop_words=()):
+        self.stop_words = sorted(set(stop_words))
+        self.vocab = {}
+        self.ids = []
+        self.lengths = []
+        self.handles = []
+        self.dates = []
+
+    def add_tokens(self, tokens, handles, dates):
+        '''
+        Adds tweets from a TokenStore of their clean text, with the handle
+        and date of each tweet
+        '''
+        setdefault = self.vocab.setdefault
+        to_global = np.array([setdefault(term, len(self.vocab))
+                              for term in tokens.terms], dtype=np.int32)
+        self.ids.append(to_global[tokens.ids])
+        self.lengths.append(np.diff(tokens.offsets))
+        self.handles.append(np.asarray(handles, dtype=str))
+        self.dates.append(np.asarray(pd.to_datetime(dates).values,
+                                     dtype='datetime64[D]'))
+        return self
+
+    def add(self, df, text_col='clean_tweet'):
+        '''Adds the tweets in df, which has date, handle and text_col'''
+        setdefault = self.vocab.setdefault
+        ids = []
+        lengths = []
+        for text in df[text_col]:
+            words = text.split() if isinstance(text, str) else []
+            ids.extend([setdefault(word, len(self.vocab)) for word in words])
+            lengths.append(len(words))
+        self.ids.append(np.array(ids, dtype=np.int32))
+        self.lengths.append(np.array(lengths, dtype=np.int64))
+        self.handles.append(np.asarray(df['handle'], dtype=str))
+        self.dates.append(np.asarray(pd.to_datetime(df['date']).values,
+                                     dtype='datetime64[D]'))
+        return self
+
+    def build(self):
+        '''Returns the SearchIndex of every tweet added so far'''
+        terms = [None] * len(self.vocab)
+        for term, i in self.vocab.items():
+            terms[i] = term
+        if not self.lengths:
+            return SearchIndex(terms, self.stop_words, {})
+        ids = np.concatenate(self.ids)
+        lengths = np.concatenate(self.lengths)
+        handles = np.concatenate(self.handles)
+        dates = np.concatenate(self.dates)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        shards = {}
+        names, codes = np.unique(handles, return_inverse=True)
+        for code, handle in enumerate(names):
+            rows = np.flatnonzero(codes == code)
+            # stable, tweets of the same day stay in row order
+            rows = rows[np.argsort(dates[rows], kind='stable')]
+            tokens = ids[_ranges(offsets[rows], lengths[rows])]
+            shards[str(handle)] = SearchShard.from_tokens(
+                dates[rows], rows, tokens,
+                np.concatenate([[0], np.cumsum(lengths[rows])]))
+        return SearchIndex(terms, self.stop_words, shards)
+
+
+def build_search_index(df, text_col='clean_tweet', stop_words=()):
+    '''
+    Builds a SearchIndex from clean tweets.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with date, handle and text_col columns, in the order of the
+        clean data
+    text_col : str
+        Column of clean, space separated text
+    stop_words : iterable of str
+        Words removed when the tweets were cleaned
+
+    Returns
+    -------
+    SearchIndex
+    '''
+    return SearchIndexBuilder(stop_words).add(df, text_col).build()
+
+
+def _join(words):
+    '''Words (without whitespace) as one array of utf-8 bytes'''
+    return np.frombuffer("\n".join(words).encode("utf-8"), dtype=np.uint8)
+
+
+def _split(array):
+    text = array.tobytes().decode("utf-8")
+    return text.split("\n") if text else []
+
+
+def save_search_index(index, path):
+    '''Saves a SearchIndex to an .npz file'''
+    arrays = {'terms': _join(index.terms),
+              'stop_words': _join(sorted(index.stop_words)),
+              'handles': np.array(list(index.shards), dtype=str)}
+    for k, shard in enumerate(index.shards.values()):
+        for name in ['dates', 'rows', 'terms', 'indptr', 'postings',
+                     'tokens', 'offsets']:
+            arrays[f"shard{k}_{name}"] = getattr(shard, name)
+    np.savez_compressed(path, **arrays)
+
+
+def load_search_index(path):
+    '''Loads a SearchIndex saved with save_search_index'''
+    with np.load(path) as f:
+        shards = {}
+        for k, handle in enumerate(f['handles']):
+            shards[str(handle)] = SearchShard(**{
+                name: f[f"shard{k}_{name}"] for name in
+                ['dates', 'rows', 'terms', 'indptr', 'postings', 'tokens',
+                 'offsets']})
+        return SearchIndex(_split(f['terms']), _split(f['stop_words']),
+                           shards)
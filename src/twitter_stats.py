@@ -0,0 +1,221 @@
+import json
+
+import numpy as np
+
+# sentiment metrics and the range TextBlob scores them in
+METRIC_RANGES = {'polarity': (-1.0, 1.0),
+                 'subjectivity': (0.0, 1.0)}
+
+# histogram bins per metric, the KDE and rug are built from these
+HIST_BINS = 200
+
+# points each KDE curve is evaluated at
+KDE_POINTS = 200
+
+
+def _empty_moments(bins):
+    return {'n': 0,
+            'sum': {metric: 0.0 for metric in METRIC_RANGES},
+            'sum_sq': {metric: 0.0 for metric in METRIC_RANGES},
+            'sum_xy': 0.0,
+            'min': {metric: None for metric in METRIC_RANGES},
+            'max': {metric: None for metric in METRIC_RANGES},
+            'hist': {metric: [0] * bins for metric in METRIC_RANGES},
+            'hist_sum': {metric: [0.0] * bins for metric in METRIC_RANGES},
+            'sample': {metric: [None] * bins for metric in METRIC_RANGES}}
+
+
+def _bin_of(values, metric, bins):
+    lo, hi = METRIC_RANGES[metric]
+    return np.clip(((values - lo) / (hi - lo) * bins).astype(int), 0, bins - 1)
+
+
+def sentiment_moments(df, bins=HIST_BINS):
+    '''
+    Summarises the sentiment of tweets per handle as statistics that can be
+    added together, so chunks of tweets can be summarised separately and
+    merged with merge_sentiment_moments.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with handle, polarity, subjectivity and break_tweet columns
+    bins : int
+        Histogram bins per metric
+
+    Returns
+    -------
+    dict
+        handle -> counts, sums, sums of squares, the sum of polarity times
+        subjectivity, min, max, a histogram per metric with the sum of the
+        scores in each bin, and the first tweet in each bin
+    '''
+    out = {}
+    for handle, group in df.groupby('handle'):
+        moments = _empty_moments(bins)
+        moments['n'] = len(group)
+        x = group['subjectivity'].values.astype(float)
+        y = group['polarity'].values.astype(float)
+        moments['sum_xy'] = float(np.dot(x, y))
+        text = group['break_tweet'].values
+        for metric, values in [('subjectivity', x), ('polarity', y)]:
+            moments['sum'][metric] = float(values.sum())
+            moments['sum_sq'][metric] = float(np.dot(values, values))
+            moments['min'][metric] = float(values.min())
+            moments['max'][metric] = float(values.max())
+            which = _bin_of(values, metric, bins)
+            moments['hist'][metric] = np.bincount(
+                which, minlength=bins).tolist()
+            moments['hist_sum'][metric] = np.bincount(
+                which, weights=values, minlength=bins).tolist()
+            # first tweet in each bin
+            first_bin, first = np.unique(which, return_index=True)
+            for b, i in zip(first_bin, first):
+                moments['sample'][metric][b] = text[i]
+        out[handle] = moments
+    return out
+
+
+def merge_sentiment_moments(a, b):
+    '''
+    Combines two results of sentiment_moments, e.g. of two chunks of
+    tweets. Sample tweets are taken from `a` where it has one.
+    '''
+    out = {}
+    for handle in list(a) + [h for h in b if h not in a]:
+        if handle not in a or handle not in b:
+            out[handle] = a.get(handle) or b[handle]
+            continue
+        x, y = a[handle], b[handle]
+        merged = {'n': x['n'] + y['n'],
+                  'sum_xy': x['sum_xy'] + y['sum_xy'],
+                  'sum': {}, 'sum_sq': {}, 'min': {}, 'max': {},
+                  'hist': {}, 'hist_sum': {}, 'sample': {}}
+        for metric in METRIC_RANGES:
+            merged['sum'][metric] = x['sum'][metric] + y['sum'][metric]
+            merged['sum_sq'][metric] = \
+                x['sum_sq'][metric] + y['sum_sq'][metric]
+            merged['min'][metric] = min(x['min'][metric], y['min'][metric])
+            merged['max'][metric] = max(x['max'][metric], y['max'][metric])
+            merged['hist'][metric] = [
+                i + j for i, j in zip(x['hist'][metric], y['hist'][metric])]
+            merged['hist_sum'][metric] = [
+                i + j for i, j in
+                zip(x['hist_sum'][metric], y['hist_sum'][metric])]
+            merged['sample'][metric] = [
+                i if i is not None else j
+                for i, j in zip(x['sample'][metric], y['sample'][metric])]
+        out[handle] = merged
+    return out
+
+
+def trendline(moments):
+    '''
+    Least squares fit of polarity on subjectivity from sentiment_moments
+    of one handle, the same line as plotly's 'ols' trendline.
+
+    Returns
+    -------
+    tuple or None
+        (slope, intercept), None if subjectivity does not vary
+    '''
+    n = moments['n']
+    sum_x = moments['sum']['subjectivity']
+    sum_y = moments['sum']['polarity']
+    denominator = n * moments['sum_sq']['subjectivity'] - sum_x ** 2
+    if n < 2 or denominator <= 1e-12 * max(n * n, 1):
+        return None
+    slope = (n * moments['sum_xy'] - sum_x * sum_y) / denominator
+    return slope, (sum_y - slope * sum_x) / n
+
+
+def kde_curve(moments, metric, points=KDE_POINTS):
+    '''
+    Gaussian kernel density estimate of one metric, computed from the
+    histogram rather than every tweet. Uses Scott's rule for the bandwidth
+    and evaluates between the smallest and largest score, as
+    plotly.figure_factory.create_distplot does.
+
+    Returns
+    -------
+    tuple of list
+        (x, density)
+    '''
+    n = moments['n']
+    hist = np.asarray(moments['hist'][metric], dtype=float)
+    lo, hi = METRIC_RANGES[metric]
+    width = (hi - lo) / len(hist)
+    occupied = hist > 0
+    # kernels sit at the mean score of each bin, so spikes such as the many
+    # tweets scored exactly 0 are not shifted to the centre of their bin
+    means = np.asarray(moments['hist_sum'][metric])[occupied] \
+        / hist[occupied]
+    x = np.linspace(moments['min'][metric], moments['max'][metric], points)
+
+    mean = moments['sum'][metric] / n
+    variance = (moments['sum_sq'][metric] - n * mean ** 2) / max(n - 1, 1)
+    # never narrower than a bin, e.g. when every score is the same
+    bandwidth = max(np.sqrt(max(variance, 0.0)) * n ** (-1 / 5), width)
+
+    z = (x[:, None] - means[None, :]) / bandwidth
+    density = np.exp(-0.5 * z ** 2) @ hist[occupied] \
+        / (n * bandwidth * np.sqrt(2 * np.pi))
+    return np.round(x, 6).tolist(), np.round(density, 6).tolist()
+
+
+def rug(moments, metric):
+    '''
+    Non empty histogram bins of one metric with their tweet count and a
+    sample tweet, drawn instead of one rug mark per tweet.
+
+    Returns
+    -------
+    dict
+        x (mean score of each bin), count and sample lists
+    '''
+    hist = moments['hist'][metric]
+    hist_sum = moments['hist_sum'][metric]
+    bins = [i for i, count in enumerate(hist) if count]
+    return {'x': [round(hist_sum[i] / hist[i], 6) for i in bins],
+            'count': [hist[i] for i in bins],
+            'sample': [moments['sample'][metric][i] for i in bins]}
+
+
+def finalize_sentiment_stats(moments):
+    '''
+    Turns sentiment_moments into what the dashboard plots: per handle
+    trendlines, and a KDE curve and rug per metric.
+    '''
+    out = {'trendlines': {}, 'kde': {}, 'rug': {}}
+    for metric in METRIC_RANGES:
+        out['kde'][metric] = {}
+        out['rug'][metric] = {}
+    for handle, m in moments.items():
+        line = trendline(m)
+        if line is not None:
+            out['trendlines'][handle] = line
+        for metric in METRIC_RANGES:
+            x, density = kde_curve(m, metric)
+            out['kde'][metric][handle] = {'x': x, 'density': density}
+            out['rug'][metric][handle] = rug(m, metric)
+    return out
+
+
+def build_sentiment_stats(df, bins=HIST_BINS):
+    '''Sentiment statistics of tweets, see finalize_sentiment_stats'''
+    return finalize_sentiment_stats(sentiment_moments(df, bins))
+
+
+def save_sentiment_stats(stats, path):
+    '''Saves the output of finalize_sentiment_stats as JSON'''
+    with open(path, "w") as file:
+        json.dump(stats, file)
+
+
+def load_sentiment_stats(path):
+    '''Loads statistics saved with save_sentiment_stats'''
+    with open(path) as file:
+        stats = json.load(file)
+    stats['trendlines'] = {handle: tuple(line) for handle, line
+                           in stats['trendlines'].items()}
+    return stats
@@ -0,0 +1,752 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# columns stored as datetimes, parsed when reading csv files
+DATE_COLUMNS = ['date_time', 'date', 'date_week']
+
+# file extension -> storage format
+FORMATS = {".csv": "csv",
+           ".parquet": "parquet",
+           ".feather": "feather",
+           ".arrow": "feather",
+           ".parts": "partitioned"}
+
+# a partitioned table has one file per handle and week, listed in a manifest
+PARTITION_KEYS = ['handle', 'date_week']
+MANIFEST_NAME = "manifest.json"
+
+
+def table_format(path):
+    '''Returns the storage format of a path based on its extension'''
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown data format for {path}, expected one of "
+                         f"{', '.join(FORMATS)}")
+    return FORMATS[ext]
+
+
+def csv_path(path):
+    '''
+    Returns the csv version of a path, e.g. for exports. For a partitioned
+    table, e.g. data/tweets.parquet.parts, it is the flat data/tweets.csv.
+    '''
+    root = os.path.splitext(path)[0]
+    if path.endswith(".parts"):
+        root = os.path.splitext(root)[0]
+    return root + ".csv"
+
+
+def _resolve(path):
+    '''
+    The path and format read_table reads: the path itself, or if it does not
+    exist yet a flat file with the same name, e.g. the csv files in the repo
+    or a table moving to the partitioned layout
+    '''
+    fmt = table_format(path)
+    if fmt == "partitioned":
+        if PartitionedTable(path).exists():
+            return path, fmt
+        flat = os.path.splitext(path)[0]
+        if os.path.exists(flat):
+            return flat, table_format(flat)
+    elif os.path.exists(path):
+        return path, fmt
+    return csv_path(path), "csv"
+
+
+def table_exists(path):
+    '''True if read_table can read the path (or its csv fallback)'''
+    return os.path.exists(_resolve(path)[0])
+
+
+def content_path(path):
+    '''
+    The file whose content changes when the table read from a path does,
+    e.g. to fingerprint it: the manifest of a partitioned table, otherwise
+    the file read_table reads
+    '''
+    path, fmt = _resolve(path)
+    if fmt == "partitioned":
+        return PartitionedTable(path).manifest_path
+    return path
+
+
+def _text(values):
+    '''Values as strings, missing values kept missing'''
+    return values.astype(str).where(values.notnull(), None)
+
+
+def _to_columnar(df):
+    '''
+    Prepares a DataFrame for parquet/feather. Lists and dicts (e.g. hashtags
+    and user_mentions straight from the twitter API) and columns with mixed
+    types are stored as strings, the same way they end up in the csv files.
+    '''
+    df = df.reset_index(drop=True)
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        types = set(map(type, df[col].dropna()))
+        if len(types) > 1 or types & {list, dict, tuple}:
+            df[col] = _text(df[col])
+    return df
+
+
+def _is_text(arrow_type):
+    import pyarrow as pa
+    return pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)
+
+
+def _common_type(types):
+    '''
+    The type a column is written with when chunks have values of several
+    types: floats for ints and floats, text for anything else
+    '''
+    import pyarrow as pa
+    if not types:
+        return pa.string()
+    if all(t.equals(types[0]) for t in types):
+        return types[0]
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    return pa.string()
+
+
+def table_schema(path, chunk_rows):
+    '''
+    Arrow schema of a table for writing it again chunk by chunk with
+    TableWriter, e.g. the raw tweets while the clean tweets are streamed.
+    A column with no values in the first chunks (e.g. media or favorited,
+    which pandas reads as float when all missing) gets the type of its
+    later values. Parquet and feather files have their own schema, other
+    tables are read once, in chunks of chunk_rows.
+
+    Returns
+    -------
+    pyarrow.Schema
+    '''
+    import pyarrow as pa
+
+    resolved, fmt = _resolve(path)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_schema(resolved).remove_metadata()
+    if fmt == "feather":
+        import pyarrow.ipc as ipc
+        with pa.OSFile(resolved) as source:
+            return ipc.open_file(source).schema.remove_metadata()
+
+    types = {}
+    for chunk in iter_table(path, chunk_rows):
+        table = pa.Table.from_pandas(_to_columnar(chunk),
+                                     preserve_index=False)
+        for name in table.column_names:
+            column_types = types.setdefault(name, [])
+            if table[name].null_count < len(table):
+                column_types.append(table[name].type)
+    return pa.schema([(name, _common_type(column_types))
+                      for name, column_types in types.items()])
+
+
+def read_table(path, columns=None):
+    '''
+    Reads a data file written by write_table. If a parquet/feather file
+    does not exist yet but a csv file with the same name does, the csv file
+    is read instead. A partitioned table without a manifest yet reads the
+    flat file with the same name, e.g. data/tweets.parquet for
+    data/tweets.parquet.parts, or the csv file.
+
+    Parameters
+    ----------
+    path : str
+        A .csv, .parquet, .feather or .arrow file, or a .parts directory
+    columns : list of str
+        Only read these columns. By default, None (all columns).
+
+    Returns
+    -------
+    pd.DataFrame
+        With the date columns as datetimes
+    '''
+    path, fmt = _resolve(path)
+    if fmt == "partitioned":
+        return PartitionedTable(path).read(columns)
+    return _read_file(path, fmt, columns)
+
+
+def _read_file(path, fmt, columns=None):
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    if fmt == "feather":
+        return pd.read_feather(path, columns=columns)
+
+    header = pd.read_csv(path, nrows=0).columns
+    wanted = header if columns is None else columns
+    parse_dates = [col for col in DATE_COLUMNS if col in wanted]
+    return pd.read_csv(path, usecols=columns, parse_dates=parse_dates)
+
+
+def write_table(df, path, export_csv=False):
+    '''
+    Writes a DataFrame in the format given by the path's extension.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data to write, the index is not kept
+    path : str
+        A .csv, .parquet, .feather or .arrow file, or a .parts directory
+        (see PartitionedTable)
+    export_csv : bool
+        Also write a csv copy next to a parquet/feather file
+
+    Returns
+    -------
+    dict
+        For a partitioned table, the number of partitions written, unchanged
+        and removed, otherwise None
+    '''
+    fmt = table_format(path)
+    if fmt == "partitioned":
+        stats = PartitionedTable(path).write(df)
+        if export_csv:
+            df.to_csv(csv_path(path), index=False)
+        return stats
+    if fmt == "parquet":
+        _to_columnar(df).to_parquet(path, index=False)
+    elif fmt == "feather":
+        _to_columnar(df).to_feather(path)
+    if fmt == "csv" or export_csv:
+        df.to_csv(csv_path(path), index=False)
+
+
+def iter_table(path, chunk_rows, columns=None):
+    '''
+    Reads a data file written by write_table or TableWriter in chunks, so
+    files larger than memory can be processed.
+
+    Parameters
+    ----------
+    path : str
+        A .csv, .parquet, .feather or .arrow file, or a .parts directory,
+        with the same fallback as read_table
+    chunk_rows : int
+        Rows per chunk
+    columns : list of str
+        Only read these columns. By default, None (all columns).
+
+    Yields
+    ------
+    pd.DataFrame
+        With the date columns as datetimes and a index continuing from the
+        previous chunk
+    '''
+    path, fmt = _resolve(path)
+    if fmt == "partitioned":
+        yield from PartitionedTable(path).iter_chunks(chunk_rows, columns)
+        return
+
+    if fmt == "csv":
+        header = pd.read_csv(path, nrows=0).columns
+        wanted = header if columns is None else columns
+        parse_dates = [col for col in DATE_COLUMNS if col in wanted]
+        yield from pd.read_csv(path, usecols=columns, parse_dates=parse_dates,
+                               chunksize=chunk_rows)
+        return
+
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        file = pq.ParquetFile(path)
+        groups = (file.read_row_group(i, columns=columns)
+                  for i in range(file.num_row_groups))
+    else:
+        # memory mapped, batches are only read when converted
+        groups = feather.read_table(path, columns=columns,
+                                    memory_map=True).to_batches()
+    start = 0
+    for group in groups:
+        # row groups and record batches are split further if they are larger
+        # than chunk_rows
+        for offset in range(0, group.num_rows, chunk_rows):
+            df = group.slice(offset, chunk_rows).to_pandas()
+            if columns is not None:
+                df = df[columns]
+            df.index = pd.RangeIndex(start, start + len(df))
+            start += len(df)
+            yield df
+
+
+class TableWriter:
+    '''
+    Writes a DataFrame to a data file one chunk at a time, in the format
+    given by the path's extension. Every chunk must have the same columns.
+    A partitioned table is written best with the chunks in partition order
+    (see partition_order), then each partition is written once it is
+    complete.
+
+    Parameters
+    ----------
+    path : str
+        A .csv, .parquet, .feather or .arrow file, or a .parts directory
+    export_csv : bool
+        Also write a csv copy next to a parquet/feather file
+    schema : pyarrow.Schema
+        Types of some of the columns of a parquet/feather file, e.g. from
+        table_schema, so a column with no values in the first chunk is not
+        written with the wrong type. Other columns take their type from the
+        first chunk. By default, None.
+    '''
+
+    def __init__(self, path, export_csv=False, schema=None):
+        self.path = path
+        self.format = table_format(path)
+        self.export_csv = export_csv
+        self.rows = 0
+        # partitions written, unchanged and removed, set on close
+        self.stats = None
+        self._given_schema = schema
+        self._schema = None
+        self._writer = None
+        if self.format == "partitioned":
+            self._writer = PartitionWriter(PartitionedTable(path))
+
+    def _arrow_table(self, df):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(_to_columnar(df), preserve_index=False)
+        if self._schema is None:
+            # columns not in the given schema take the type of the first
+            # chunk, text if it has no values
+            given = self._given_schema
+            self._schema = pa.schema([
+                given.field(field.name)
+                if given is not None and field.name in given.names
+                else field.with_type(pa.string())
+                if pa.types.is_null(field.type) else field
+                for field in table.schema
+            ])
+
+        columns = []
+        for field in self._schema:
+            column = table[field.name]
+            if column.null_count == len(column):
+                column = pa.nulls(len(column), field.type)
+            elif _is_text(field.type) and not _is_text(column.type):
+                # e.g. a chunk with only numbers in a column that also has
+                # text, written as text the same way _to_columnar does
+                column = pa.array(_text(df[field.name]), type=field.type)
+            elif not column.type.equals(field.type):
+                column = column.cast(field.type)
+            columns.append(column)
+        return pa.Table.from_arrays(columns, schema=self._schema)
+
+    def write(self, df):
+        '''Appends a chunk'''
+        if self.format == "partitioned":
+            self._writer.write(df)
+        elif self.format in ("parquet", "feather"):
+            table = self._arrow_table(df)
+            if self._writer is None:
+                if self.format == "parquet":
+                    import pyarrow.parquet as pq
+                    self._writer = pq.ParquetWriter(self.path, self._schema)
+                else:
+                    import pyarrow.ipc as ipc
+                    self._writer = ipc.new_file(self.path, self._schema)
+            self._writer.write_table(table)
+        if self.format == "csv" or self.export_csv:
+            df.to_csv(csv_path(self.path), index=False,
+                      mode="w" if self.rows == 0 else "a",
+                      header=self.rows == 0)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            if self.format == "partitioned":
+                self.stats = self._writer.stats
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def partition_order(df):
+    '''
+    Sorts rows by handle and week, keeping the order within each week. A
+    partitioned table is read in this order.
+    '''
+    return df.sort_values(PARTITION_KEYS, kind='stable').reset_index(drop=True)
+
+
+def _week_key(values):
+    '''Dates as ISO strings, the week of a partition'''
+    return pd.DatetimeIndex(pd.to_datetime(values)).strftime("%Y-%m-%d")
+
+
+def _canonical_csv(df):
+    '''
+    A partition as csv text, used to tell if it changed. Numbers are written
+    with 15 significant digits, so a column read back with another dtype or
+    a float that moved by a rounding error through a csv file (e.g. the
+    ids in quoted_status_id_str) has the same text.
+    '''
+    df = df.reset_index(drop=True)
+    for col in df.columns:
+        if df[col].dtype.kind in 'iu':
+            df[col] = df[col].astype('float64')
+    return df.to_csv(index=False, float_format='%.15g')
+
+
+class PartitionedTable:
+    '''
+    A table split into one file per handle and week (PARTITION_KEYS) under
+    a directory, e.g. data/tweets.parquet.parts/JustinTrudeau/2019-09-09
+    .parquet, with a manifest.json listing each partition's handle, week,
+    file, number of rows, date range and content hash.
+
+    Writing only rewrites the partitions whose content hash changed and
+    removes the ones no longer in the data, so a refresh that adds a week
+    of tweets writes one file per handle. Reading can be limited to some
+    handles and dates, then only the files holding them are opened.
+    Partitions are read in handle and week order (see partition_order).
+
+    Parameters
+    ----------
+    path : str
+        A directory ending in .parts, the extension before it is the format
+        of the partition files, e.g. data/tweets.parquet.parts
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        root = os.path.splitext(path)[0]
+        self.format = table_format(root)
+        if self.format == "partitioned":
+            raise ValueError(f"{path} does not give a format for the "
+                             f"partition files, e.g. tweets.parquet.parts")
+        self.ext = os.path.splitext(root)[1].lower()
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def load_manifest(self):
+        if not self.exists():
+            return {"columns": None, "partitions": []}
+        with open(self.manifest_path) as file:
+            return json.load(file)
+
+    def _save_manifest(self, manifest):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def partitions(self, handles=None, start_date=None, end_date=None):
+        '''
+        Manifest entries of the partitions holding tweets of some handles
+        between two dates, in read order.
+
+        Parameters
+        ----------
+        handles : list of str
+            By default, None (all handles)
+        start_date, end_date : str or datetime
+            Date range, inclusive. By default, None (no limit).
+        '''
+        start = None if start_date is None else str(start_date)[:10]
+        end = None if end_date is None else str(end_date)[:10]
+        entries = []
+        for entry in self.load_manifest()["partitions"]:
+            if handles is not None and entry["handle"] not in handles:
+                continue
+            # ISO dates compare as strings
+            if start is not None and entry["max_date"] < start:
+                continue
+            if end is not None and entry["min_date"] > end:
+                continue
+            entries.append(entry)
+        return entries
+
+    def _read_partition(self, entry, columns=None):
+        return _read_file(os.path.join(self.path, entry["file"]),
+                          self.format, columns)
+
+    def _empty(self, columns=None):
+        manifest_columns = self.load_manifest()["columns"] or []
+        return pd.DataFrame(columns=columns or manifest_columns)
+
+    def read(self, columns=None, handles=None, start_date=None,
+             end_date=None):
+        '''
+        Reads the partitions returned by partitions(handles, start_date,
+        end_date), whole, in read order.
+
+        Parameters
+        ----------
+        columns : list of str
+            Only read these columns. By default, None (all columns).
+        '''
+        frames = [self._read_partition(entry, columns)
+                  for entry in self.partitions(handles, start_date,
+                                               end_date)]
+        if not frames:
+            return self._empty(columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def read_rows(self, rows, columns=None):
+        '''
+        Reads rows by position in the whole table, e.g. the rows of a search
+        index built from it, opening only the partitions they are in.
+
+        Parameters
+        ----------
+        rows : array of int
+            Sorted row positions
+        columns : list of str
+            Only read these columns. By default, None (all columns).
+
+        Returns
+        -------
+        pd.DataFrame
+            Indexed by row position
+        '''
+        entries = self.load_manifest()["partitions"]
+        rows = np.asarray(rows, dtype=np.int64)
+        ends = np.cumsum([entry["rows"] for entry in entries], dtype=np.int64)
+        parts = np.searchsorted(ends, rows, side='right')
+        frames = []
+        for part in np.unique(parts):
+            selected = rows[parts == part]
+            start = ends[part] - entries[part]["rows"]
+            df = self._read_partition(entries[part], columns)
+            df = df.iloc[selected - start]
+            df.index = selected
+            frames.append(df)
+        if not frames:
+            return self._empty(columns)
+        return pd.concat(frames)
+
+    def iter_chunks(self, chunk_rows, columns=None):
+        '''
+        Reads the table in read order, in chunks of about chunk_rows rows.
+        Small partitions are joined into one chunk and large ones split,
+        the index continues from the previous chunk.
+        '''
+        frames, rows, start = [], 0, 0
+        for entry in self.partitions():
+            df = self._read_partition(entry, columns)
+            for offset in range(0, len(df), chunk_rows):
+                frames.append(df.iloc[offset:offset + chunk_rows])
+                rows += len(frames[-1])
+                if rows >= chunk_rows:
+                    chunk = pd.concat(frames, ignore_index=True)
+                    chunk.index = pd.RangeIndex(start, start + len(chunk))
+                    start += len(chunk)
+                    frames, rows = [], 0
+                    yield chunk
+        if frames:
+            chunk = pd.concat(frames, ignore_index=True)
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            yield chunk
+
+    def _write_partition(self, key, df, previous, stats):
+        '''
+        Writes one partition unless its content is the same as the previous
+        manifest entry's, returns its manifest entry
+        '''
+        handle, week = key
+        text = _canonical_csv(df)
+        dates = df['date'].dropna() if 'date' in df else []
+        entry = {
+            "handle": handle,
+            "week": week,
+            "file": f"{handle}/{week}{self.ext}",
+            "rows": len(df),
+            "min_date": _week_key([dates.min()])[0] if len(dates) else week,
+            "max_date": _week_key([dates.max()])[0] if len(dates) else week,
+            "hash": hashlib.sha1(text.encode("utf-8")).hexdigest()
+        }
+        path = os.path.join(self.path, entry["file"])
+        if previous is not None and previous["hash"] == entry["hash"] \
+                and os.path.exists(path):
+            stats["unchanged"] += 1
+            return entry
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.format == "parquet":
+            _to_columnar(df).to_parquet(path, index=False)
+        elif self.format == "feather":
+            _to_columnar(df).to_feather(path)
+        else:
+            df.to_csv(path, index=False)
+        stats["written"] += 1
+        return entry
+
+    def write(self, df):
+        '''
+        Replaces the table with a DataFrame, see write_table
+
+        Returns
+        -------
+        dict
+            The number of partitions written, unchanged and removed
+        '''
+        with PartitionWriter(self) as writer:
+            writer.write(df)
+        return writer.stats
+
+
+class PartitionWriter:
+    '''
+    Replaces a PartitionedTable one chunk at a time, see TableWriter. Rows
+    are kept until their partition is complete, i.e. a later chunk starts
+    at a later partition, then written. The manifest is only replaced on
+    close, so readers see the old table until then.
+
+    Parameters
+    ----------
+    table : PartitionedTable
+    '''
+
+    def __init__(self, table):
+        self.table = table
+        self.stats = {"written": 0, "unchanged": 0, "removed": 0}
+        self._previous = {(entry["handle"], entry["week"]): entry
+                          for entry in table.load_manifest()["partitions"]}
+        self._entries = {}
+        self._pending = {}
+        self._columns = None
+
+    def write(self, df):
+        '''Appends a chunk'''
+        if df[PARTITION_KEYS].isnull().any(axis=None):
+            raise ValueError(f"{self.table.path} is partitioned by "
+                             f"{', '.join(PARTITION_KEYS)}, which can not be "
+                             f"missing")
+        if self._columns is None:
+            self._columns = list(df.columns)
+        if len(df) == 0:
+            return
+        weeks = _week_key(df['date_week'])
+        # groupby keeps the order of the rows within each partition
+        for key, part in df.groupby([df['handle'].values, weeks], sort=True):
+            self._pending.setdefault(key, []).append(part)
+
+        first = min(zip(df['handle'].values, weeks))
+        for key in sorted(key for key in self._pending if key < first):
+            self._flush(key)
+
+    def _flush(self, key):
+        df = pd.concat(self._pending.pop(key), ignore_index=True)
+        if key in self._entries:
+            # the partition was written already, the input was not in
+            # partition order
+            df = pd.concat([self.table._read_partition(self._entries[key]),
+                            df], ignore_index=True)
+        self._entries[key] = self.table._write_partition(
+            key, df, self._previous.get(key), self.stats)
+
+    def close(self):
+        for key in sorted(self._pending):
+            self._flush(key)
+        for key, entry in self._previous.items():
+            path = os.path.join(self.table.path, entry["file"])
+            if key not in self._entries and os.path.exists(path):
+                os.remove(path)
+                self.stats["removed"] += 1
+        self.table._save_manifest({
+            "columns": self._columns,
+            "partitions": [self._entries[key] for key in sorted(self._entries)]
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_tweets(path, columns=None, handles=None, start_date=None,
+                end_date=None):
+    '''
+    Reads the tweets of some handles between two dates. A partitioned table
+    only opens the partitions holding them, other tables are read whole and
+    filtered.
+
+    Parameters
+    ----------
+    path : str
+        A data file or .parts directory, see read_table
+    columns : list of str
+        Only read these columns. By default, None (all columns).
+    handles : list of str
+        By default, None (all handles)
+    start_date, end_date : str or datetime
+        Date range, inclusive. By default, None (no limit).
+
+    Returns
+    -------
+    pd.DataFrame
+        The matching rows, in the order read_table returns them
+    '''
+    needed = [] if columns is None else [
+        col for col, used in [('handle', handles is not None),
+                              ('date', start_date is not None
+                               or end_date is not None)]
+        if used and col not in columns]
+    read_columns = None if columns is None else list(columns) + needed
+
+    path, fmt = _resolve(path)
+    if fmt == "partitioned":
+        df = PartitionedTable(path).read(read_columns, handles, start_date,
+                                         end_date)
+    else:
+        df = _read_file(path, fmt, read_columns)
+
+    keep = np.ones(len(df), dtype=bool)
+    if handles is not None:
+        keep &= df['handle'].isin(handles).values
+    if start_date is not None:
+        keep &= (df['date'] >= pd.Timestamp(start_date)).values
+    if end_date is not None:
+        keep &= (df['date'] <= pd.Timestamp(end_date)).values
+    df = df[keep].reset_index(drop=True)
+    return df.drop(columns=needed)
+
+
+def read_rows(path, rows, columns=None):
+    '''
+    Reads rows by position, e.g. the rows of a search index. A partitioned
+    table only opens the partitions holding them, other tables are read
+    whole.
+
+    Parameters
+    ----------
+    path : str
+        A data file or .parts directory, see read_table
+    rows : array of int
+        Sorted row positions
+    columns : list of str
+        Only read these columns. By default, None (all columns).
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by row position
+    '''
+    path, fmt = _resolve(path)
+    if fmt == "partitioned":
+        return PartitionedTable(path).read_rows(rows, columns)
+    return _read_file(path, fmt, columns).iloc[rows]
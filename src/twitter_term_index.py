@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class TermIndex:
+    '''
+    Term counts per day and handle, stored as a sparse matrix with one row
+    per (date, handle) and one column per term. Rows are sorted by date so
+    a date range is a contiguous block of rows.
+
+    Parameters
+    ----------
+    dates : np.ndarray
+        datetime64 date of each row, sorted
+    handles : np.ndarray
+        Handle of each row
+    terms : np.ndarray
+        Term of each column
+    counts : scipy.sparse.csr_matrix
+        Number of times each term was used on each row's date and handle
+    '''
+
+    def __init__(self, dates, handles, terms, counts):
+        self.dates = dates
+        self.handles = handles
+        self.terms = terms
+        self.counts = counts
+
+    def rows_between(self, start_date, end_date):
+        '''Returns the slice of rows from start_date to end_date inclusive'''
+        start = np.datetime64(pd.to_datetime(start_date))
+        end = np.datetime64(pd.to_datetime(end_date))
+        lo = np.searchsorted(self.dates, start, side='left')
+        hi = np.searchsorted(self.dates, end, side='right')
+        return slice(lo, hi)
+
+
+def tweet_ngrams(text, ngrams=(1,)):
+    '''
+    Returns the n-grams of a clean tweet, words joined by "_" (e.g.
+    "justin_trudeau"). n-grams do not run across tweets.
+    '''
+    words = text.split()
+    terms = []
+    for n in ngrams:
+        if n == 1:
+            terms += words
+        else:
+            terms += ["_".join(words[i:i + n])
+                      for i in range(len(words) - n + 1)]
+    return terms
+
+
+class TermIndexBuilder:
+    '''
+    Counts terms per day and handle one chunk of tweets at a time, keeping
+    a single vocabulary, so the memory used depends on the number of terms
+    and days rather than the number of tweets.
+
+    Parameters
+    ----------
+    text_col : str
+        Column of clean, space separated text
+    ngrams : tuple of int
+        Which n-grams to count, (1,) for words, (2, 3) for phrases
+    '''
+
+    def __init__(self, text_col='clean_tweet', ngrams=(1,)):
+        self.text_col = text_col
+        self.ngrams = ngrams
+        self.vocab = {}
+        self.row_of = {}
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.int32)
+
+    def add(self, df):
+        '''Adds the tweets in df, which has date, handle and text_col'''
+        rows = []
+        cols = []
+        for date, handle, text in zip(df['date'], df['handle'],
+                                      df[self.text_col]):
+            row = self.row_of.setdefault((date, handle), len(self.row_of))
+            if not isinstance(text, str):
+                continue
+            for term in tweet_ngrams(text, self.ngrams):
+                rows.append(row)
+                cols.append(self.vocab.setdefault(term, len(self.vocab)))
+
+        # duplicate (row, col) pairs are summed when converting to csr
+        shape = (len(self.row_of), len(self.vocab))
+        chunk = sparse.coo_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=shape
+        ).tocsr()
+        self.counts.resize(shape)
+        self.counts = self.counts + chunk
+        return self
+
+    def add_tokens(self, df, tokens):
+        '''
+        Adds the tweets in df (with date and handle columns) from their
+        tokens, a TokenStore of text_col, without splitting the text again.
+        '''
+        keys = pd.MultiIndex.from_arrays([df['date'], df['handle']])
+        codes, uniques = pd.factorize(keys)
+        rows = np.array([self.row_of.setdefault(key, len(self.row_of))
+                         for key in uniques], dtype=np.int64)
+
+        out_rows = []
+        out_cols = []
+        out_data = []
+        for n in self.ngrams:
+            counts = tokens.count(n, codes)
+            terms = tokens.ngram_terms(counts['key'], n)
+            out_rows.append(rows[counts['group'].values])
+            out_cols.append(np.array(
+                [self.vocab.setdefault(term, len(self.vocab))
+                 for term in terms], dtype=np.int64))
+            out_data.append(counts['count'].values.astype(np.int32))
+
+        shape = (len(self.row_of), len(self.vocab))
+        chunk = sparse.coo_matrix(
+            (np.concatenate(out_data),
+             (np.concatenate(out_rows), np.concatenate(out_cols))),
+            shape=shape).tocsr()
+        self.counts.resize(shape)
+        self.counts = self.counts + chunk
+        return self
+
+    def build(self):
+        '''Returns the TermIndex of every tweet added so far'''
+        keys = sorted(self.row_of)
+        order = [self.row_of[key] for key in keys]
+        terms = np.empty(len(self.vocab), dtype=object)
+        for term, col in self.vocab.items():
+            terms[col] = term
+        return TermIndex(
+            dates=np.array([key[0] for key in keys], dtype='datetime64[ns]'),
+            handles=np.array([key[1] for key in keys], dtype=str),
+            terms=terms.astype(str), counts=self.counts[order])
+
+
+def build_term_index(df, text_col='clean_tweet', ngrams=(1,)):
+    '''
+    Builds a TermIndex from clean tweets.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Tweets with date, handle and text_col columns
+    text_col : str
+        Column of clean, space separated text
+    ngrams : tuple of int
+        Which n-grams to count, (1,) for words, (2, 3) for phrases
+
+    Returns
+    -------
+    TermIndex
+    '''
+    return TermIndexBuilder(text_col, ngrams).add(df).build()
+
+
+def save_term_index(index, path):
+    '''Saves a TermIndex to an .npz file'''
+    np.savez_compressed(
+        path, data=index.counts.data, indices=index.counts.indices,
+        indptr=index.counts.indptr, shape=index.counts.shape,
+        dates=index.dates, handles=index.handles, terms=index.terms
+    )
+
+
+def load_term_index(path):
+    '''Loads a TermIndex saved with save_term_index'''
+    with np.load(path) as f:
+        counts = sparse.csr_matrix(
+            (f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return TermIndex(dates=f['dates'], handles=f['handles'],
+                         terms=f['terms'], counts=counts)
+
+
+def _top(counts, n):
+    '''Column positions of the n largest counts, largest first'''
+    n = min(n, int((counts > 0).sum()))
+    if n == 0:
+        return np.array([], dtype=int)
+    top = np.argpartition(-counts, n - 1)[:n]
+    return top[np.argsort(-counts[top], kind='stable')]
+
+
+def top_terms(index, start_date, end_date, handle="All", n=50,
+              term_col='word'):
+    '''
+    Returns the most used terms between two dates, in the same layout as
+    the word-count and phrase-count files.
+
+    Parameters
+    ----------
+    index : TermIndex
+    start_date, end_date : str or datetime
+        Date range, inclusive
+    handle : str
+        A handle, or "All" for the top terms across every handle broken
+        down by handle
+    n : int
+        Number of terms
+    term_col : str
+        Name of the term column, "word" or "phrase"
+
+    Returns
+    -------
+    pd.DataFrame
+        term_col, count, handle, total_count and rank columns
+    '''
+    rows = index.rows_between(start_date, end_date)
+    handles = index.handles[rows]
+    block = index.counts[rows]
+
+    if handle != "All":
+        block = block[handles == handle]
+        totals = np.asarray(block.sum(axis=0)).ravel()
+        top = _top(totals, n)
+        return pd.DataFrame({term_col: index.terms[top],
+                             'count': totals[top],
+                             'handle': handle,
+                             'total_count': totals[top],
+                             'rank': np.arange(1, len(top) + 1)})
+
+    totals = np.asarray(block.sum(axis=0)).ravel()
+    top = _top(totals, n)
+    out = []
+    for user in np.unique(handles):
+        counts = np.asarray(
+            block[handles == user][:, top].sum(axis=0)).ravel()
+        out.append(pd.DataFrame({term_col: index.terms[top],
+                                 'count': counts,
+                                 'handle': user,
+                                 'total_count': totals[top],
+                                 'rank': np.arange(1, len(top) + 1)}))
+    if not out:
+        return pd.DataFrame(columns=[term_col, 'count', 'handle',
+                                     'total_count', 'rank'])
+    out = pd.concat(out, ignore_index=True)
+    return out[out['count'] > 0].sort_values(
+        by=['rank', 'count'], ascending=[True, False]).reset_index(drop=True)
@@ -0,0 +1,172 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# runs of letters, what mention keywords are matched against
+LETTER_RUN_PATTERN = re.compile(r"[a-z]+")
+
+
+def letter_runs(text):
+    '''
+    Lower case runs of letters in a text, e.g. "#May2019 it's" -> ["may",
+    "it", "s"]. Matching keywords against these is matching them as whole
+    words.
+    '''
+    return LETTER_RUN_PATTERN.findall(text.lower())
+
+
+class TokenStore:
+    '''
+    Tokens of many tweets as integers: a vocabulary, one flat array with
+    the token ids of every tweet and the offset of each tweet in it, so the
+    tokens of tweet i are ids[offsets[i]:offsets[i + 1]]. Texts are split
+    once, counting, n-grams and searches then work on the arrays.
+
+    Parameters
+    ----------
+    vocab : dict
+        token -> id
+    ids : np.ndarray
+        Token ids of every tweet, one after the other
+    offsets : np.ndarray
+        Start of each tweet in ids, plus the end of the last one
+    '''
+
+    def __init__(self, vocab, ids, offsets):
+        self.vocab = vocab
+        self.ids = ids
+        self.offsets = offsets
+        self.terms = np.empty(len(vocab), dtype=object)
+        for token, i in vocab.items():
+            self.terms[i] = token
+        self._ngrams = {}
+        # n -> the distinct n-grams as rows of ids, for n-grams whose keys
+        # would not fit in 64 bits written in base len(vocab)
+        self._ngram_rows = {}
+
+    @classmethod
+    def from_texts(cls, texts, tokenize=str.split):
+        '''
+        Tokenizes texts, e.g. clean tweets with str.split or raw tweets with
+        letter_runs. Anything that is not a string has no tokens.
+        '''
+        vocab = {}
+        setdefault = vocab.setdefault
+        ids = []
+        offsets = [0]
+        for text in texts:
+            if isinstance(text, str):
+                ids.extend([setdefault(token, len(vocab))
+                            for token in tokenize(text)])
+            offsets.append(len(ids))
+        return cls(vocab, np.array(ids, dtype=np.int64),
+                   np.array(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def tokens(self, i):
+        '''Tokens of tweet i'''
+        return list(self.terms[self.ids[self.offsets[i]:self.offsets[i + 1]]])
+
+    def ngrams(self, n):
+        '''
+        Every n-gram that does not run across tweets.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            The tweet of each n-gram and its key, the token ids written as
+            one number in base len(vocab), see ngram_terms. When those
+            would not fit in 64 bits (a vocabulary of millions of tokens),
+            the key is the n-gram's position among the distinct n-grams.
+        '''
+        if n not in self._ngrams:
+            starts = len(self.ids) - n + 1
+            if starts <= 0:
+                empty = np.array([], dtype=np.int64)
+                self._ngrams[n] = (empty, empty)
+                return self._ngrams[n]
+            tweet_of = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+            inside = tweet_of[:starts] == tweet_of[n - 1:n - 1 + starts]
+            if len(self.vocab) ** n < 2 ** 63:
+                keys = self.ids[:starts].copy()
+                for k in range(1, n):
+                    keys = keys * len(self.vocab) + self.ids[k:k + starts]
+                keys = keys[inside]
+            else:
+                rows, keys = np.unique(
+                    np.stack([self.ids[k:k + starts][inside]
+                              for k in range(n)], axis=1),
+                    axis=0, return_inverse=True)
+                self._ngram_rows[n] = rows
+                keys = keys.reshape(-1).astype(np.int64)
+            self._ngrams[n] = (tweet_of[:starts][inside], keys)
+        return self._ngrams[n]
+
+    def _key(self, ids):
+        '''Key of an n-gram given its token ids, None if it is not used'''
+        n = len(ids)
+        if n in self._ngram_rows:
+            found = np.flatnonzero((self._ngram_rows[n] == ids).all(axis=1))
+            return found[0] if len(found) else None
+        key = 0
+        for i in ids:
+            key = key * len(self.vocab) + i
+        return key
+
+    def ngram_terms(self, keys, n, sep="_"):
+        '''n-gram keys back to text, tokens joined by sep'''
+        keys = np.asarray(keys, dtype=np.int64)
+        if n in self._ngram_rows:
+            rows = self._ngram_rows[n][keys]
+            columns = [self.terms[rows[:, k]] for k in reversed(range(n))]
+        else:
+            columns = []
+            for _ in range(n):
+                keys, token = np.divmod(keys, len(self.vocab))
+                columns.append(self.terms[token])
+        return [sep.join(tokens) for tokens in zip(*reversed(columns))]
+
+    def count(self, n, groups):
+        '''
+        Counts n-grams per group of tweets.
+
+        Parameters
+        ----------
+        n : int
+            1 for tokens, 2 for pairs of tokens, ...
+        groups : np.ndarray
+            Integer group of each tweet, e.g. a handle code
+
+        Returns
+        -------
+        pd.DataFrame
+            group, key and count of every n-gram used in each group
+        '''
+        tweets, keys = self.ngrams(n)
+        counts = pd.DataFrame({'group': np.asarray(groups)[tweets],
+                               'key': keys})
+        return counts.groupby(['group', 'key']).size() \
+            .reset_index(name='count')
+
+    def contains(self, sequences):
+        '''
+        Which tweets contain any of several token sequences, e.g.
+        [["trudeau"], ["justin", "trudeau"]].
+
+        Returns
+        -------
+        np.ndarray
+            True for each tweet containing at least one sequence
+        '''
+        found = np.zeros(len(self), dtype=bool)
+        for sequence in sequences:
+            if not sequence or any(i not in self.vocab for i in sequence):
+                continue
+            tweets, keys = self.ngrams(len(sequence))
+            key = self._key([self.vocab[token] for token in sequence])
+            if key is not None:
+                found[tweets[keys == key]] = True
+        return found
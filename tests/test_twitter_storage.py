@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.twitter_storage import (TableWriter, iter_table, read_table,
+                                 table_schema)
+
+
+@pytest.mark.parametrize("ext", ["parquet", "feather"])
+def test_table_writer_sparse_columns(tmp_path, ext):
+    '''
+    Columns with no values in the first chunk (read by pandas as float) keep
+    the values of later chunks
+    '''
+    pytest.importorskip("pyarrow")
+    raw = pd.DataFrame({
+        'id': [1, 2, 3, 4, 5, 6],
+        'media': [np.nan, np.nan, "[{'type': 'photo'}]", np.nan,
+                  [{'type': 'video'}], np.nan],
+        'favorited': [np.nan, np.nan, True, np.nan, np.nan, False],
+        'count': [1, 2, 1.5, np.nan, 3, 4],
+        'source': [np.nan, np.nan, np.nan, 7, np.nan, "web"]
+    })
+    raw_path = str(tmp_path / "raw.csv")
+    raw.to_csv(raw_path, index=False)
+
+    path = str(tmp_path / f"tweets.{ext}")
+    with TableWriter(path, schema=table_schema(raw_path, 2)) as writer:
+        for chunk in iter_table(raw_path, 2):
+            writer.write(chunk)
+
+    df = read_table(path).astype(object)
+    df = df.where(df.notnull(), None)
+    assert df['id'].tolist() == [1, 2, 3, 4, 5, 6]
+    assert df['media'].tolist() == [None, None, "[{'type': 'photo'}]", None,
+                                    "[{'type': 'video'}]", None]
+    assert df['favorited'].tolist() == [None, None, True, None, None, False]
+    assert df['count'].tolist() == [1.0, 2.0, 1.5, None, 3.0, 4.0]
+    # a chunk with only numbers in a text column is written as text
+    assert df['source'].tolist() == [None, None, None, "7.0", None, "web"]